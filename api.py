@@ -0,0 +1,215 @@
+"""HTTP API to search the transcripts and stream the vocals, see the Gradio UI for the search options.
+    GET /search?keyword=晚上好&roomid=all&date_from=20220101&date_to=20770101&options=Pinyin&order=Relevance&page=1
+    GET /rooms
+    GET /recordings/{base_name}/segments
+    GET /audio/{base_name}?start=12.5&end=20
+"""
+import os, sys, asyncio, mp3index, corpus, utils
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Iterator
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from utils import msg
+
+
+# seconds between checks for new transcripts
+UPDATE_INTERVAL = 60
+# threads for searches and transcript loading, started on the first one
+_pool: ThreadPoolExecutor | None = None
+MAX_PAGE_SIZE = 1000
+OPTIONS = ["Pinyin", "Phrase", "Exact Match", "Ends With"]
+ORDERS = ["Chronological", "Relevance"]
+# bytes per read of the audio
+CHUNK = 64 * 1024
+
+
+def pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(
+            utils.config.get("api_workers", 4), thread_name_prefix="api"
+        )
+    return _pool
+
+
+async def offload(func, *args):
+    """run a blocking function in the pool"""
+    return await asyncio.get_running_loop().run_in_executor(pool(), func, *args)
+
+
+async def update() -> None:
+    while True:
+        await asyncio.sleep(UPDATE_INTERVAL)
+        try:
+            if await offload(corpus.outdated):
+                await offload(corpus.load_transcript, True)
+        except Exception as e:
+            msg("API", "Update Failed", repr(e), error=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await offload(corpus.load_transcript)
+    task = asyncio.create_task(update())
+    yield
+    task.cancel()
+
+
+app = FastAPI(title="auto-transcribe", lifespan=lifespan)
+
+
+def vocal_of(base_name: str) -> tuple[str, float, float]:
+    """(vocal, offset, duration) of a recording, see corpus.vocal()"""
+    if os.path.basename(base_name) != base_name:
+        raise HTTPException(404, f"no vocal for {base_name}")
+    vocal, offset, duration = corpus.vocal(base_name)
+    if not os.path.exists(vocal):
+        raise HTTPException(404, f"no vocal for {base_name}")
+    return vocal, offset, duration
+
+
+def segment(row, margin: float = 0.0) -> dict:
+    start, end = max(float(row["start"]) - margin, 0), float(row["end"]) + margin
+    return {
+        "roomid": str(row["roomid"]),
+        "basename": row["basename"],
+        "date": int(row["date"]),
+        "start": float(row["start"]),
+        "end": float(row["end"]),
+        "text": row["text"],
+        "audio": f"/audio/{row['basename']}?start={start:.2f}&end={end:.2f}",
+    }
+
+
+@app.get("/search")
+async def search(
+    keyword: str,
+    roomid: str = "all",
+    date_from: int = 20220101,
+    date_to: int = 20770101,
+    options: list[str] = Query([]),
+    order: str = "Chronological",
+    page: int = 1,
+    page_size: int = Query(corpus.PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    margin: float = 2,
+) -> dict:
+    """Matched segments like the search UI, with links to their audio including the margin in seconds."""
+    if not set(options) <= set(OPTIONS) or order not in ORDERS:
+        raise HTTPException(422, f"options must be in {OPTIONS} and order in {ORDERS}")
+    rows, total, page, total_page = await offload(
+        corpus.search,
+        corpus.STORE,
+        roomid,
+        date_from,
+        date_to,
+        keyword,
+        options,
+        order,
+        page,
+        page_size,
+    )
+    return {
+        "total": total,
+        "page": page,
+        "total_page": total_page,
+        "results": [segment(row, margin) for _, row in rows.iterrows()],
+    }
+
+
+@app.get("/rooms")
+async def rooms() -> list[str]:
+    return corpus.STORE.rooms
+
+
+def recording_segments(base_name: str) -> list[dict]:
+    rows = corpus.STORE.segments(base_name)
+    if rows.empty:
+        raise HTTPException(404, f"no transcript for {base_name}")
+    return [segment(row) for _, row in rows.iterrows()]
+
+
+@app.get("/recordings/{base_name}/segments")
+async def recording(base_name: str) -> list[dict]:
+    return await offload(recording_segments, base_name)
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """[first, last] bytes of a single range "bytes=a-b", "bytes=a-" or "bytes=-n", None if several"""
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    a, _, b = ranges.strip().partition("-")
+    try:
+        if not a:
+            # a suffix longer than the file is the whole file
+            first, last = max(size - int(b), 0), size - 1
+        else:
+            first, last = int(a), min(int(b), size - 1) if b else size - 1
+    except ValueError:
+        return None
+    if first < 0 or first > last:
+        raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+    return first, last
+
+
+def read(vocal: str, first: int, last: int) -> Iterator[bytes]:
+    with open(vocal, "rb") as f:
+        f.seek(first)
+        left = last - first + 1
+        while left > 0:
+            data = f.read(min(CHUNK, left))
+            if not data:
+                break
+            left -= len(data)
+            yield data
+
+
+@app.get("/audio/{base_name}")
+async def audio(
+    base_name: str,
+    request: Request,
+    start: float | None = None,
+    end: float | None = None,
+) -> StreamingResponse:
+    """The whole mp3 frames of the vocal covering [start, end], which play on their own. The times they actually
+    cover are in the X-Start and X-End headers. A duplicate recording is served from the canonical vocal.
+    """
+    vocal, offset, duration = vocal_of(base_name)
+    if start is None and end is None and duration == np.inf:
+        first, stop = 0, os.path.getsize(vocal)
+        headers = {}
+    else:
+        # builds the frame index on first use
+        first, stop, start, end = await offload(
+            mp3index.locate,
+            vocal,
+            offset + (start or 0.0),
+            offset + min(np.inf if end is None else end, duration),
+        )
+        headers = {"X-Start": f"{start - offset:.3f}", "X-End": f"{end - offset:.3f}"}
+    size = stop - first
+    if not size:
+        raise HTTPException(416, "the span is out of range of the vocal")
+    status = 200
+    span = (0, size - 1)
+    if "range" in request.headers:
+        span = parse_range(request.headers["range"], size) or span
+        if span != (0, size - 1):
+            status = 206
+            headers["Content-Range"] = f"bytes {span[0]}-{span[1]}/{size}"
+    headers |= {"Accept-Ranges": "bytes", "Content-Length": str(span[1] - span[0] + 1)}
+    return StreamingResponse(
+        read(vocal, first + span[0], first + span[1]),
+        status_code=status,
+        headers=headers,
+        media_type="audio/mpeg",
+    )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    uvicorn.run(app, host=utils.config.get("api_host", "127.0.0.1"), port=port)
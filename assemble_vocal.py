@@ -1,23 +1,15 @@
-import os, time, ffmpeg, torchaudio
-from utils import (
-    VOCAL_DIR,
-    TMP_DIR,
-    DEMUCS_DIR,
-    get_duration,
-    msg,
-    valid,
-    get_audio_parts,
-)
+import os, time, ffmpeg, media, lease, journal, metrics, profiling, priority, utils
+from utils import get_duration, msg, valid, get_audio_parts
 
 
 def assemble_vocal(file: str) -> None:
     base_name = file.split("_vocals.wav")[0]
     bare_name = base_name.split("_part_")[0]
-    vocal = os.path.join(VOCAL_DIR, f"{bare_name}.mp3")
+    vocal = os.path.join(utils.VOCAL_DIR, f"{bare_name}.mp3")
     audio_parts = get_audio_parts(bare_name)
     wav_parts = [
         os.path.join(
-            DEMUCS_DIR,
+            utils.DEMUCS_DIR,
             f"{os.path.splitext(os.path.basename(f))[0]}_vocals.wav",
         )
         for f in audio_parts
@@ -27,58 +19,89 @@ def assemble_vocal(file: str) -> None:
         valid(os.path.splitext(os.path.basename(f))[0], "demucs") for f in audio_parts
     ) or valid(base_name, "vocal"):
         return
-    # start assembling
-    msg(
-        "Vocal",
-        "Assembling",
-        file=vocal,
-    )
-    start_time = time.time()
-    # assemble from wav in tmp dir to mp3 in vocal dir
-    TMP_FILE = os.path.join(TMP_DIR, "filelist.txt")
-    with open(TMP_FILE, "w") as f:
-        for wav_part in wav_parts:
-            mp3_part = wav_part[:-4] + ".mp3"
-            wav, sr = torchaudio.load(wav_part)  # type: ignore
-            # note that compression = -a.b, '-' for variable bitrate
-            # a: 1 is max bitrate, 9 is least bitrate
-            # b: 0 is least quality, 5 is best quality
-            torchaudio.save(mp3_part, wav, sr, compression=-1.5)  # type: ignore
-            f.write(f"file '{mp3_part}'\n")
-    time.sleep(1)
-    # concat mp3 parts
-    try:
-        ffmpeg.input(TMP_FILE, format="concat", safe=0).output(
-            vocal, acodec="copy"
-        ).run(overwrite_output=True, quiet=True)
-    except (Exception, KeyboardInterrupt) as e:
+    # claim the job so that other nodes skip it, then check again as it may have been finished meanwhile
+    claim = lease.acquire("vocal", bare_name)
+    if not claim:
+        return
+    if valid(base_name, "vocal"):
+        claim.release()
+        return
+    # imported only when there is work, a scan over finished jobs stays light
+    import torchaudio
+
+    with claim, metrics.span("vocal", bare_name) as record, journal.attempt(
+        "vocal", bare_name
+    ):
+        record["bytes"] = sum(os.path.getsize(f) for f in wav_parts)
+        # start assembling
+        msg(
+            "Vocal",
+            "Assembling",
+            file=vocal,
+        )
+        start_time = time.time()
+        # assemble from wav in tmp dir to mp3 in vocal dir
+        # one list per recording, as other nodes may be assembling at the same time
+        TMP_FILE = os.path.join(utils.TMP_DIR, f"filelist_{bare_name}.txt")
+        with open(TMP_FILE, "w") as f:
+            for wav_part in wav_parts:
+                mp3_part = wav_part[:-4] + ".mp3"
+                wav, sr = torchaudio.load(wav_part)  # type: ignore
+                # note that compression = -a.b, '-' for variable bitrate
+                # a: 1 is max bitrate, 9 is least bitrate
+                # b: 0 is least quality, 5 is best quality
+                torchaudio.save(mp3_part, wav, sr, compression=-1.5)  # type: ignore
+                f.write(f"file '{mp3_part}'\n")
+        time.sleep(1)
+        # concat mp3 parts next to the list, and publish the vocal only if the job is still ours
+        tmp = os.path.join(utils.TMP_DIR, f"{bare_name}.{os.getpid()}.mp3")
         try:
-            os.remove(vocal)
-        except:
-            pass
-        if isinstance(e, Exception):
-            msg(
-                "Vocal",
-                "Assemble Failed",
-                file=vocal,
-                error=True,
+            media.run(
+                "encode",
+                ffmpeg.input(TMP_FILE, format="concat", safe=0)
+                .output(tmp, acodec="copy")
+                .compile(overwrite_output=True),
             )
-        raise
-    end_time = time.time()
-    speed = get_duration(vocal) / (end_time - start_time)
-    msg("Vocal", "Assembled", f"({speed:.0f}X)", file=vocal)
+        except (Exception, KeyboardInterrupt) as e:
+            try:
+                os.remove(tmp)
+            except:
+                pass
+            if isinstance(e, Exception):
+                msg(
+                    "Vocal",
+                    "Assemble Failed",
+                    file=vocal,
+                    error=True,
+                )
+            raise
+        end_time = time.time()
+        record["audio_seconds"] = get_duration(tmp)
+        if not claim.publish(tmp, vocal):
+            return
+        speed = record["audio_seconds"] / (end_time - start_time)
+        msg("Vocal", "Assembled", f"({speed:.0f}X)", file=vocal)
+
+
+def scan() -> None:
+    msg("Vocal", "Scanning")
+    with profiling.profile("vocal", "scan"):
+        files = [
+            os.path.join(utils.DEMUCS_DIR, file)
+            for file in os.listdir(utils.DEMUCS_DIR)
+            if file.endswith("_vocals.wav") and not file.endswith("_no_vocals.wav")
+        ]
+        for file in priority.order("vocal", files):
+            # parts of an assembled recording are removed with it
+            if os.path.exists(file) and not journal.blocked(
+                "vocal", priority.bare_name(file)
+            ):
+                assemble_vocal(os.path.basename(file))
 
 
 if __name__ == "__main__":
     try:
-        msg("Vocal", "Scanning")
-        for file in os.listdir(DEMUCS_DIR):
-            if (
-                os.path.exists(os.path.join(DEMUCS_DIR, file))
-                and file.endswith("_vocals.wav")
-                and not file.endswith("_no_vocals.wav")
-            ):
-                assemble_vocal(file)
+        scan()
     except KeyboardInterrupt:
         msg("Vocal", "Safe to Exit")
     except Exception as e:
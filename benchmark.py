@@ -0,0 +1,340 @@
+"""Offline benchmark of every pipeline stage on synthetic recordings, in a work directory of its own."""
+import os, sys, json, time, random, shutil, argparse, resource, tempfile, subprocess
+import numpy as np
+
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+QUERIES = ["晚上好", "大家", "游戏", "哈哈", "吃饭 了", "wan shang"]
+TEXTS = ["晚上好大家", "今天我们来玩游戏", "哈哈哈哈", "吃饭了吗", "谢谢大家的礼物", "这个好难啊"]
+
+
+def synthesize(video: str, minutes: float, seed: int) -> None:
+    """a recording with tones, noise, silence and speech-like bursts, mp4 or flv by extension"""
+    duration = minutes * 60
+    rng = random.Random(seed)
+    tone = rng.choice([220, 330, 440])
+    burst = rng.uniform(0.8, 1.6)
+    audio = (
+        f"sine=f={tone}:d={duration},volume=0.2[tone];"
+        f"anoisesrc=d={duration}:c=pink:a=0.3,"
+        # speech-like bursts, about 40% on, with a silent gap every minute
+        f"volume='if(lt(mod(t,{burst:.2f}),{burst * 0.4:.2f}),1,0.05)"
+        f"*if(lt(mod(t,60),55),1,0)':eval=frame[speech];"
+        "[tone][speech]amix=inputs=2[a]"
+    )
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"color=c=black:s=64x36:r=5:d={duration}",
+            "-filter_complex",
+            audio,
+            "-map",
+            "0:v",
+            "-map",
+            "[a]",
+            "-c:a",
+            "aac",
+            "-ar",
+            "44100",
+            "-ac",
+            "2",
+            video,
+        ],
+        check=True,
+    )
+
+
+def stub_demucs(argv: list[str]) -> None:
+    """CPU stand-in for the demucs CLI, writes the input as both stems"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--two-stems")
+    parser.add_argument("--shifts")
+    parser.add_argument("-d")
+    parser.add_argument("-o")
+    parser.add_argument("--filename")
+    parser.add_argument("audio", nargs="+")
+    args, _ = parser.parse_known_args(argv)
+    out = os.path.join(args.o, "htdemucs")
+    os.makedirs(out, exist_ok=True)
+    for audio in args.audio:
+        track = os.path.splitext(os.path.basename(audio))[0]
+        for stem in ["vocals", "no_vocals"]:
+            name = args.filename.format(track=track, stem=stem, ext="wav")
+            subprocess.run(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-loglevel",
+                    "error",
+                    "-i",
+                    audio,
+                    "-ar",
+                    "44100",
+                    os.path.join(out, name),
+                ],
+                check=True,
+            )
+
+
+class StubWhisper:
+    """CPU stand-in for a whisper model, one segment every 3 seconds"""
+
+    def transcribe(self, audio: np.ndarray, **kwargs) -> dict:
+        rng = random.Random(len(audio))
+        segments = []
+        for i, start in enumerate(np.arange(0, len(audio) / 16000 - 3, 3.0)):
+            text = rng.choice(TEXTS)
+            segments.append(
+                {
+                    "id": i,
+                    # in 30 s windows like whisper
+                    "seek": int(start // 30 * 3000),
+                    "start": float(start),
+                    "end": float(start) + 2.5,
+                    "text": text,
+                }
+            )
+        return {
+            "text": "".join(s["text"] for s in segments),
+            "segments": segments,
+            "language": "zh",
+        }
+
+
+def run_stage(name: str, jobs: list, func, audio_seconds) -> dict:
+    """run func on every job and collect realtime multiple, peak RSS and latency percentiles"""
+    from utils import msg
+    from profiling import peak_rss, reset_peak
+
+    msg("Bench", "Running", f"{name} x {len(jobs)}")
+    reset_peak()
+    latencies = []
+    audio = 0.0
+    start_time = time.time()
+    for job in jobs:
+        t = time.perf_counter()
+        func(job)
+        latencies.append(time.perf_counter() - t)
+        audio += audio_seconds(job)
+    wall = time.time() - start_time
+    result = {
+        "jobs": len(jobs),
+        "wall_seconds": wall,
+        "audio_seconds": audio,
+        "realtime": audio / wall if wall and audio else None,
+        "peak_rss_mb": peak_rss(),
+        "children_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        / 1024,
+        "latency_ms": {
+            f"p{p}": float(np.percentile(latencies, p)) * 1000 for p in [50, 90, 99]
+        }
+        if latencies
+        else {},
+    }
+    msg("Bench", "Finished", f"{name} {wall:.2f} s")
+    return result
+
+
+def bench(args: argparse.Namespace) -> dict:
+    work = tempfile.mkdtemp(prefix="at-bench-")
+    videos = os.path.join(work, "videos")
+    os.makedirs(videos)
+    with open(os.path.join(work, "config.json"), "w") as f:
+        json.dump(
+            {
+                "video_dir_list": [videos],
+                "out_dir": os.path.join(work, "out"),
+                "part_duration": args.part_duration,
+            },
+            f,
+        )
+    os.makedirs(os.path.join(work, "out"))
+    # the pipeline reads config.json from the working directory
+    os.chdir(work)
+    sys.path.insert(0, REPO)
+    if not args.real:
+        # put the stub demucs on PATH for extract_vocal
+        bin = os.path.join(work, "bin")
+        os.makedirs(bin)
+        with open(os.path.join(bin, "demucs"), "w") as f:
+            f.write(
+                f'#!/bin/sh\nexec {sys.executable} {os.path.abspath(__file__)} stub-demucs "$@"\n'
+            )
+        os.chmod(os.path.join(bin, "demucs"), 0o755)
+        os.environ["PATH"] = bin + os.pathsep + os.environ["PATH"]
+
+    from utils import (
+        AUDIO_DIR,
+        DEMUCS_DIR,
+        VOCAL_DIR,
+        TRANSCRIPT_DIR,
+        get_duration,
+        msg,
+    )
+
+    report = {"params": vars(args), "stages": {}}
+    stages = report["stages"]
+    try:
+        report["commit"] = subprocess.run(
+            ["git", "-C", REPO, "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except FileNotFoundError:
+        pass
+    # synthetic recordings
+    msg("Bench", "Synthesizing", f"{args.count} x {args.minutes} min", file=work)
+    files = [
+        os.path.join(
+            videos, f"{1000 + i % 2}_202401{1 + i:02d}_120000.{['flv', 'mp4'][i % 2]}"
+        )
+        for i in range(args.count)
+    ]
+    for i, video in enumerate(files):
+        synthesize(video, args.minutes, args.seed + i)
+    bare_names = [os.path.splitext(os.path.basename(v))[0] for v in files]
+    duration = {v: get_duration(v) for v in files}
+
+    import extract_audio
+
+    stages["extract_audio"] = run_stage(
+        "extract_audio", files, extract_audio.extract_audio, duration.get
+    )
+
+    import extract_vocal
+
+    parts = sorted(f for f in os.listdir(AUDIO_DIR) if f.endswith(".m4a"))
+    stages["separation"] = run_stage(
+        "separation",
+        parts,
+        lambda f: extract_vocal.extract_vocal(0, f),
+        lambda f: get_duration(os.path.join(AUDIO_DIR, f)),
+    )
+
+    import assemble_vocal
+
+    wavs = [
+        next(
+            f
+            for f in sorted(os.listdir(DEMUCS_DIR))
+            if f.startswith(b) and f.endswith("_vocals.wav")
+        )
+        for b in bare_names
+    ]
+    stages["assemble_vocal"] = run_stage(
+        "assemble_vocal",
+        wavs,
+        assemble_vocal.assemble_vocal,
+        lambda f: duration[files[wavs.index(f)]],
+    )
+
+    import transcribe
+
+    worker = transcribe.Worker(0, {"task": None, "progress": "n/a"})
+    if not args.real:
+        worker.model = StubWhisper()
+    vocals = [os.path.join(VOCAL_DIR, f"{b}.mp3") for b in bare_names]
+    stages["transcribe"] = run_stage(
+        "transcribe",
+        vocals,
+        lambda v: worker.transcribe(
+            transcribe.load_part(v, 0.0, get_duration(v)),
+            os.path.join(TRANSCRIPT_DIR, os.path.basename(v)[:-4] + ".json"),
+        ),
+        get_duration,
+    )
+
+    import launch
+
+    store = {}
+    stages["load_transcript"] = run_stage(
+        "load_transcript",
+        [True],
+        lambda refresh: store.update(store=launch.load_transcript(refresh)[0]),
+        lambda _: sum(duration.values()),
+    )
+    queries = [
+        (q, options, order)
+        for q in QUERIES
+        for options in [[], ["Pinyin"]]
+        for order in ["Chronological", "Relevance"]
+    ] * args.repeat
+    stages["search"] = run_stage(
+        "search",
+        queries,
+        lambda q: store["store"].search("all", 0, 99999999, q[0], q[1], q[2], 6),
+        lambda _: 0,
+    )
+    segments, total = store["store"].search("all", 0, 99999999, "", [])
+    hits = segments.sample(min(args.slices, total), random_state=args.seed)
+    stages["slice_cache"] = run_stage(
+        "slice_cache",
+        list(hits.itertuples()),
+        lambda row: launch.load_slice(row.basename, max(row.start - 2, 0), row.end + 2),
+        lambda row: row.end - row.start + 4,
+    )
+    if not args.keep:
+        os.chdir(REPO)
+        shutil.rmtree(work, ignore_errors=True)
+    else:
+        report["work"] = work
+    return report
+
+
+def compare(old: str, new: str) -> None:
+    """print the change of every stage between two reports"""
+    with open(old) as f:
+        a = json.load(f)
+    with open(new) as f:
+        b = json.load(f)
+    print(f"{'stage':<16} {'realtime':>21} {'peak RSS MB':>21} {'p50 ms':>21}")
+    for stage in b["stages"]:
+        if stage not in a["stages"]:
+            continue
+        x, y = a["stages"][stage], b["stages"][stage]
+        cells = []
+        for get in [
+            lambda r: r["realtime"],
+            lambda r: r["peak_rss_mb"],
+            lambda r: r["latency_ms"].get("p50"),
+        ]:
+            u, v = get(x), get(y)
+            cells.append(f"{u or 0:>9.1f} -> {v or 0:>9.1f}")
+        print(f"{stage:<16} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "stub-demucs":
+        stub_demucs(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description="offline benchmark of the pipeline")
+    parser.add_argument("--count", type=int, default=2, help="number of recordings")
+    parser.add_argument(
+        "--minutes", type=float, default=10, help="length of each recording"
+    )
+    parser.add_argument("--part-duration", type=int, default=300)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="repeat the search queries"
+    )
+    parser.add_argument(
+        "--slices", type=int, default=50, help="number of slices to load"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--real", action="store_true", help="use the real demucs and whisper"
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    parser.add_argument("--out", default="bench.json")
+    args = parser.parse_args()
+    out = os.path.abspath(args.out)
+    report = bench(args)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=4)
+    print(json.dumps(report["stages"], indent=4))
@@ -0,0 +1,297 @@
+"""The searchable transcripts sharded by room, shared by the Gradio UI in launch.py and the HTTP API in api.py."""
+import os, json, pickle, threading, metrics, fingerprint, utils
+import pandas as pd
+from pypinyin import lazy_pinyin
+from store import COLUMNS, ShardedStore, TranscriptStore
+from utils import msg
+
+
+# results per page
+PAGE_SIZE = 6
+EMPTY = pd.DataFrame(columns=COLUMNS)
+# segments in a shard's delta before it's folded into the shard
+DELTA_ROWS = 5000
+# {shard: {"room", "month", "rows", "files", "base"}} of the shards on disk, base being the files not in the delta
+SHARDS: dict[str, dict] = {}
+# {shard: (base files, store, delta files, delta store)} of the shards loaded so far, shared by all pages
+LOADED: dict[str, tuple[dict, TranscriptStore, dict, TranscriptStore]] = {}
+SHARD_LOCKS: dict[str, threading.Lock] = {}
+STORE: ShardedStore | None = None
+LOCK = threading.Lock()
+
+
+def parse_transcript(file: str) -> pd.DataFrame:
+    """the segments of a transcript or part transcript as rows of its recording"""
+    if os.path.dirname(file) == utils.FINGERPRINT_DIR:
+        return parse_duplicate(file)
+    base_name = os.path.splitext(os.path.basename(file))[0].split("_part_")[0]
+    roomid = base_name.split("_")[0]
+    tmp = {k: [] for k in ["roomid", "basename", "start", "end", "text", "pinyin"]}
+    with open(file) as f:
+        for segment in json.load(f)["segments"]:
+            tmp["roomid"].append(roomid)
+            tmp["basename"].append(base_name)
+            tmp["start"].append(segment["start"])
+            tmp["end"].append(segment["end"])
+            tmp["text"].append(segment["text"].lower())
+            tmp["pinyin"].append(" ".join(lazy_pinyin(segment["text"])))
+    return pd.DataFrame(tmp)
+
+
+def parse_duplicate(file: str) -> pd.DataFrame:
+    """the rows of the canonical transcript a duplicate is linked to by its fingerprint meta, shifted to the time of
+    the duplicate and clipped to it"""
+    with open(file) as f:
+        meta = json.load(f)
+    base_name = os.path.splitext(os.path.basename(file))[0]
+    rows = parse_transcript(
+        os.path.join(utils.TRANSCRIPT_DIR, f"{meta['duplicate_of']}.json")
+    )
+    start, end = rows["start"] - meta["offset"], rows["end"] - meta["offset"]
+    inside = (end > 0) & (start < meta["duration"])
+    rows = rows[inside].reset_index(drop=True)
+    rows["roomid"] = base_name.split("_")[0]
+    rows["basename"] = base_name
+    rows["start"] = start[inside].clip(lower=0).to_numpy()
+    rows["end"] = end[inside].clip(upper=meta["duration"]).to_numpy()
+    return rows
+
+
+def transcript_files() -> dict[str, float]:
+    """{file: mtime} of the transcripts, of the part transcripts of recordings still being transcribed and of the
+    fingerprint metas of duplicates whose canonical recording is transcribed, as of the later of meta and transcript
+    """
+    files = {}
+    merged = set()
+    for file in os.listdir(utils.TRANSCRIPT_DIR):
+        if file.endswith(".json"):
+            files[os.path.join(utils.TRANSCRIPT_DIR, file)] = 0
+            merged.add(os.path.splitext(file)[0])
+    for file in os.listdir(utils.TRANSCRIPT_PART_DIR):
+        if file.endswith(".json") and file.split("_part_")[0] not in merged:
+            files[os.path.join(utils.TRANSCRIPT_PART_DIR, file)] = 0
+    canonicals = {}
+    for bare_name, (canonical, _) in fingerprint.duplicates().items():
+        if bare_name not in merged and canonical in merged:
+            canonicals[fingerprint.path(bare_name, "json")] = os.path.join(
+                utils.TRANSCRIPT_DIR, f"{canonical}.json"
+            )
+    for file in list(files) + list(canonicals):
+        try:
+            files[file] = os.path.getmtime(file)
+            if file in canonicals:
+                files[file] = max(files[file], os.path.getmtime(canonicals[file]))
+        except FileNotFoundError:
+            # merged meanwhile
+            files.pop(file, None)
+    return files
+
+
+def vocal(base_name: str) -> tuple[str, float, float]:
+    """(vocal, offset of the recording in it, duration of the recording) to cut the audio of a recording from, the
+    canonical vocal for a duplicate without its own"""
+    own = os.path.join(utils.VOCAL_DIR, f"{base_name}.mp3")
+    meta = None if os.path.exists(own) else fingerprint.load_meta(base_name)
+    if not meta or not meta["duplicate_of"]:
+        return own, 0.0, float("inf")
+    canonical = os.path.join(utils.VOCAL_DIR, f"{meta['duplicate_of']}.mp3")
+    return canonical, meta["offset"], meta["duration"]
+
+
+def by_month() -> bool:
+    """whether shards are split by month besides room, see config shard_by_month"""
+    return utils.config.get("shard_by_month", False)
+
+
+def shard_of(file: str) -> tuple[str, str, int | None]:
+    """(shard, room, month) of a transcript or part transcript"""
+    roomid, date = (os.path.basename(file).split("_") + [""])[:2]
+    if not by_month():
+        return roomid, roomid, None
+    month = int(date[:6]) if date[:6].isdigit() else 0
+    return f"{roomid}_{month}", roomid, month
+
+
+def manifest_file() -> str:
+    return os.path.join(utils.SHARD_DIR, "manifest.json")
+
+
+def legacy_file() -> str:
+    """the cache of the single store before sharding, migrated on the first refresh"""
+    return os.path.join(utils.TMP_DIR, "transcript.pkl")
+
+
+def shard_file(shard: str) -> str:
+    return os.path.join(utils.SHARD_DIR, f"{shard}.pkl")
+
+
+def delta_file(shard: str) -> str:
+    return os.path.join(utils.SHARD_DIR, f"{shard}.delta.pkl")
+
+
+def read_shard(file: str) -> dict[str, tuple[float, pd.DataFrame]]:
+    try:
+        with open(file, "rb") as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def save(file: str, data, binary: bool = True) -> None:
+    """write to a temporary file first, so a reader never sees it half-written"""
+    tmp = f"{file}.{os.getpid()}.tmp"
+    with open(tmp, "wb" if binary else "w") as f:
+        if binary:
+            pickle.dump(data, f)
+        else:
+            json.dump(data, f, indent=4)
+    os.replace(tmp, file)
+
+
+def build_store(cached: dict[str, tuple[float, pd.DataFrame]]) -> TranscriptStore:
+    # parts of a recording in order
+    frames = [cached[file][1] for file in sorted(cached)]
+    return TranscriptStore(pd.concat(frames, ignore_index=True) if frames else EMPTY)
+
+
+def load_shard(shard: str, meta: dict) -> list[TranscriptStore]:
+    """the stores of a shard and of its delta, each loaded from its cache on first use or when its files changed"""
+    # not LOCK, searches go on while a refresh parses transcripts
+    with SHARD_LOCKS.setdefault(shard, threading.Lock()):
+        base_files, store, delta_files, delta = LOADED.get(
+            shard, (None, None, None, None)
+        )
+        # manifests from before the delta have none
+        base = meta.get("base", meta["files"])
+        added = {f: t for f, t in meta["files"].items() if f not in base}
+        if base_files != base:
+            with metrics.span("load_shard", shard):
+                store = build_store(read_shard(shard_file(shard)))
+        if delta_files != added:
+            with metrics.span("load_delta", shard):
+                delta = build_store(read_shard(delta_file(shard)) if added else {})
+        LOADED[shard] = (base, store, added, delta)
+        return [store, delta]
+
+
+def refresh_shards() -> None:
+    """parse the transcripts that are new or changed since the last refresh into their shards"""
+    legacy = {}
+    if os.path.exists(legacy_file()):
+        with open(legacy_file(), "rb") as f:
+            cached = pickle.load(f)
+        # older caches are a single frame without the files it came from
+        if isinstance(cached, dict):
+            legacy = cached
+    grouped: dict[str, dict[str, float]] = {}
+    rooms: dict[str, tuple[str, int | None]] = {}
+    for file, mtime in transcript_files().items():
+        shard, room, month = shard_of(file)
+        grouped.setdefault(shard, {})[file] = mtime
+        rooms[shard] = (room, month)
+    for shard in set(SHARDS) - set(grouped):
+        del SHARDS[shard]
+        LOADED.pop(shard, None)
+        for file in [shard_file(shard), delta_file(shard)]:
+            if os.path.exists(file):
+                os.remove(file)
+    for shard, files in grouped.items():
+        if SHARDS.get(shard, {}).get("files") == files:
+            continue
+        main = read_shard(shard_file(shard))
+        cached = main | read_shard(delta_file(shard))
+        if not cached:
+            cached = {f: legacy[f] for f in files if f in legacy}
+        # merged or deleted
+        removed = set(cached) - set(files)
+        for file in removed:
+            del cached[file]
+        for file, mtime in files.items():
+            if cached.get(file, (None,))[0] != mtime:
+                try:
+                    cached[file] = (mtime, parse_transcript(file))
+                except (FileNotFoundError, json.JSONDecodeError) as e:
+                    msg("Search", "Load Failed", repr(e), file=file, error=True)
+        base = {file: mtime for file, (mtime, _) in main.items()}
+        added = {file: v for file, v in cached.items() if file not in base}
+        if (
+            removed
+            or any(cached[file][0] != mtime for file, mtime in base.items())
+            or sum(len(df) for _, df in added.values()) > DELTA_ROWS
+        ):
+            # fold the delta into the shard
+            save(shard_file(shard), cached)
+            base, added = {file: mtime for file, (mtime, _) in cached.items()}, {}
+        if added:
+            save(delta_file(shard), added)
+        elif os.path.exists(delta_file(shard)):
+            os.remove(delta_file(shard))
+        SHARDS[shard] = {
+            "room": rooms[shard][0],
+            "month": rooms[shard][1],
+            "rows": sum(len(df) for _, df in cached.values()),
+            "files": {file: mtime for file, (mtime, _) in cached.items()},
+            "base": base,
+        }
+    save(manifest_file(), SHARDS, binary=False)
+    if os.path.exists(legacy_file()):
+        os.remove(legacy_file())
+
+
+def load_transcript(refresh: bool = False) -> tuple[ShardedStore, str]:
+    """Build the store from the manifest of the shards, or on refresh parse only the transcripts that are new or
+    changed since the last refresh, so that finished parts show up in search quickly. Shards are loaded by the
+    searches that need them."""
+    global STORE
+    with LOCK:
+        msg("Search", "Loading Transcripts")
+        if not SHARDS:
+            try:
+                with open(manifest_file()) as f:
+                    SHARDS.update(json.load(f))
+            except (FileNotFoundError, json.JSONDecodeError):
+                refresh = True
+        # sharded the other way before "shard_by_month" changed
+        if any((meta["month"] is None) == by_month() for meta in SHARDS.values()):
+            refresh = True
+        if refresh:
+            refresh_shards()
+        STORE = ShardedStore(SHARDS, load_shard)
+        status = f"Loaded {len(STORE)} transcripts"
+        msg("Search", "Loading Transcripts Finished")
+        return STORE, status
+
+
+def outdated() -> bool:
+    """whether transcripts were added, changed or merged since the store was loaded"""
+    files = {f: t for meta in SHARDS.values() for f, t in meta["files"].items()}
+    return files != transcript_files()
+
+
+def search(
+    store: ShardedStore,
+    roomid: str,
+    date_from: int,
+    date_to: int,
+    keyword: str,
+    options: list[str],
+    order: str,
+    page: int = 1,
+    page_size: int = PAGE_SIZE,
+) -> tuple[pd.DataFrame, int, int, int]:
+    """(rows, matches, page, pages) of a page of the search, only the rows up to the page are ordered"""
+    with metrics.span("search", keyword):
+        transcript, total = store.search(
+            roomid,
+            date_from,
+            date_to,
+            keyword,
+            options,
+            order,
+            limit=max(page, 1) * page_size,
+        )
+    metrics.count("search", "results", total)
+    total_page = (total - 1) // page_size + 1
+    page = max(1, min(page, total_page))
+    rows = transcript.iloc[(page - 1) * page_size : page * page_size]
+    return rows.reset_index(drop=True), total, page, total_page
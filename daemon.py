@@ -0,0 +1,156 @@
+"""Run pipeline stages in one long-lived process instead of restarting scripts with keep_running.sh."""
+import time, signal, argparse, threading
+import utils
+from utils import msg
+
+
+# seconds between scans of each stage
+INTERVAL = {
+    "audio": 60,
+    "dedup": 600,
+    "demucs": 10,
+    "vocal": 60,
+    "transcribe": 5,
+    "summary": 60,
+}
+# seconds between walks of the video directories
+RESCAN_DIRS = 600
+# longest wait before restarting a crashed stage
+MAX_BACKOFF = 600
+# child processes to stop on exit
+children = []
+
+
+def audio_stage():
+    import extract_audio
+
+    return extract_audio.scan
+
+
+def demucs_stage():
+    import extract_vocal
+    from multiprocessing import Manager
+
+    # the manager lives as long as the daemon, workers share the last start times through it
+    manager = Manager()
+    extract_vocal.setup(manager)
+    return extract_vocal.scan
+
+
+def dedup_stage():
+    import fingerprint
+
+    # new audio is fingerprinted by extract_audio, this catches up on older recordings
+    return fingerprint.scan
+
+
+def vocal_stage():
+    import assemble_vocal
+
+    return assemble_vocal.scan
+
+
+def transcribe_stage():
+    import transcribe
+    from multiprocessing import Process
+
+    # transcribe.main supervises its own workers, which keep the models loaded
+    process = None
+
+    def supervise() -> None:
+        nonlocal process
+        if process and process.is_alive():
+            return
+        if process:
+            msg("Daemon", "Restarting", f"transcribe, exit code {process.exitcode}")
+            children.remove(process)
+        process = Process(target=transcribe.main)
+        process.start()
+        children.append(process)
+
+    return supervise
+
+
+def summary_stage():
+    import summary, metrics
+    from status import StatusEngine
+
+    engine, exporter = StatusEngine(), metrics.Metrics()
+    return lambda: summary.main(engine, exporter)
+
+
+STAGES = {
+    "audio": audio_stage,
+    "dedup": dedup_stage,
+    "demucs": demucs_stage,
+    "vocal": vocal_stage,
+    "transcribe": transcribe_stage,
+    "summary": summary_stage,
+}
+
+
+class Stage(threading.Thread):
+    """Scans a stage on an interval, setting it up on first use and restarting it after crashes."""
+
+    def __init__(self, name: str, stop: threading.Event) -> None:
+        super().__init__(name=name, daemon=True)
+        self.setup = STAGES[name]
+        self.interval = INTERVAL[name]
+        self.stop = stop
+        self.scan = None
+        self.failures = 0
+
+    def run(self) -> None:
+        while not self.stop.is_set():
+            try:
+                if not self.scan:
+                    msg("Daemon", "Starting", self.name)
+                    self.scan = self.setup()
+                self.scan()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                msg(
+                    "Daemon",
+                    "Crashed",
+                    f"{self.name} {e!r}, restart #{self.failures}",
+                    error=True,
+                )
+            # back off exponentially while crashing
+            self.stop.wait(min(self.interval * 2**self.failures, MAX_BACKOFF))
+
+
+def main(names: list[str]) -> None:
+    utils.require_config()
+    stop = threading.Event()
+    reload = threading.Event()
+    signal.signal(signal.SIGHUP, lambda *_: reload.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    stages = [Stage(name, stop) for name in names]
+    for stage in stages:
+        stage.start()
+    walked = time.time()
+    try:
+        while not stop.wait(1):
+            if reload.is_set() or time.time() - walked > RESCAN_DIRS:
+                msg("Daemon", "Reloading", "config.json" if reload.is_set() else "")
+                reload.clear()
+                walked = time.time()
+                try:
+                    utils.reload_config()
+                except Exception as e:
+                    # keep running with the old config
+                    msg("Daemon", "Reload Failed", repr(e), error=True)
+    except KeyboardInterrupt:
+        stop.set()
+    for process in children:
+        process.terminate()
+    msg("Daemon", "Safe to Exit")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run pipeline stages as a daemon")
+    parser.add_argument(
+        "stages", nargs="*", choices=list(STAGES), default=["audio", "demucs", "vocal"]
+    )
+    main(parser.parse_args().stages)
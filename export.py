@@ -0,0 +1,180 @@
+"""Export the matches of a search as clips to FAVORITE_DIR, with a manifest and optionally as a zip archive."""
+import os, re, json, time, zipfile, argparse, itertools, mp3index, corpus, utils
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+from store import ShardedStore
+from utils import msg
+
+
+# recordings cut at the same time
+WORKERS = 4
+# numbers the exports of this process
+EXPORTS = itertools.count(1)
+UNSAFE = re.compile(r'[\\/:*?"<>|\s]+')
+
+
+def max_clips() -> int:
+    """most clips per export"""
+    return utils.config.get("export_limit", 2000)
+
+
+def parse_rows(rows: str, limit: int | None = None) -> list[int]:
+    """the first `limit` 1-based result numbers from e.g. "1-20, 35", empty for all"""
+    limit = limit or max_clips()
+    numbers = set()
+    for item in filter(None, re.split(r"[,\s]+", rows.strip())):
+        first, _, last = item.partition("-")
+        first = max(int(first), 1)
+        # no more than the limit of any range, however large it's written
+        last = min(int(last or first), first + limit - 1)
+        numbers.update(range(first, last + 1))
+    return sorted(numbers)[:limit]
+
+
+def safe(text: str, length: int = 40) -> str:
+    return UNSAFE.sub("_", text)[:length]
+
+
+def cut(base_name: str, clips: list[dict], dir: str) -> list[dict]:
+    """cut the clips of one recording, returns those that failed with the reason"""
+    vocal, offset, _ = corpus.vocal(base_name)
+    failed = []
+    for clip in clips:
+        try:
+            mp3index.extract(
+                vocal,
+                offset + clip["start"],
+                offset + clip["end"],
+                os.path.join(dir, clip["file"]),
+            )
+        except (FileNotFoundError, ValueError) as e:
+            failed.append(clip | {"error": repr(e)})
+    return failed
+
+
+def export(
+    store: ShardedStore,
+    roomid: str,
+    date_from: int,
+    date_to: int,
+    keyword: str,
+    options: list[str],
+    order: str,
+    margin: float = 2,
+    rows: str = "",
+    archive: bool = False,
+    progress: Callable[[int, int], None] | None = None,
+) -> tuple[str, dict]:
+    """cut the matches of a search, or rows like "1-20, 35" of it, to a new directory or zip, with a manifest"""
+    selected = parse_rows(rows)
+    transcript, total = store.search(
+        roomid,
+        date_from,
+        date_to,
+        keyword,
+        options,
+        order,
+        limit=selected[-1] if selected else max_clips(),
+    )
+    if selected:
+        numbers = [n for n in selected if n <= len(transcript)]
+    else:
+        numbers = list(range(1, len(transcript) + 1))
+    # the pid and a counter keep exports of the same second apart
+    name = f"export_{safe(keyword, 20) or 'all'}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{next(EXPORTS)}"
+    dir = os.path.join(utils.FAVORITE_DIR, name)
+    os.makedirs(dir)
+    # {base_name: [clip]}
+    recordings: dict[str, list[dict]] = {}
+    for n in numbers:
+        row = transcript.iloc[n - 1]
+        start, end = max(float(row["start"]) - margin, 0), float(row["end"]) + margin
+        clip = {
+            "number": n,
+            "file": f"{n:04d}_{row['basename']}_{start:.0f}_{end:.0f}_{safe(row['text'])}.mp3",
+            "basename": row["basename"],
+            "roomid": str(row["roomid"]),
+            "date": int(row["date"]),
+            "start": start,
+            "end": end,
+            "text": row["text"],
+        }
+        recordings.setdefault(row["basename"], []).append(clip)
+    msg("Export", "Exporting", f"{len(numbers)} of {total} matches", file=dir)
+    failed: list[dict] = []
+    done = 0
+    with ThreadPoolExecutor(WORKERS) as pool:
+        jobs = {
+            pool.submit(cut, base_name, clips, dir): clips
+            for base_name, clips in recordings.items()
+        }
+        for job in as_completed(jobs):
+            failed += job.result()
+            done += len(jobs[job])
+            if progress:
+                progress(done, len(numbers))
+    numbers_failed = {clip["number"] for clip in failed}
+    manifest = {
+        "query": {
+            "roomid": roomid,
+            "date_from": date_from,
+            "date_to": date_to,
+            "keyword": keyword,
+            "options": options,
+            "order": order,
+            "margin": margin,
+            "rows": rows,
+        },
+        "total": total,
+        "clips": [
+            clip
+            for clips in recordings.values()
+            for clip in clips
+            if clip["number"] not in numbers_failed
+        ],
+        "failed": failed,
+    }
+    manifest["clips"].sort(key=lambda clip: clip["number"])
+    with open(os.path.join(dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    msg(
+        "Export",
+        "Exported",
+        f"{len(manifest['clips'])} clips, {len(failed)} failed",
+        file=dir,
+    )
+    if archive:
+        # mp3 doesn't compress any further, so the clips are stored as they are
+        with zipfile.ZipFile(f"{dir}.zip", "w", zipfile.ZIP_STORED) as zip:
+            for file in sorted(os.listdir(dir)):
+                zip.write(os.path.join(dir, file), os.path.join(name, file))
+        dir = f"{dir}.zip"
+    return dir, manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export the matches of a search")
+    parser.add_argument("keyword")
+    parser.add_argument("--roomid", default="all")
+    parser.add_argument("--date-from", type=int, default=20220101)
+    parser.add_argument("--date-to", type=int, default=20770101)
+    parser.add_argument("--options", nargs="*", default=[])
+    parser.add_argument("--order", default="Chronological")
+    parser.add_argument("--margin", type=float, default=2)
+    parser.add_argument("--rows", default="")
+    parser.add_argument("--zip", action="store_true")
+    args = parser.parse_args()
+    store, _ = corpus.load_transcript()
+    export(
+        store,
+        args.roomid,
+        args.date_from,
+        args.date_to,
+        args.keyword,
+        args.options,
+        args.order,
+        args.margin,
+        args.rows,
+        args.zip,
+        lambda done, total: msg("Export", "Progress", f"{done}/{total}", end="\r"),
+    )
@@ -1,21 +1,15 @@
-import os, time, ffmpeg
-from utils import (
-    VIDEO_DIR_LIST,
-    TMP_DIR,
-    get_duration,
-    msg,
-    valid,
-    get_audio_parts,
-)
+import os, time, ffmpeg, media, lease, journal, metrics, profiling, priority
+import fingerprint, utils
+from utils import get_duration, msg, valid, get_audio_parts
 
 
 def extract_audio(video: str) -> None:
     base_name = os.path.splitext(os.path.basename(video))[0]
     bare_name = base_name
-    cache_audio = os.path.join(TMP_DIR, f"{bare_name}.m4a")
-    # skip if video is not valid (prerequisite)
+    cache_audio = os.path.join(utils.TMP_DIR, f"{bare_name}.m4a")
+    # skip if video is not valid (prerequisite), the parts are planned here on first use
     try:
-        audio_parts = get_audio_parts(bare_name)
+        audio_parts = get_audio_parts(bare_name, plan=True)
     except Exception as e:
         msg("Audio", "get_audio_parts()", repr(e), file=video, error=True)
         return
@@ -24,86 +18,150 @@ def extract_audio(video: str) -> None:
         valid(os.path.splitext(os.path.basename(f))[0], "audio") for f in audio_parts
     ):
         return
-    # extract cache
-    try:
-        msg("Audio", "Caching", file=cache_audio)
-        start_time = time.time()
-        ffmpeg.input(video).audio.output(cache_audio, acodec="copy").run(
-            overwrite_output=True, quiet=True
-        )
-    except (Exception, KeyboardInterrupt) as e:
+    # claim the job so that other nodes skip it, then check again as it may have been finished meanwhile
+    claim = lease.acquire("audio", bare_name)
+    if not claim:
+        return
+    if all(
+        valid(os.path.splitext(os.path.basename(f))[0], "audio") for f in audio_parts
+    ):
+        claim.release()
+        return
+    with claim, metrics.span("audio", bare_name) as record, journal.attempt(
+        "audio", bare_name
+    ):
+        record["audio_seconds"] = sum(audio_parts.values())
+        record["bytes"] = os.path.getsize(video)
+        # extract cache
         try:
-            os.remove(cache_audio)
-        except:
-            pass
-        if isinstance(e, Exception):
-            msg(
-                "Audio",
-                "Cache Failed",
-                file=cache_audio,
-                error=True,
-            )
-        raise
-    else:
-        end_time = time.time()
-        speed = get_duration(cache_audio) / (end_time - start_time)
-        msg("Audio", "Cached", f"({speed:.0f}X)", file=cache_audio)
-    # extract audio
-    if len(audio_parts) > 1:
-        ss = 0
-        for audio in audio_parts:
+            msg("Audio", "Caching", file=cache_audio)
             start_time = time.time()
+            media.run(
+                "extract",
+                ffmpeg.input(video)
+                .audio.output(cache_audio, acodec="copy")
+                .compile(overwrite_output=True),
+            )
+        except (Exception, KeyboardInterrupt) as e:
             try:
-                ffmpeg.input(cache_audio).output(
-                    audio,
-                    ss=ss,
-                    to=ss + audio_parts[audio],
-                    acodec="copy",
-                ).run(overwrite_output=True, quiet=True)
-            except (Exception, KeyboardInterrupt) as e:
+                os.remove(cache_audio)
+            except:
+                pass
+            if isinstance(e, Exception):
+                msg(
+                    "Audio",
+                    "Cache Failed",
+                    file=cache_audio,
+                    error=True,
+                )
+            raise
+        else:
+            end_time = time.time()
+            speed = get_duration(cache_audio) / (end_time - start_time)
+            msg("Audio", "Cached", f"({speed:.0f}X)", file=cache_audio)
+        # extract audio
+        if len(audio_parts) > 1:
+            ss = 0
+            # {part: audio}, extracted next to the cache and published once all are done
+            parts = {}
+            for audio in audio_parts:
+                part = os.path.join(
+                    utils.TMP_DIR, f"{os.getpid()}_{os.path.basename(audio)}"
+                )
+                start_time = time.time()
                 try:
-                    os.remove(audio)
-                except:
-                    pass
-                if isinstance(e, Exception):
-                    msg(
-                        "Audio",
-                        "Extract Failed",
-                        file=audio,
-                        error=True,
+                    media.run(
+                        "extract",
+                        ffmpeg.input(cache_audio)
+                        .output(
+                            part,
+                            ss=ss,
+                            to=ss + audio_parts[audio],
+                            acodec="copy",
+                        )
+                        .compile(overwrite_output=True),
                     )
+                except (Exception, KeyboardInterrupt) as e:
+                    for f in [part, *parts]:
+                        try:
+                            os.remove(f)
+                        except:
+                            pass
+                    if isinstance(e, Exception):
+                        msg(
+                            "Audio",
+                            "Extract Failed",
+                            file=audio,
+                            error=True,
+                        )
+                    raise
+                parts[part] = audio
+                ss += audio_parts[audio]
+                end_time = time.time()
+                speed = get_duration(part) / (end_time - start_time)
+                msg(
+                    "Audio",
+                    "Extracted",
+                    f"({speed:.0f}X)",
+                    file=audio,
+                )
+            # a lost lease drops the rest too
+            if not all([claim.publish(part, audio) for part, audio in parts.items()]):
+                return
+        else:
+            audio = list(audio_parts.keys())[0]
+            try:
+                if not claim.publish(cache_audio, audio):
+                    return
+            except Exception:
+                msg(
+                    "Audio",
+                    "Extract Failed",
+                    file=audio,
+                    error=True,
+                )
                 raise
-            ss += audio_parts[audio]
-            end_time = time.time()
-            speed = get_duration(audio) / (end_time - start_time)
-            msg(
-                "Audio",
-                "Extracted",
-                f"({speed:.0f}X)",
-                file=audio,
-            )
-    else:
-        audio = list(audio_parts.keys())[0]
+            msg("Audio", "Extracted", file=audio)
+        # fingerprint the new audio, duplicates of other recordings are skipped by the later stages
         try:
-            os.rename(cache_audio, audio)
-        except Exception:
-            msg(
-                "Audio",
-                "Extract Failed",
-                file=audio,
-                error=True,
-            )
-            raise
-        msg("Audio", "Extracted", file=audio)
+            fingerprint.dedup(bare_name, list(audio_parts))
+        except Exception as e:
+            msg("Audio", "Dedup Failed", repr(e), file=video, error=True)
+
+
+def queued(video: str) -> bool:
+    """whether the video still needs its audio extracted, or fails to, so that it's reported"""
+    try:
+        audio_parts = get_audio_parts(os.path.splitext(os.path.basename(video))[0])
+    except Exception:
+        # not planned yet, or broken
+        return True
+    return not all(
+        valid(os.path.splitext(os.path.basename(f))[0], "audio") for f in audio_parts
+    )
+
+
+def scan() -> None:
+    msg("Audio", "Scanning")
+    with profiling.profile("audio", "scan"):
+        videos = [
+            os.path.join(dir, file)
+            for dir in utils.VIDEO_DIR_LIST
+            for file in os.listdir(dir)
+            if file.endswith(".mp4") or file.endswith(".flv")
+        ]
+        videos = [
+            video
+            for video in videos
+            if queued(video) and not journal.blocked("audio", priority.bare_name(video))
+        ]
+        for video in priority.order("audio", videos):
+            extract_audio(video)
 
 
 if __name__ == "__main__":
     try:
-        msg("Audio", "Scanning")
-        for dir in VIDEO_DIR_LIST:
-            for file in os.listdir(dir):
-                if file.endswith(".mp4") or file.endswith(".flv"):
-                    extract_audio(os.path.join(dir, file))
+        scan()
     except KeyboardInterrupt:
         msg("Audio", "Safe to Exit")
     except Exception as e:
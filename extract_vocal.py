@@ -1,15 +1,26 @@
-import os, time, subprocess, torch
+import os, sys, json, time, wave, shutil, ffmpeg, subprocess
+import media, lease, journal, metrics, priority, fingerprint, utils
+import numpy as np
 from multiprocessing import Process, Manager
-from utils import (
-    AUDIO_DIR,
-    TMP_DIR,
-    DEMUCS_DIR,
-    EXCLUDELIST,
-    get_duration,
-    msg,
-    valid,
-    get_audio_parts,
-)
+from utils import get_duration, msg, valid, get_audio_parts
+
+
+# worker slots, see setup()
+processes: list[Process | None] = []
+last_run: list[float] = []
+# seconds per window whose difficulty is estimated
+WINDOW = 10
+# mean square of full scale below which a window is silence
+SILENCE = 1e-6
+# seconds of context around hard spans, crossfaded into the single-shift vocals
+MARGIN = 1.0
+
+
+def num_gpu() -> int:
+    # torch is slow to import, so only on first use
+    import torch
+
+    return torch.cuda.device_count()
 
 
 def skip(file: str) -> bool:
@@ -17,53 +28,202 @@ def skip(file: str) -> bool:
     base_name = os.path.splitext(file)[0]
     # skip if in exclude list
     try:
-        with open(EXCLUDELIST) as f:
+        with open(utils.EXCLUDELIST) as f:
             exclude_list = f.read().splitlines()
         if file in exclude_list:
             return True
     except FileNotFoundError:
         pass
+    # skip duplicates of other recordings, they are linked to the canonical transcript
+    if fingerprint.duplicate_of(base_name.split("_part_")[0]):
+        return True
     # skip if audio is not valid (prerequisite) or either valid vocal or wav already exists (job)
     if not valid(base_name, "audio") or valid(base_name, "vocal") or valid(base_name, "demucs"):
         return True
+    # skip if another node is working on it
+    if lease.held("demucs", base_name):
+        return True
+    # skip if it keeps failing
+    if journal.blocked("demucs", base_name):
+        return True
     return False
 
 
-def extract_vocal(id: int, file: str) -> None:
+def separate(audios: list[str], out: str, shifts: int, device: str) -> None:
+    """run Demucs on the audio files in one go, to {out}/htdemucs/{track}_{stem}.wav"""
+    output = subprocess.run(
+        [
+            "demucs",
+            "--two-stems",
+            "vocals",
+            "--shifts",
+            str(shifts),
+            "-o",
+            out,
+            "--filename",
+            "{track}_{stem}.{ext}",
+            "-d",
+            device,
+            *audios,
+        ],
+        capture_output=True,
+    )
+    if output.returncode != 0:
+        raise Exception((output.stdout + output.stderr).decode())
+
+
+def read_frames(f: wave.Wave_read, n: int) -> np.ndarray:
+    """up to n frames of a 16 bit wav as float (frames, channels)"""
+    data = np.frombuffer(f.readframes(n), dtype=np.int16)
+    return data.reshape(-1, f.getnchannels()).astype(np.float32)
+
+
+def write_frames(f: wave.Wave_write, data: np.ndarray) -> None:
+    f.writeframes(np.clip(np.round(data), -32768, 32767).astype(np.int16).tobytes())
+
+
+def difficulty(vocals: str, no_vocals: str) -> list[float]:
+    """Per WINDOW seconds, the share of the energy in the quieter stem, 0 for silence. Where speech is alone, or music
+    is, one stem is near silent and a single shift separates it well, where both are loud it bleeds."""
+    result = []
+    with wave.open(vocals) as v, wave.open(no_vocals) as a:
+        n = v.getframerate() * WINDOW
+        while True:
+            x, y = read_frames(v, n), read_frames(a, n)
+            if not len(x):
+                break
+            ex, ey = np.mean((x / 32768) ** 2), np.mean((y[: len(x)] / 32768) ** 2) if len(y) else 0.0
+            result.append(0.0 if ex + ey < SILENCE else float(min(ex, ey) / (ex + ey)))
+    return result
+
+
+def settings() -> dict:
+    """The demucs config: in mode "full" everything is separated with shifts, in "adaptive" with a single shift first and
+    shifts only where it's hard. A window is hard if its quieter stem has more than the hard share of the energy, i.e.
+    vocals over music within about 10 dB."""
+    return {
+        "mode": utils.config.get("demucs_mode", "full"),
+        "shifts": utils.config.get("demucs_shifts", 2),
+        "hard": utils.config.get("demucs_hard", 0.1),
+    }
+
+
+def hard_spans(scores: list[float], duration: float) -> list[tuple[float, float]]:
+    """(start, end) seconds of the runs of hard windows, with MARGIN around them and merged where they meet"""
+    spans: list[tuple[float, float]] = []
+    hard = settings()["hard"]
+    for i, score in enumerate(scores):
+        if score <= hard:
+            continue
+        start, end = max(i * WINDOW - MARGIN, 0), min((i + 1) * WINDOW + MARGIN, duration)
+        if spans and start <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+    return spans
+
+
+def splice(vocals: str, spans: list[tuple[float, float]], clips: list[str], out: str) -> None:
+    """the vocals with the spans replaced by the clips, crossfading over MARGIN where a span doesn't touch the ends"""
+    with wave.open(vocals) as src, wave.open(out, "wb") as dst:
+        dst.setparams(src.getparams())
+        rate, total = src.getframerate(), src.getnframes()
+        chunk, fade = rate * WINDOW, max(round(rate * MARGIN), 1)
+        position = 0
+        for (start, end), clip in zip(spans, clips):
+            first, last = round(start * rate), min(round(end * rate), total)
+            while position < first:
+                dst.writeframes(src.readframes(min(chunk, first - position)))
+                position = min(position + chunk, first)
+            with wave.open(clip) as c:
+                while position < last:
+                    data = read_frames(src, min(chunk, last - position))
+                    if not len(data):
+                        break
+                    shifted = read_frames(c, len(data))
+                    i = np.arange(position, position + len(data))
+                    weight = np.ones(len(data), dtype=np.float32)
+                    if first > 0:
+                        weight = np.minimum(weight, (i - first) / fade)
+                    if last < total:
+                        weight = np.minimum(weight, (last - i) / fade)
+                    weight = weight[: len(shifted), None]
+                    data[: len(shifted)] = data[: len(shifted)] * (1 - weight) + shifted * weight
+                    write_frames(dst, data)
+                    position += len(data)
+        while data := src.readframes(chunk):
+            dst.writeframes(data)
+
+
+def adaptive(audio: str, out: str, device: str, shifts: int | None = None) -> dict:
+    """separate with a single shift, then with shifts on the hard windows only, returns the scores and spans"""
+    track = os.path.splitext(os.path.basename(audio))[0]
+    work = os.path.join(utils.SEPARATION_DIR, f"{track}.{os.getpid()}")
+    single = os.path.join(work, "htdemucs")
+    os.makedirs(out, exist_ok=True)
+    try:
+        separate([audio], work, 1, device)
+        vocals, no_vocals = (os.path.join(single, f"{track}_{stem}.wav") for stem in ["vocals", "no_vocals"])
+        with wave.open(vocals) as f:
+            rate, channels, duration = f.getframerate(), f.getnchannels(), f.getnframes() / f.getframerate()
+        scores = difficulty(vocals, no_vocals)
+        spans = hard_spans(scores, duration)
+        clips = []
+        for i, (start, end) in enumerate(spans):
+            clip = os.path.join(work, f"{track}_span_{i:03d}.wav")
+            # seek in the output so that the clip lines up with the decoded audio to the sample
+            stream = ffmpeg.input(audio).output(clip, ss=start, t=end - start, ar=rate, ac=channels)
+            media.run("extract", stream.compile(overwrite_output=True))
+            clips.append(clip)
+        if clips:
+            separate(clips, work, settings()["shifts"] if shifts is None else shifts, device)
+        stem = os.path.join(out, "htdemucs", f"{track}_vocals.wav")
+        os.makedirs(os.path.dirname(stem), exist_ok=True)
+        # write next to the target and move it there in one go, the transcriber picks up any valid wav
+        splice(
+            vocals,
+            spans,
+            [os.path.join(single, f"{os.path.splitext(os.path.basename(c))[0]}_vocals.wav") for c in clips],
+            f"{stem}.tmp",
+        )
+        os.replace(f"{stem}.tmp", stem)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return {
+        "duration": duration,
+        "hard_seconds": sum(end - start for start, end in spans),
+        "scores": scores,
+        "spans": spans,
+    }
+
+
+def extract_vocal(id: int, file: str, claim: lease.Lease | None = None) -> float:
     base_name = os.path.splitext(file)[0]
-    audio = os.path.join(AUDIO_DIR, file)
-    wav = os.path.join(DEMUCS_DIR, f"{base_name}_vocals.wav")
-    wav_no_vocal = os.path.join(DEMUCS_DIR, f"{base_name}_no_vocals.wav")
-    # extract vocal wav to tmp
+    audio = os.path.join(utils.AUDIO_DIR, file)
+    wav = os.path.join(utils.DEMUCS_DIR, f"{base_name}_vocals.wav")
+    # separate in a work dir of this process, only the vocals are moved into place, through the claim if given
+    out = os.path.join(utils.SEPARATION_DIR, f"{base_name}.{os.getpid()}.out")
+    separated = os.path.join(out, "htdemucs", f"{base_name}_vocals.wav")
     msg(f"Worker{id}", "Extracting", file=audio)
     audio_duration = get_duration(audio)
     start_time = time.time()
+    hard = ""
     try:
-        output = subprocess.run(
-            [
-                "demucs",
-                "--two-stems",
-                "vocals",
-                "--shifts",
-                "2",
-                "-o",
-                TMP_DIR,
-                "--filename",
-                "{track}_{stem}.{ext}",
-                "-d",
-                f"cuda:{torch.cuda.device_count() - 1 - id}",
-                audio,
-            ],
-            capture_output=True,
-        )
-        if output.returncode != 0:
-            raise Exception((output.stdout + output.stderr).decode())
+        device = f"cuda:{num_gpu() - 1 - id}"
+        demucs = settings()
+        if demucs["mode"] == "adaptive":
+            stats = adaptive(audio, out, device)
+            metrics.count("demucs", "hard_seconds", stats["hard_seconds"])
+            hard = f", {stats['hard_seconds'] / max(stats['duration'], 1):.0%} hard"
+        else:
+            separate([audio], out, demucs["shifts"], device)
+        speed = get_duration(separated) / (time.time() - start_time)
+        if claim:
+            if not claim.publish(separated, wav):
+                return audio_duration
+        else:
+            os.replace(separated, wav)
     except (Exception, KeyboardInterrupt) as e:
-        for f in [wav, wav_no_vocal]:
-            try:
-                os.remove(f)
-            except:
-                pass
         if isinstance(e, Exception):
             msg(
                 f"Worker{id}",
@@ -71,35 +231,39 @@ def extract_vocal(id: int, file: str) -> None:
                 file=audio,
                 error=True,
             )
-            # problem might be because there's no speech in the audio, exclude the audio if duration is small
-            if audio_duration < 300:
-                with open(EXCLUDELIST, "a") as f:
-                    f.write(f"{file}\n")
-                msg(f"Worker{id}", "Excluded", file=audio, error=True)
         raise
     else:
-        end_time = time.time()
-        speed = get_duration(wav) / (end_time - start_time)
         msg(
             f"Worker{id}",
             "Extracted",
-            f"({speed:.0f}X)",
+            f"({speed:.0f}X{hard})",
             file=audio,
         )
     finally:
-        try:
-            os.remove(wav_no_vocal)
-        except:
-            pass
+        shutil.rmtree(out, ignore_errors=True)
+    return audio_duration
 
 
-def work(id: int, last_run: list[float], file: str) -> None:
+def work(id: int, last_run: list[float], file: str, queued: float) -> None:
+    base_name = os.path.splitext(file)[0]
+    # claim the job so that other nodes skip it, then check again as it may have been finished meanwhile
+    claim = lease.acquire("demucs", base_name)
+    if not claim:
+        return
+    if valid(base_name, "vocal") or valid(base_name, "demucs"):
+        claim.release()
+        return
     try:
         while time.time() - max(last_run) < 0:
             msg(f"Worker{id}", "Waiting", file=file, end="\r")
             time.sleep(1)
         last_run[id] = time.time()
-        extract_vocal(id, file)
+        device = f"cuda:{num_gpu() - 1 - id}"
+        with metrics.span("demucs", file, device, queued) as record, journal.attempt("demucs", base_name) as attempt:
+            # problem might be because there's no speech in the audio, quarantine the audio if duration is small
+            attempt["quarantine"] = get_duration(os.path.join(utils.AUDIO_DIR, file)) < 300
+            record["bytes"] = os.path.getsize(os.path.join(utils.AUDIO_DIR, file))
+            record["audio_seconds"] = extract_vocal(id, file, claim)
     except KeyboardInterrupt:
         msg(f"Worker{id}", "Safe to Exit")
     except Exception as e:
@@ -110,42 +274,115 @@ def work(id: int, last_run: list[float], file: str) -> None:
             raise
     finally:
         last_run[id] = 0
+        claim.release()
 
 
 def run(file: str) -> None:
+    queued = time.time()
     while True:
         for i, p in enumerate(processes):
             if not p or not p.is_alive():
-                worker = Process(target=work, args=(i, last_run, file))
+                worker = Process(target=work, args=(i, last_run, file, queued))
                 worker.start()
                 processes[i] = worker
                 return
         time.sleep(0.01)
 
 
-if __name__ == "__main__":
+def setup(manager) -> None:
+    """one worker slot per GPU, sharing the last start times through the manager"""
+    global processes, last_run
+    processes = [None] * num_gpu()
+    last_run = manager.list([0] * len(processes))
+
+
+def scan() -> None:
     msg("Demucs", "Scanning")
-    NUM_PROC = torch.cuda.device_count()
-    processes: list[Process | None] = [None] * NUM_PROC
-    with Manager() as manager:
-        last_run = manager.list([0] * NUM_PROC)
-        check_tmp = True
-        for file in os.listdir(AUDIO_DIR):
-            # finish those in the tmp dir first
-            if check_tmp:
-                bare_names = set()
-                for tmp_file in os.listdir(DEMUCS_DIR):
-                    if tmp_file.endswith("_vocals.wav") and not tmp_file.endswith("_no_vocals.wav"):
-                        bare_name = os.path.basename(tmp_file).split("_vocals.wav")[0].split("_part_")[0]
-                        bare_names.add(bare_name)
-                for bare_name in bare_names:
-                    audio_parts = get_audio_parts(bare_name)
-                    for f in audio_parts:
-                        if not skip(os.path.basename(f)):
-                            run(os.path.basename(f))
-                check_tmp = False
-            # then those in the audio dir
-            if file.endswith(".m4a"):
-                if not skip(file):
-                    run(file)
-                    check_tmp = True
+    check_tmp = True
+    files = [file for file in os.listdir(utils.AUDIO_DIR) if file.endswith(".m4a") and not skip(file)]
+    for file in priority.order("demucs", [os.path.join(utils.AUDIO_DIR, file) for file in files]):
+        file = os.path.basename(file)
+        # finish those in the tmp dir first
+        if check_tmp:
+            bare_names = set()
+            for tmp_file in os.listdir(utils.DEMUCS_DIR):
+                if tmp_file.endswith("_vocals.wav") and not tmp_file.endswith("_no_vocals.wav"):
+                    bare_name = os.path.basename(tmp_file).split("_vocals.wav")[0].split("_part_")[0]
+                    bare_names.add(bare_name)
+            for bare_name in bare_names:
+                audio_parts = get_audio_parts(bare_name)
+                for f in audio_parts:
+                    if not skip(os.path.basename(f)):
+                        run(os.path.basename(f))
+            check_tmp = False
+        # then those in the audio dir by priority, checking again as a job may have been done meanwhile
+        if not skip(file):
+            run(file)
+            check_tmp = True
+
+
+def snr(reference: str, estimate: str, windows: list[bool]) -> tuple[float, float]:
+    """dB of the reference over the difference of the estimate, over the windows marked True and the rest"""
+    power = np.zeros((2, 2))
+    with wave.open(reference) as r, wave.open(estimate) as e:
+        n = r.getframerate() * WINDOW
+        for marked in windows:
+            x, y = read_frames(r, n), read_frames(e, n)
+            m = min(len(x), len(y))
+            power[int(marked)] += [np.sum(x[:m] ** 2), np.sum((x[:m] - y[:m]) ** 2)]
+    return tuple(float(10 * np.log10(max(p, 1e-9) / max(d, 1e-9))) for p, d in power[::-1])  # type: ignore
+
+
+def report(audios: list[str]) -> list[dict]:
+    """Separate the audio files adaptively and with the configured shifts everywhere, comparing speed and the adaptive vocals to the
+    full-shift ones, which are the reference. Written to SEPARATION_DIR/report.json."""
+    device = f"cuda:{num_gpu() - 1}" if num_gpu() else "cpu"
+    demucs = settings()
+    result = []
+    for audio in audios:
+        track = os.path.splitext(os.path.basename(audio))[0]
+        work = os.path.join(utils.SEPARATION_DIR, f"report.{os.getpid()}")
+        try:
+            start_time = time.time()
+            separate([audio], os.path.join(work, "full"), demucs["shifts"], device)
+            full_time = time.time() - start_time
+            start_time = time.time()
+            stats = adaptive(audio, os.path.join(work, "adaptive"), device)
+            adaptive_time = time.time() - start_time
+            hard, easy = snr(
+                os.path.join(work, "full", "htdemucs", f"{track}_vocals.wav"),
+                os.path.join(work, "adaptive", "htdemucs", f"{track}_vocals.wav"),
+                [score > demucs["hard"] for score in stats["scores"]],
+            )
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        item = {
+            "audio": audio,
+            "duration": stats["duration"],
+            "hard_share": stats["hard_seconds"] / max(stats["duration"], 1),
+            "full_seconds": full_time,
+            "adaptive_seconds": adaptive_time,
+            "speedup": full_time / adaptive_time,
+            "snr_hard": hard,
+            "snr_easy": easy,
+        }
+        msg(
+            "Demucs",
+            "Report",
+            f"{item['hard_share']:.0%} hard, {item['speedup']:.2f}X faster, "
+            f"SNR to full shifts {easy:.1f} dB easy / {hard:.1f} dB hard",
+            file=audio,
+        )
+        result.append(item)
+    with open(os.path.join(utils.SEPARATION_DIR, "report.json"), "w") as f:
+        json.dump(result, f, indent=4)
+    return result
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["report"]:
+        report(sys.argv[2:])
+    else:
+        with Manager() as manager:
+            setup(manager)
+            scan()
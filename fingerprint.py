@@ -0,0 +1,318 @@
+"""Audio fingerprints to find recordings that are copies, re-muxes or parts of another recording."""
+import os, json, ffmpeg, media, threading, utils
+import numpy as np
+from utils import NotPlanned, msg, valid, get_audio_parts
+
+
+SAMPLE_RATE = 5512
+# 0.37 s frames every 0.1 s
+FRAME = 2048
+HOP = 551
+# 5 log-spaced bands give 4 spectral bits, the other 12 bits are loudness
+BANDS = np.geomspace(300, 2000, 6)
+LOUDNESS_BITS = 12
+# frames to smooth the energies over, 0.5 s
+SMOOTH = 5
+# about one in 2 ** ANCHOR_BITS keys goes into the index
+ANCHOR_BITS = 3
+# matching thresholds, unrelated audio has a bit error rate of about 0.5
+MIN_VOTES = 8
+MAX_BER = 0.25
+MIN_OVERLAP = 60
+CONTAINED = 0.9
+
+
+def fingerprint(files: list[str]) -> np.ndarray:
+    """16-bit keys of the files played back to back, one per HOP samples, -1 for silent frames"""
+    freqs = np.fft.rfftfreq(FRAME, 1 / SAMPLE_RATE)
+    band = np.digitize(freqs, BANDS) - 1
+    bands = (band[:, None] == np.arange(len(BANDS) - 1)).astype(np.float32)
+    window = np.hanning(FRAME).astype(np.float32)
+    energies = []
+    rest = np.zeros(0, dtype=np.float32)
+    for file in files:
+        args = (
+            ffmpeg.input(file)
+            .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+            .compile()
+        )
+        for data in media.stream("decode", args, HOP * 1024 * 2):
+            samples = np.concatenate(
+                [
+                    rest,
+                    np.frombuffer(data[: len(data) // 2 * 2], dtype=np.int16).astype(
+                        np.float32
+                    ),
+                ]
+            )
+            n = max((len(samples) - FRAME) // HOP + 1, 0)
+            if n:
+                frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME)
+                power = np.abs(np.fft.rfft(frames[::HOP][:n] * window)) ** 2
+                energies.append(power @ bands)
+            rest = samples[n * HOP :]
+    energy = np.concatenate(energies or [np.zeros((0, len(BANDS) - 1))])
+    n = len(energy) - (LOUDNESS_BITS + 1) * SMOOTH
+    if n <= 0:
+        return np.zeros(0, dtype=np.int32)
+    total = energy.sum(axis=1)
+    silent = total < 1e-4 * total.mean()
+    # loudness, whether each SMOOTH frames are louder than the ones before
+    cumsum = np.cumsum(np.log(total + 1))
+    loudness = cumsum[SMOOTH:] - cumsum[:-SMOOTH]
+    bits = [
+        loudness[(j + 1) * SMOOTH : (j + 1) * SMOOTH + n]
+        > loudness[j * SMOOTH : j * SMOOTH + n]
+        for j in range(LOUDNESS_BITS)
+    ]
+    # spectral shape, band differences against SMOOTH frames before
+    cumsum = np.cumsum(energy, axis=0)
+    smooth = cumsum[SMOOTH:] - cumsum[:-SMOOTH]
+    diff = smooth[:, :-1] - smooth[:, 1:]
+    bits += list((diff[SMOOTH:] - diff[:-SMOOTH] > 0)[:n].T)
+    keys = np.packbits(np.stack(bits, axis=1), axis=1, bitorder="little")
+    keys = keys.view("<u2").ravel().astype(np.int32)
+    keys[silent[:n]] = -1
+    return keys
+
+
+def anchors(keys: np.ndarray) -> np.ndarray:
+    """positions of about one in 2 ** ANCHOR_BITS keys, chosen by value so that copies pick the same ones"""
+    mixed = (keys * 0x9E37) & 0xFFFF
+    return np.flatnonzero((mixed >> (16 - ANCHOR_BITS) == 0) & (keys >= 0))
+
+
+def compare(a: np.ndarray, b: np.ndarray, offset: int) -> tuple[float, int]:
+    """bit error rate and number of overlapping frames when frame i of a is frame i + offset of b"""
+    start, end = max(0, -offset), min(len(a), len(b) - offset)
+    if end <= start:
+        return 1.0, 0
+    x, y = a[start:end], b[start + offset : end + offset]
+    both = (x >= 0) & (y >= 0)
+    if not both.any():
+        return 1.0, 0
+    errors = np.unpackbits((x[both] ^ y[both]).astype(np.uint16).view(np.uint8))
+    return float(errors.mean()), end - start
+
+
+def path(bare_name: str, ext: str) -> str:
+    return os.path.join(utils.FINGERPRINT_DIR, f"{bare_name}.{ext}")
+
+
+def load_meta(bare_name: str) -> dict | None:
+    try:
+        with open(path(bare_name, "json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def duplicate_of(bare_name: str) -> tuple[str, float] | None:
+    """(canonical recording, offset in seconds of this recording in it) if the recording is a duplicate"""
+    meta = load_meta(bare_name)
+    if meta and meta["duplicate_of"]:
+        return meta["duplicate_of"], meta["offset"]
+    return None
+
+
+def duplicates() -> dict[str, tuple[str, float]]:
+    """{bare_name: (canonical recording, offset)} of all duplicates"""
+    result = {}
+    for file in os.listdir(utils.FINGERPRINT_DIR):
+        if file.endswith(".json"):
+            link = duplicate_of(file[:-5])
+            if link:
+                result[file[:-5]] = link
+    return result
+
+
+class Index:
+    """Anchors of all fingerprinted recordings, loaded incrementally and kept sorted for lookups."""
+
+    def __init__(self) -> None:
+        self.names: list[str] = []
+        self.parts: list[tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self.keys = np.zeros(0, dtype=np.int32)
+        self.recordings = np.zeros(0, dtype=np.int32)
+        self.positions = np.zeros(0, dtype=np.int32)
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def add(self, bare_name: str, keys: np.ndarray) -> None:
+        with self.lock:
+            if bare_name in self.names:
+                return
+            positions = anchors(keys)
+            self.parts.append(
+                (
+                    keys[positions],
+                    np.full(len(positions), len(self.names), dtype=np.int32),
+                    positions.astype(np.int32),
+                )
+            )
+            self.names.append(bare_name)
+            self.dirty = True
+
+    def refresh(self) -> None:
+        """add the recordings fingerprinted by other processes since the last refresh"""
+        for file in os.listdir(utils.FINGERPRINT_DIR):
+            # the meta is written last, so its fingerprint is complete
+            if file.endswith(".json") and file[:-5] not in self.names:
+                try:
+                    self.add(file[:-5], np.load(path(file[:-5], "npy")))
+                except (FileNotFoundError, ValueError):
+                    pass
+
+    def lookup(
+        self, query_keys: np.ndarray, top_n: int = 5
+    ) -> list[tuple[str, int, int]]:
+        """[(recording, offset in frames, votes)] of the best aligned recordings"""
+        with self.lock:
+            if self.dirty:
+                keys, recordings, positions = map(np.concatenate, zip(*self.parts))
+                order = np.argsort(keys, kind="stable")
+                self.keys = keys[order]
+                self.recordings = recordings[order]
+                self.positions = positions[order]
+                self.dirty = False
+            keys, recordings, positions = self.keys, self.recordings, self.positions
+        # every key and its 1-bit neighbours are probed, the anchors are only a subset of the index side, so a copy's
+        # keys with a flipped bit still find them
+        query = np.flatnonzero(query_keys >= 0)
+        probes = query_keys[query, None] ^ np.concatenate([[0], 1 << np.arange(16)])
+        query = np.repeat(query, probes.shape[1])
+        left = np.searchsorted(keys, probes.ravel(), "left")
+        right = np.searchsorted(keys, probes.ravel(), "right")
+        counts = right - left
+        if not counts.sum():
+            return []
+        # every posting of every probe votes for (recording, offset)
+        starts = np.repeat(left - np.cumsum(counts) + counts, counts)
+        matches = starts + np.arange(counts.sum())
+        offsets = positions[matches] - np.repeat(query, counts)
+        votes = recordings[matches].astype(np.int64) << 32 | (
+            offsets.astype(np.int64) + 2**31
+        )
+        votes, counts = np.unique(votes, return_counts=True)
+        best = np.argsort(counts)[::-1][:top_n]
+        return [
+            (
+                self.names[votes[i] >> 32],
+                int((votes[i] & 0xFFFFFFFF) - 2**31),
+                counts[i],
+            )
+            for i in best
+            if counts[i] >= MIN_VOTES
+        ]
+
+
+INDEX = Index()
+
+
+def dedup(bare_name: str, files: list[str]) -> dict:
+    """fingerprint a recording and link it to the recording containing it, returns the saved meta"""
+    msg("Dedup", "Fingerprinting", file=bare_name)
+    keys = fingerprint(files)
+    INDEX.refresh()
+    meta = {
+        "duration": len(keys) * HOP / SAMPLE_RATE,
+        "duplicate_of": None,
+        "offset": 0.0,
+        "overlaps": [],
+    }
+    for other, offset, votes in INDEX.lookup(keys):
+        # the same recording may also vote at neighbouring offsets
+        if other == bare_name or other in [o["recording"] for o in meta["overlaps"]]:
+            continue
+        candidate = np.load(path(other, "npy"))
+        # anchors may be off by a frame when the copies are not aligned to the hop
+        ber, overlap, offset = min(
+            compare(keys, candidate, offset + d) + (offset + d,) for d in (-1, 0, 1)
+        )
+        # short recordings only need to be covered
+        if ber > MAX_BER or (
+            overlap * HOP / SAMPLE_RATE < MIN_OVERLAP
+            and overlap < CONTAINED * len(keys)
+        ):
+            continue
+        meta["overlaps"].append(
+            {
+                "recording": other,
+                "offset": offset * HOP / SAMPLE_RATE,
+                "overlap": overlap * HOP / SAMPLE_RATE,
+                "ber": ber,
+                "votes": int(votes),
+            }
+        )
+        if not meta["duplicate_of"] and overlap >= CONTAINED * len(keys):
+            # link to the canonical recording directly
+            canonical, shift = duplicate_of(other) or (other, 0.0)
+            meta["duplicate_of"] = canonical
+            meta["offset"] = offset * HOP / SAMPLE_RATE + shift
+    np.save(path(bare_name, "npy"), keys)
+    tmp = path(bare_name, "json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp, path(bare_name, "json"))
+    INDEX.add(bare_name, keys)
+    if meta["duplicate_of"]:
+        msg(
+            "Dedup",
+            "Duplicate",
+            f"of {meta['duplicate_of']} from {meta['offset']:.1f} s",
+            file=bare_name,
+        )
+    elif meta["overlaps"]:
+        msg(
+            "Dedup",
+            "Overlap",
+            f"with {len(meta['overlaps'])} recordings",
+            file=bare_name,
+        )
+    return meta
+
+
+def scan() -> None:
+    """fingerprint the recordings extracted before deduplication, transcribed ones first so they become canonical"""
+    msg("Dedup", "Scanning")
+    bare_names = [
+        os.path.splitext(file)[0]
+        for dir in utils.VIDEO_DIR_LIST
+        for file in os.listdir(dir)
+        if file.endswith(".mp4") or file.endswith(".flv")
+    ]
+    bare_names.sort(
+        key=lambda b: not os.path.exists(
+            os.path.join(utils.TRANSCRIPT_DIR, f"{b}.json")
+        )
+    )
+    for bare_name in bare_names:
+        if load_meta(bare_name):
+            continue
+        try:
+            audio_parts = list(get_audio_parts(bare_name))
+        except NotPlanned:
+            # not extracted yet, extract_audio fingerprints it then
+            continue
+        except Exception as e:
+            msg("Dedup", "get_audio_parts()", repr(e), file=bare_name, error=True)
+            continue
+        if all(
+            valid(os.path.splitext(os.path.basename(f))[0], "audio")
+            for f in audio_parts
+        ):
+            dedup(bare_name, audio_parts)
+
+
+if __name__ == "__main__":
+    try:
+        scan()
+        for bare_name, (canonical, offset) in duplicates().items():
+            msg(
+                "Dedup",
+                "Duplicate",
+                f"of {canonical} from {offset:.1f} s",
+                file=bare_name,
+            )
+    except KeyboardInterrupt:
+        msg("Dedup", "Safe to Exit")
@@ -0,0 +1,173 @@
+"""Remember failing jobs, back off from retrying them and quarantine the ones that keep failing."""
+import os, json, time, argparse, utils
+from contextlib import contextmanager
+from utils import msg
+
+
+STAGES = ["audio", "demucs", "vocal", "transcribe"]
+
+
+def settings() -> dict:
+    return {"attempts": 3, "backoff": 600, "max_backoff": 86400} | utils.config.get(
+        "journal", {}
+    )
+
+
+def path(stage: str, job: str) -> str:
+    return os.path.join(utils.JOURNAL_DIR, stage, f"{job}.json")
+
+
+def load(stage: str, job: str) -> dict | None:
+    try:
+        with open(path(stage, job)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save(entry: dict) -> None:
+    file = path(entry["stage"], entry["job"])
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp = f"{file}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(entry, f, indent=4)
+    os.replace(tmp, file)
+
+
+def transient(error: BaseException) -> bool:
+    """whether the error is the device's fault rather than the job's"""
+    return "out of memory" in str(error).lower()
+
+
+def failed(
+    stage: str, job: str, error: BaseException, quarantine: bool = False
+) -> dict:
+    """journal a failure and set when the job may be retried, or quarantine it right away"""
+    now = time.time()
+    limits = settings()
+    entry = load(stage, job) or {
+        "stage": stage,
+        "job": job,
+        "attempts": 0,
+        "first": now,
+    }
+    entry["attempts"] += 1
+    entry["error"] = type(error).__name__
+    entry["message"] = str(error)[-1000:]
+    entry["last"] = now
+    entry["retry_at"] = now + min(
+        limits["backoff"] * 2 ** (entry["attempts"] - 1), limits["max_backoff"]
+    )
+    entry["quarantined"] = (
+        quarantine
+        or entry.get("quarantined", False)
+        or entry["attempts"] >= limits["attempts"]
+    )
+    save(entry)
+    if entry["quarantined"]:
+        msg("Journal", "Quarantined", f"{stage} {entry['error']}", file=job, error=True)
+    else:
+        msg(
+            "Journal",
+            "Backing Off",
+            f"{stage} attempt {entry['attempts']}, retry in {entry['retry_at'] - now:.0f} s",
+            file=job,
+            error=True,
+        )
+    return entry
+
+
+def succeeded(stage: str, job: str) -> None:
+    try:
+        os.remove(path(stage, job))
+    except FileNotFoundError:
+        pass
+
+
+def blocked(stage: str, job: str) -> bool:
+    """whether the job is quarantined or backing off"""
+    entry = load(stage, job)
+    return bool(entry) and (entry["quarantined"] or time.time() < entry["retry_at"])
+
+
+@contextmanager
+def attempt(stage: str, job: str):
+    """Journal the job as failed if the block raises an Exception, or clear it if it succeeds. Interrupts and
+    transient errors are neither. Set "quarantine" on the yielded dict to quarantine the job on this failure.
+    """
+    options = {"quarantine": False}
+    try:
+        yield options
+    except Exception as e:
+        if not transient(e):
+            failed(stage, job, e, options["quarantine"])
+        raise
+    else:
+        succeeded(stage, job)
+
+
+def entries(stage: str | None = None) -> list[dict]:
+    result = []
+    for s in [stage] if stage else STAGES:
+        dir = os.path.join(utils.JOURNAL_DIR, s)
+        for file in sorted(os.listdir(dir)) if os.path.exists(dir) else []:
+            if file.endswith(".json"):
+                entry = load(s, file[:-5])
+                if entry:
+                    result.append(entry)
+    return result
+
+
+def retry(stage: str, job: str) -> None:
+    """let the job run again on the next scan, one more failure quarantines it again"""
+    entry = load(stage, job)
+    if entry:
+        entry["quarantined"] = False
+        entry["retry_at"] = 0
+        entry["attempts"] = min(entry["attempts"], settings()["attempts"] - 1)
+        save(entry)
+        msg("Journal", "Retrying", stage, file=job)
+
+
+def release(stage: str, job: str) -> None:
+    """forget the failures of the job"""
+    succeeded(stage, job)
+    msg("Journal", "Released", stage, file=job)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="list, retry or release failing jobs")
+    parser.add_argument("action", nargs="?", choices=["list", "retry", "release"])
+    parser.add_argument("stage", nargs="?", choices=STAGES)
+    parser.add_argument("jobs", nargs="*", help='job names, or "all"')
+    parser.add_argument("--stage", dest="only", choices=STAGES)
+    parser.add_argument(
+        "--all", action="store_true", help="also list jobs that may be retried now"
+    )
+    args = parser.parse_args()
+    if args.action in ["retry", "release"]:
+        if not args.stage or not args.jobs:
+            parser.error(f"{args.action} needs a stage and jobs")
+        jobs = args.jobs
+        if jobs == ["all"]:
+            jobs = [entry["job"] for entry in entries(args.stage)]
+        for job in jobs:
+            (retry if args.action == "retry" else release)(args.stage, job)
+    else:
+        now = time.time()
+        for entry in entries(args.only or args.stage):
+            if entry["quarantined"]:
+                state = "Quarantined"
+            elif now < entry["retry_at"]:
+                state = f"Retry in {entry['retry_at'] - now:.0f} s"
+            elif args.all:
+                state = "Retry Now"
+            else:
+                continue
+            msg(
+                "Journal",
+                state,
+                f"{entry['stage']:<10} x{entry['attempts']} {entry['error']}: "
+                f"{entry['message'].strip().splitlines()[-1] if entry['message'].strip() else ''}",
+                file=entry["job"],
+            )
@@ -1,160 +1,134 @@
-import os, json, ffmpeg, pickle
+import os, threading, mp3index, peaks, corpus, export, utils
 import gradio as gr
-import pandas as pd
-from pypinyin import lazy_pinyin
-from utils import (
-    TRANSCRIPT_DIR,
-    VOCAL_DIR,
-    FAVORITE_DIR,
-    TMP_DIR,
-    SLICE_DIR,
-    msg,
-    get_duration,
-)
-
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from corpus import load_transcript
+from store import ShardedStore
+from slice_cache import SliceCache
+from utils import msg
+
+
+MAX_SLICE_NUM = corpus.PAGE_SIZE
+# seconds between checks for new transcripts
+UPDATE_INTERVAL = 60
+# previews of the pages before and after the shown one are loaded in the background
+PREFETCH = ThreadPoolExecutor(2, thread_name_prefix="prefetch")
+# {(base_name, start, end): (slice, waveplot)} of the recently shown or prefetched rows, least recently used first
+PREVIEWS: OrderedDict[tuple, tuple] = OrderedDict()
+MAX_PREVIEWS = 8 * MAX_SLICE_NUM
+PREVIEW_LOCK = threading.Lock()
+PLACEHOLDERS = {"placeholder_slice.mp3", "placeholder_waveplot.jpg"}
+# the slice cache, built on the first slice
+_slice_cache: SliceCache | None = None
+SLICE_CACHE_LOCK = threading.Lock()
+# the query being prefetched for and its jobs, a new query cancels the jobs of the last one
+prefetching: tuple = ()
+pending: list[Future] = []
+
+
+def slice_cache() -> SliceCache:
+    global _slice_cache
+    with SLICE_CACHE_LOCK:
+        if _slice_cache is None:
+            _slice_cache = SliceCache()
+        return _slice_cache
+
+
+def refresh_transcript() -> tuple[ShardedStore, str]:
+    return load_transcript(refresh=True)
 
-MAX_SLICE_NUM = 6
 
+def update_transcript(store: ShardedStore) -> tuple[ShardedStore, str | dict]:
+    """pick up the transcripts finished since the store was loaded, run periodically by every open page"""
+    if corpus.outdated():
+        load_transcript(refresh=True)
+    if store is corpus.STORE:
+        return store, gr.update()
+    return corpus.STORE, f"Loaded {len(corpus.STORE)} transcripts"
 
-def load_transcript(refresh: bool = False) -> tuple[pd.DataFrame, str]:
-    msg("Search", "Loading Transcripts")
-    transcript = pd.DataFrame()
-    try:
-        if refresh:
-            raise FileNotFoundError
-        with open(os.path.join(TMP_DIR, "transcript.pkl"), "rb") as f:
-            transcript: pd.DataFrame = pickle.load(f)
-    except FileNotFoundError:
-        tmp = {k: [] for k in ["roomid", "basename", "start", "end", "text", "pinyin"]}
-        for file in sorted(os.listdir(TRANSCRIPT_DIR)):
-            if file.endswith(".json"):
-                with open(os.path.join(TRANSCRIPT_DIR, file)) as f:
-                    base_name = os.path.splitext(file)[0]
-                    roomid = base_name.split("_")[0]
-                    for segment in json.load(f)["segments"]:
-                        tmp["roomid"].append(roomid)
-                        tmp["basename"].append(base_name)
-                        tmp["start"].append(segment["start"])
-                        tmp["end"].append(segment["end"])
-                        tmp["text"].append(segment["text"].lower())
-                        tmp["pinyin"].append(" ".join(lazy_pinyin(segment["text"])))
-        transcript = pd.DataFrame(tmp)
-        with open(os.path.join(TMP_DIR, "transcript.pkl"), "wb") as f:
-            pickle.dump(transcript, f)
-    finally:
-        status = f"Loaded {len(transcript)} transcripts"
-        msg("Search", "Loading Transcripts Finished")
-        return transcript, status
-
-
-def refresh_transcript() -> tuple[pd.DataFrame, str]:
-    return load_transcript(refresh=True)
 
-
-def trim(vocal: str, start: float, end: float, slice: str):
+def trim(vocal: str, start: float, end: float, slice: str) -> None:
     # skip if slice already exists
-    try:
-        if abs(start + get_duration(slice) - end) < 1:
-            return
-    except:
-        pass
-    return (
-        ffmpeg.input(vocal)
-        .output(slice, ss=start, to=end, acodec="copy")
-        .run_async(overwrite_output=True, quiet=True)
-        # ffmpeg.input(vocal, ss=start, to=end)
-        # .output(slice, ab=bitrate)
-        # .run_async(overwrite_output=True, quiet=True)
-    )
+    if os.path.exists(slice):
+        return
+    # copy the whole mp3 frames covering [start, end] from the vocal
+    mp3index.extract(vocal, start, end, slice)
 
 
 def load_slice(
     base_name: str, start: float, end: float
-) -> tuple[str | None, str | None]:
-    slice = os.path.join(SLICE_DIR, base_name, f"{base_name}_{start:.0f}_{end:.0f}.mp3")
+) -> tuple[str | None, str | np.ndarray | None]:
+    """the slice and waveplot of a row, from memory if shown or prefetched recently"""
+    key = (base_name, start, end)
+    with PREVIEW_LOCK:
+        if key in PREVIEWS:
+            PREVIEWS.move_to_end(key)
+            return PREVIEWS[key]
+    preview = cut_slice(base_name, start, end)
+    # placeholders are tried again next time, the vocal may be assembled by then
+    if PLACEHOLDERS.isdisjoint(p for p in preview if isinstance(p, str)):
+        with PREVIEW_LOCK:
+            PREVIEWS[key] = preview
+            while len(PREVIEWS) > MAX_PREVIEWS:
+                PREVIEWS.popitem(last=False)
+    return preview
+
+
+def cut_slice(
+    base_name: str, start: float, end: float
+) -> tuple[str | None, str | np.ndarray | None]:
+    vocal, offset, _ = corpus.vocal(base_name)
+    # a duplicate is cut from the canonical vocal, and shares its slices
+    base_name = os.path.splitext(os.path.basename(vocal))[0]
+    start, end = start + offset, end + offset
+    slice = os.path.join(
+        utils.SLICE_DIR, base_name, f"{base_name}_{start:.0f}_{end:.0f}.mp3"
+    )
     waveplot = slice.replace(".mp3", ".jpg")
-    # check if slice exists and valid
+    # cut the slice from the vocal on demand
     try:
-        if abs(start + get_duration(slice) - end) < 2:
-            pass
-        else:
-            slice = "placeholder_slice.mp3"
-    except:
+        slice = slice_cache().get(base_name, start, end)
+    except (FileNotFoundError, ValueError) as e:
+        msg("Search", "Slice Failed", repr(e), file=slice, error=True)
         slice = "placeholder_slice.mp3"
-    # check if waveplot exists
-    try:
-        if os.path.exists(waveplot):
-            pass
-        else:
+    # use the cached waveplot if exists, else render it from the peaks of the vocal
+    if not os.path.exists(waveplot):
+        try:
+            waveplot = peaks.render(vocal, start, end)
+        except (FileNotFoundError, RuntimeError) as e:
+            msg("Search", "Plot Failed", repr(e), file=vocal, error=True)
             waveplot = "placeholder_waveplot.jpg"
-    except:
-        waveplot = "placeholder_waveplot.jpg"
     # print message
     if slice:
         msg("Search", "Slice Loaded", file=slice)
-    if waveplot:
+    if isinstance(waveplot, str):
         msg("Search", "Plot Loaded", file=waveplot)
 
     return slice, waveplot
 
 
 def search(
-    transcript: pd.DataFrame,
+    store: ShardedStore,
     roomid: str,
     date_from: int,
     date_to: int,
     keyword: str,
     options: list[str],
+    order: str,
     margin: float,
     page: int = 1,
 ):
     labels: list[str | None] = [None] * MAX_SLICE_NUM
     info: list[tuple | None] = [None] * MAX_SLICE_NUM
     slices: list[str | None] = [None] * MAX_SLICE_NUM
-    waveplots: list[str | None] = [None] * MAX_SLICE_NUM
-    # filter transcript by roomid
-    if roomid != "all":
-        transcript = transcript[transcript["roomid"] == roomid]
-
-    # filter transcript by date
-    def date_filter(base_name: str) -> bool:
-        date = int(base_name.split("_")[1])
-        return date_from <= date <= date_to
-
-    transcript = transcript[transcript["basename"].apply(date_filter)]
-    # filter transcript by keywords, allow multiple keywords separated by space
-    if "Exact Match" in options:  # exact match
-        if "Pinyin" in options:
-            transcript = transcript[
-                transcript["pinyin"] == " ".join(lazy_pinyin(keyword))
-            ]
-        else:
-            transcript = transcript[transcript["text"] == keyword.lower()]
-    elif "Ends With" in options:  # ends with
-        if "Pinyin" in options:
-            transcript = transcript[
-                transcript["pinyin"].str.endswith(" ".join(lazy_pinyin(keyword)))
-            ]
-        else:
-            transcript = transcript[transcript["text"].str.endswith(keyword.lower())]
-    else:
-        for k in keyword.split():
-            if "Pinyin" in options:
-                transcript = transcript[
-                    transcript["pinyin"].str.contains(" ".join(lazy_pinyin(k)))
-                ]
-            else:
-                transcript = transcript[transcript["text"].str.contains(k.lower())]
-    # reset index
-    transcript = transcript.reset_index(drop=True)
-    # regulate page number
-    total_page = (len(transcript) - 1) // MAX_SLICE_NUM + 1
-    page = max(1, min(page, total_page))
-    i = 0
-    for j in range((page - 1) * MAX_SLICE_NUM, len(transcript)):
-        if i == MAX_SLICE_NUM:
-            break
-        row = transcript.iloc[j]
+    waveplots: list[str | np.ndarray | None] = [None] * MAX_SLICE_NUM
+    # filter transcript by roomid, date and keywords
+    transcript, _, page, total_page = corpus.search(
+        store, roomid, date_from, date_to, keyword, options, order, page
+    )
+    for i in range(len(transcript)):
+        row = transcript.iloc[i]
         base_name: str = row["basename"]
         start: float = max(row["start"] - margin, 0)
         end: float = row["end"] + margin
@@ -166,57 +140,134 @@ def search(
         slice, waveplot = load_slice(base_name, start, end)
         slices[i] = slice
         waveplots[i] = waveplot
-        i += 1
+    query = (store, roomid, date_from, date_to, keyword, tuple(options), order, margin)
+    prefetch(query, page, total_page)
 
     return page, total_page, *labels, *info, *slices, *waveplots
 
 
+def prefetch(query: tuple, page: int, total_page: int) -> None:
+    """load the previews of the pages next to the shown one in the background"""
+    global prefetching
+    with PREVIEW_LOCK:
+        if query != prefetching:
+            for job in pending:
+                job.cancel()
+            prefetching = query
+        pending[:] = [job for job in pending if not job.done()]
+        for p in [page + 1, page - 1]:
+            if 1 <= p <= total_page:
+                pending.append(PREFETCH.submit(prefetch_page, query, p))
+
+
+def prefetch_page(query: tuple, page: int) -> None:
+    store, roomid, date_from, date_to, keyword, options, order, margin = query
+    try:
+        # not through corpus.search, prefetching isn't a search in the metrics
+        transcript, _ = store.search(
+            roomid,
+            date_from,
+            date_to,
+            keyword,
+            list(options),
+            order,
+            limit=page * MAX_SLICE_NUM,
+        )
+        for _, row in transcript.iloc[(page - 1) * MAX_SLICE_NUM :].iterrows():
+            # stop between rows once the query has changed
+            if query != prefetching:
+                return
+            load_slice(
+                row["basename"], max(row["start"] - margin, 0), row["end"] + margin
+            )
+    except Exception as e:
+        msg("Search", "Prefetch Failed", repr(e), error=True)
+
+
 def prev_page(
-    transcript: pd.DataFrame,
+    store: ShardedStore,
     roomid: str,
     date_from: int,
     date_to: int,
     keyword: str,
     options: list[str],
+    order: str,
     margin: float,
     page: int,
 ):
     return search(
-        transcript, roomid, date_from, date_to, keyword, options, margin, page - 1
+        store, roomid, date_from, date_to, keyword, options, order, margin, page - 1
     )
 
 
 def next_page(
-    transcript: pd.DataFrame,
+    store: ShardedStore,
     roomid: str,
     date_from: int,
     date_to: int,
     keyword: str,
     options: list[str],
+    order: str,
     margin: float,
     page: int,
 ):
     return search(
-        transcript, roomid, date_from, date_to, keyword, options, margin, page + 1
+        store, roomid, date_from, date_to, keyword, options, order, margin, page + 1
     )
 
 
 def save_to_favorite(info: tuple[str, float, float, str]) -> str:
     base_name, start, end, text = info
-    vocal = os.path.join(VOCAL_DIR, f"{base_name}.mp3")
+    vocal, offset, _ = corpus.vocal(base_name)
     favorite = os.path.join(
-        FAVORITE_DIR, f"{base_name}_{start:.0f}_{end:.0f}_{text}.mp3"
+        utils.FAVORITE_DIR, f"{base_name}_{start:.0f}_{end:.0f}_{text}.mp3"
     )
     try:
-        trim(vocal, start, end, favorite)
+        trim(vocal, offset + start, offset + end, favorite)
     except FileNotFoundError:
         msg("Search", "Not Found", file=vocal, error=True)
         return f"Not Found {vocal}"
+    except ValueError as e:
+        msg("Search", "Save Failed", str(e), file=favorite, error=True)
+        return f"Save Failed {favorite}"
     else:
         msg("Search", "Saved", file=favorite)
         return f"Saved to {favorite}"
 
 
+def export_matches(
+    store: ShardedStore,
+    roomid: str,
+    date_from: int,
+    date_to: int,
+    keyword: str,
+    options: list[str],
+    order: str,
+    margin: float,
+    rows: str,
+    progress=gr.Progress(),
+) -> str:
+    """cut all matches of the query, or the selected result numbers, to favorites"""
+    try:
+        out, manifest = export.export(
+            store,
+            roomid,
+            date_from,
+            date_to,
+            keyword,
+            options,
+            order,
+            margin,
+            rows,
+            archive=True,
+            progress=lambda done, total: progress((done, total), desc="Exporting"),
+        )
+    except ValueError as e:
+        msg("Search", "Export Failed", str(e), error=True)
+        return f"Export Failed {e}"
+    return f"Exported {len(manifest['clips'])} clips to {out}, {len(manifest['failed'])} failed"
+
+
 if __name__ == "__main__":
     css = "footer {display: none !important;} .gradio-container {min-height: 0px !important;} .gradio-container {min-width: 0px !important;}"
     with gr.Blocks(
@@ -241,23 +292,34 @@ if __name__ == "__main__":
                     value=init_status, label="Status", interactive=False
                 )
                 roomid = gr.Dropdown(
-                    choices=["all"] + sorted(df["roomid"].unique().tolist()),
+                    choices=["all"] + df.rooms,
                     label="Room ID",
                     value="all",
                 )
                 options = gr.CheckboxGroup(
-                    choices=["Audio", "Pinyin", "Exact Match", "Ends With"],
+                    choices=["Audio", "Pinyin", "Phrase", "Exact Match", "Ends With"],
                     value=["Audio"],
                     label="Options",
                 )
+                order = gr.Radio(
+                    choices=["Chronological", "Relevance"],
+                    value="Chronological",
+                    label="Order",
+                )
                 margin = gr.Number(
                     value=2,
                     label="Audio Margin (seconds)",
                 )
                 date_from = gr.Number(value=20220101, label="Date From", precision=0)
                 date_to = gr.Number(value=20770101, label="Date To", precision=0)
-                keyword = gr.Textbox(value="晚上好", label="Search For")
+                keyword = gr.Textbox(
+                    value="晚上好", label="Search For (words ~10 for within 10 seconds)"
+                )
                 submit = gr.Button(value="Search")
+                export_rows = gr.Textbox(
+                    value="", label="Export Results (e.g. 1-50, 80, empty for all)"
+                )
+                export_all = gr.Button(value="Export to Favorites")
             with gr.Column(scale=100):
                 for i in range(MAX_SLICE_NUM):
                     labels.append(gr.Markdown())
@@ -281,37 +343,89 @@ if __name__ == "__main__":
 
         keyword.submit(
             search,
-            [transcript, roomid, date_from, date_to, keyword, options, margin],
+            [transcript, roomid, date_from, date_to, keyword, options, order, margin],
             [page, total_page, *labels, *info, *audios, *waveplots],
         )
 
         submit.click(
             search,
-            [transcript, roomid, date_from, date_to, keyword, options, margin],
+            [transcript, roomid, date_from, date_to, keyword, options, order, margin],
             [page, total_page, *labels, *info, *audios, *waveplots],
         )
 
         page.submit(
             search,
-            [transcript, roomid, date_from, date_to, keyword, options, margin, page],
+            [
+                transcript,
+                roomid,
+                date_from,
+                date_to,
+                keyword,
+                options,
+                order,
+                margin,
+                page,
+            ],
             [page, total_page, *labels, *info, *audios, *waveplots],
         )
 
         backward.click(
             prev_page,
-            [transcript, roomid, date_from, date_to, keyword, options, margin, page],
+            [
+                transcript,
+                roomid,
+                date_from,
+                date_to,
+                keyword,
+                options,
+                order,
+                margin,
+                page,
+            ],
             [page, total_page, *labels, *info, *audios, *waveplots],
         )
 
         forward.click(
             next_page,
-            [transcript, roomid, date_from, date_to, keyword, options, margin, page],
+            [
+                transcript,
+                roomid,
+                date_from,
+                date_to,
+                keyword,
+                options,
+                order,
+                margin,
+                page,
+            ],
             [page, total_page, *labels, *info, *audios, *waveplots],
         )
 
         for i in range(MAX_SLICE_NUM):
             favorite[i].click(save_to_favorite, info[i], status)
 
+        export_all.click(
+            export_matches,
+            [
+                transcript,
+                roomid,
+                date_from,
+                date_to,
+                keyword,
+                options,
+                order,
+                margin,
+                export_rows,
+            ],
+            status,
+        )
+
         refresh.click(refresh_transcript, outputs=[transcript, status])
+        app.load(
+            update_transcript,
+            transcript,
+            [transcript, status],
+            every=UPDATE_INTERVAL,
+        )
 
     app.launch(share=False)
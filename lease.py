@@ -0,0 +1,226 @@
+import os, json, time, uuid, socket, threading, utils
+from utils import msg
+
+
+HOST = socket.gethostname()
+# checks of a lease file that is missing for a moment while a contender puts it back, see FileLeases.take_over()
+RETRIES = 5
+RETRY_INTERVAL = 0.2
+
+
+def ttl() -> float:
+    """Seconds without a heartbeat before a lease expires and its job may be taken over."""
+    return utils.config.get("lease_ttl", 120)
+
+
+class Lease:
+    """A claim on one job, renewed in the background until released. Use as a context manager."""
+
+    def __init__(self, leases, stage: str, item: str, owner: str) -> None:
+        self.leases = leases
+        self.stage = stage
+        self.item = item
+        self.owner = owner
+        # set if the lease expired and another node took the job over
+        self.lost = False
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew, daemon=True)
+        self.heartbeat.start()
+
+    def renew(self) -> None:
+        # renew well within the ttl
+        while not self.stopped.wait(self.leases.ttl / 4):
+            if not self.leases.renew(self):
+                self.lost = True
+                msg(
+                    "Lease",
+                    "Lost",
+                    f"{self.stage} taken over",
+                    file=self.item,
+                    error=True,
+                )
+                return
+
+    def publish(self, src: str, dst: str) -> bool:
+        """move a finished output into place if the lease is still held, else drop it"""
+        if not self.lost and not self.leases.renew(self):
+            self.lost = True
+        if self.lost:
+            msg("Lease", "Dropped", f"{self.stage} taken over", file=dst, error=True)
+            try:
+                os.remove(src)
+            except FileNotFoundError:
+                pass
+            return False
+        os.replace(src, dst)
+        return True
+
+    def release(self) -> None:
+        self.stopped.set()
+        if not self.lost:
+            self.leases.release(self)
+
+    def __enter__(self) -> "Lease":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+class FileLeases:
+    """leases as files in LEASE_DIR shared by all nodes, claimed with O_EXCL and kept alive by touching them"""
+
+    def __init__(self, dir: str | None = None, ttl: float | None = None) -> None:
+        self._dir = dir
+        self._ttl = ttl
+
+    @property
+    def dir(self) -> str:
+        return self._dir or utils.LEASE_DIR
+
+    @property
+    def ttl(self) -> float:
+        return ttl() if self._ttl is None else self._ttl
+
+    def path(self, stage: str, item: str) -> str:
+        return os.path.join(self.dir, stage, f"{item}.lease")
+
+    def read(self, path: str) -> dict:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # gone, or being written by the creator
+            return {}
+
+    def stale(self, path: str) -> bool:
+        return time.time() - os.path.getmtime(path) > self.ttl
+
+    def acquire(self, stage: str, item: str) -> Lease | None:
+        """claim the job, None if a live lease is held by anyone else"""
+        path = self.path(stage, item)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        owner = f"{HOST}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # one retry after taking over a stale lease
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self.take_over(path, owner):
+                    return None
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"owner": owner, "acquired": time.time()}, f)
+            return Lease(self, stage, item, owner)
+        return None
+
+    def take_over(self, path: str, owner: str) -> bool:
+        """remove the lease at path if stale, whether the slot may be claimed again"""
+        try:
+            if not self.stale(path):
+                return False
+            stale = f"{path}.{owner}.stale"
+            os.rename(path, stale)
+        except FileNotFoundError:
+            # released or taken over by someone else meanwhile, race for it again
+            return True
+        # the holder may have renewed between the check and the rename, put it back then
+        if not self.stale(stale):
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        msg("Lease", "Expired", f"held by {self.read(stale).get('owner')}", file=path)
+        os.remove(stale)
+        return True
+
+    def held(self, stage: str, item: str) -> bool:
+        """whether anyone holds a live lease on the job"""
+        try:
+            return not self.stale(self.path(stage, item))
+        except FileNotFoundError:
+            return False
+
+    def renew(self, lease: Lease) -> bool:
+        path = self.path(lease.stage, lease.item)
+        for _ in range(RETRIES):
+            owner = self.read(path).get("owner")
+            if owner == lease.owner:
+                try:
+                    os.utime(path)
+                    return True
+                except FileNotFoundError:
+                    pass
+            elif owner:
+                return False
+            # renamed away by a contender that is putting it back, or being written
+            time.sleep(RETRY_INTERVAL)
+        return False
+
+    def release(self, lease: Lease) -> None:
+        path = self.path(lease.stage, lease.item)
+        if self.read(path).get("owner") == lease.owner:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class MemoryLeases:
+    """Stand-in coordinator for a single process, e.g. when OUT_DIR is not shared, with the same expiry rules."""
+
+    def __init__(self, ttl: float | None = None) -> None:
+        self._ttl = ttl
+        # {(stage, item): (owner, expires)}
+        self.leases: dict[tuple[str, str], tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def ttl(self) -> float:
+        return ttl() if self._ttl is None else self._ttl
+
+    def acquire(self, stage: str, item: str) -> Lease | None:
+        owner = f"{HOST}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        with self.lock:
+            if self.held(stage, item):
+                return None
+            self.leases[stage, item] = (owner, time.time() + self.ttl)
+        return Lease(self, stage, item, owner)
+
+    def held(self, stage: str, item: str) -> bool:
+        lease = self.leases.get((stage, item))
+        return lease is not None and lease[1] > time.time()
+
+    def renew(self, lease: Lease) -> bool:
+        with self.lock:
+            if self.leases.get((lease.stage, lease.item), ("",))[0] != lease.owner:
+                return False
+            self.leases[lease.stage, lease.item] = (lease.owner, time.time() + self.ttl)
+            return True
+
+    def release(self, lease: Lease) -> None:
+        with self.lock:
+            if self.leases.get((lease.stage, lease.item), ("",))[0] == lease.owner:
+                del self.leases[lease.stage, lease.item]
+
+
+# one coordinator per kind, kept for the process so that in-memory leases survive a config reload
+_leases: dict[str, FileLeases | MemoryLeases] = {}
+
+
+def leases() -> FileLeases | MemoryLeases:
+    """The coordinator selected by the lease config."""
+    kind = "memory" if utils.config.get("lease") == "memory" else "file"
+    if kind not in _leases:
+        _leases[kind] = MemoryLeases() if kind == "memory" else FileLeases()
+    return _leases[kind]
+
+
+def acquire(stage: str, item: str) -> Lease | None:
+    return leases().acquire(stage, item)
+
+
+def held(stage: str, item: str) -> bool:
+    return leases().held(stage, item)
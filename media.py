@@ -0,0 +1,243 @@
+"""One executor for all ffmpeg and ffprobe processes of a process."""
+import os, json, time, asyncio, threading, metrics, utils
+from concurrent.futures import TimeoutError as FutureTimeout
+from subprocess import DEVNULL, PIPE
+from typing import Iterator
+
+
+def limits() -> tuple[int, dict[str, int]]:
+    """how many processes may run at once in total and per kind"""
+    kinds = {"probe": 8, "decode": 4, "extract": 2, "encode": 2} | utils.config.get(
+        "media_limits", {}
+    )
+    return utils.config.get("media_processes", os.cpu_count() or 4), kinds
+
+
+def timeouts() -> dict[str, float]:
+    """seconds before a process of each kind is killed"""
+    return {
+        "probe": 60,
+        "decode": 600,
+        "extract": 3600,
+        "encode": 3600,
+    } | utils.config.get("media_timeout", {})
+
+
+class MediaError(RuntimeError):
+    """a media process failed or timed out"""
+
+
+def describe(args: list[str]) -> str:
+    """the input file of a command, or its last argument"""
+    return args[args.index("-i") + 1] if "-i" in args else args[-1]
+
+
+def failed(args: list[str], returncode: int, stderr: bytes) -> MediaError:
+    # the last lines say what went wrong, the ones before are the banner and stream info
+    message = " | ".join(stderr.decode(errors="replace").strip().splitlines()[-3:])
+    return MediaError(
+        f"{args[0]} exited with {returncode} on {describe(args)}: {message}"
+    )
+
+
+def record(
+    kind: str, args: list[str], queued: float, started: float, status: str
+) -> None:
+    metrics.write(
+        {
+            "type": "span",
+            "stage": f"media_{kind}",
+            "item": describe(args),
+            "device": "",
+            "queued": queued,
+            "started": started,
+            "finished": time.time(),
+            "audio_seconds": 0.0,
+            "bytes": 0,
+            "status": status,
+        }
+    )
+
+
+class Executor:
+    """The loop, limits and in-flight probes of this process. Use executor() to get it."""
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.limits = limits()
+        total, kinds = self.limits
+        self.total = asyncio.Semaphore(total)
+        self.kinds = {kind: asyncio.Semaphore(n) for kind, n in kinds.items()}
+        # {file: probe task}
+        self.probes: dict[str, asyncio.Task] = {}
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="media", daemon=True
+        )
+        self.thread.start()
+
+    async def acquire(self, kind: str) -> None:
+        await self.kinds[kind].acquire()
+        try:
+            await self.total.acquire()
+        except BaseException:
+            self.kinds[kind].release()
+            raise
+
+    def release(self, kind: str) -> None:
+        self.total.release()
+        self.kinds[kind].release()
+
+    async def spawn(
+        self, args: list[str]
+    ) -> tuple[asyncio.subprocess.Process, asyncio.Task]:
+        """start a process with its stderr read in the background, so that it never blocks on a full pipe"""
+        process = await asyncio.create_subprocess_exec(
+            *args, stdin=DEVNULL, stdout=PIPE, stderr=PIPE
+        )
+        return process, asyncio.ensure_future(process.stderr.read())  # type: ignore
+
+    async def reap(
+        self, process: asyncio.subprocess.Process, stderr: asyncio.Task
+    ) -> bytes:
+        """kill the process if still running and wait for it, returns its stderr"""
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+        return await stderr
+
+    async def read(self, process: asyncio.subprocess.Process, size: int) -> bytes:
+        """size bytes of stdout, fewer only at the end"""
+        try:
+            return await process.stdout.readexactly(size)  # type: ignore
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def run(
+        self, kind: str, args: list[str], timeout: float | None = None
+    ) -> bytes:
+        queued = time.time()
+        await self.acquire(kind)
+        started = time.time()
+        status = "error"
+        try:
+            process, stderr = await self.spawn(args)
+            try:
+                stdout = await asyncio.wait_for(
+                    process.stdout.read(), timeout or timeouts()[kind]  # type: ignore
+                )
+                await process.wait()
+            except asyncio.TimeoutError:
+                status = "timeout"
+                raise MediaError(f"{args[0]} timed out on {describe(args)}")
+            finally:
+                errors = await self.reap(process, stderr)
+            if process.returncode != 0:
+                raise failed(args, process.returncode, errors)
+            status = "ok"
+            return stdout
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            self.release(kind)
+            record(kind, args, queued, started, status)
+
+    async def probe(self, file: str) -> dict:
+        """ffprobe format and streams of the file, sharing the probe with callers asking at the same time"""
+        task = self.probes.get(file)
+        if not task:
+            args = ["ffprobe", "-show_format", "-show_streams", "-of", "json", file]
+            task = asyncio.ensure_future(self.run("probe", args))
+            self.probes[file] = task
+            task.add_done_callback(lambda _: self.probes.pop(file, None))
+        # one caller giving up doesn't cancel the others
+        return json.loads(await asyncio.shield(task))
+
+
+_executor: Executor | None = None
+_pid = 0
+_lock = threading.Lock()
+
+
+def executor() -> Executor:
+    """The executor of this process, started on first use and again in forked children. A new one is started when
+    the limits in the config change, the old one finishes the processes it's running."""
+    global _executor, _pid
+    with _lock:
+        if not _executor or _pid != os.getpid() or _executor.limits != limits():
+            _executor, _pid = Executor(), os.getpid()
+        return _executor
+
+
+def call(ex: Executor, coroutine, timeout: float | None = None):
+    """run a coroutine of the executor on its loop and wait for it, cancelling it if the caller is interrupted"""
+    future = asyncio.run_coroutine_threadsafe(coroutine, ex.loop)
+    try:
+        return future.result(timeout)
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def run(kind: str, args: list[str], timeout: float | None = None) -> bytes:
+    """stdout of a command of a kind of limits(), killed after the timeout of the kind by default"""
+    ex = executor()
+    return call(ex, ex.run(kind, args, timeout))
+
+
+def probe(file: str) -> dict:
+    ex = executor()
+    return call(ex, ex.probe(file))
+
+
+async def run_async(kind: str, args: list[str], timeout: float | None = None) -> bytes:
+    """run() for coroutines on any loop, cancelling the coroutine kills the process"""
+    ex = executor()
+    future = asyncio.run_coroutine_threadsafe(ex.run(kind, args, timeout), ex.loop)
+    return await asyncio.wrap_future(future)
+
+
+async def probe_async(file: str) -> dict:
+    ex = executor()
+    future = asyncio.run_coroutine_threadsafe(ex.probe(file), ex.loop)
+    return await asyncio.wrap_future(future)
+
+
+def stream(
+    kind: str, args: list[str], size: int, timeout: float | None = None
+) -> Iterator[bytes]:
+    """Run a command and yield its stdout in chunks of size bytes, fewer only for the last chunk. The process is
+    killed if the caller stops iterating early."""
+    ex = executor()
+    queued = time.time()
+    call(ex, ex.acquire(kind))
+    started = time.time()
+    deadline = started + (timeout or timeouts()[kind])
+    status = "error"
+    process = None
+    try:
+        process, stderr = call(ex, ex.spawn(args))
+        while True:
+            data = call(ex, ex.read(process, size), max(deadline - time.time(), 0))
+            if not data:
+                break
+            yield data
+        errors = call(ex, ex.reap(process, stderr))
+        returncode, process = process.returncode, None
+        if returncode != 0:
+            raise failed(args, returncode, errors)
+        status = "ok"
+    except FutureTimeout:
+        status = "timeout"
+        raise MediaError(f"{args[0]} timed out on {describe(args)}")
+    except GeneratorExit:
+        status = "cancelled"
+        raise
+    finally:
+        if process:
+            call(ex, ex.reap(process, stderr))
+        ex.loop.call_soon_threadsafe(ex.release, kind)
+        record(kind, args, queued, started, status)
@@ -0,0 +1,267 @@
+import os, sys, json, time, fcntl, socket, threading, profiling, utils
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import msg
+
+
+# files in METRIC_DIR
+TRACE = "trace.jsonl"
+TEXTFILE = "auto_transcribe.prom"
+# the aggregates and how far into the trace they go, shared by all readers
+STATE = "state.json"
+HOST = socket.gethostname()
+
+
+def path(name: str) -> str:
+    return os.path.join(utils.METRIC_DIR, name)
+
+
+def trace_bytes() -> int:
+    return utils.config.get("metrics_trace_bytes", 256 * 1024**2)
+
+
+def rotate(f, trace: str) -> None:
+    """move a full trace aside to trace.1, the one writer holding its lock wins and the others write to the new one"""
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+        # another writer may have rotated it between our open and the lock
+        if os.stat(trace).st_ino == os.fstat(f.fileno()).st_ino:
+            os.replace(trace, f"{trace}.1")
+    except FileNotFoundError:
+        pass
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write(event: dict) -> None:
+    """append an event to the trace, one line per event so concurrent processes don't interleave"""
+    event |= {"host": HOST, "pid": os.getpid()}
+    trace = path(TRACE)
+    with open(trace, "a", encoding="utf-8") as f:
+        f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        if f.tell() > trace_bytes():
+            rotate(f, trace)
+
+
+@contextmanager
+def span(stage: str, item: str, device: str = "", queued: float | None = None):
+    """record a job from queued to finished, set "audio_seconds" and "bytes" on the yielded record when known"""
+    started = time.time()
+    record = {
+        "type": "span",
+        "stage": stage,
+        "item": item,
+        "device": device,
+        "queued": queued or started,
+        "started": started,
+        "audio_seconds": 0.0,
+        "bytes": 0,
+    }
+    try:
+        # jobs are also the unit of opt-in profiling
+        with profiling.profile(stage, item):
+            yield record
+        record["status"] = "ok"
+    except BaseException as e:
+        record["status"] = "error"
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["finished"] = time.time()
+        write(record)
+
+
+def count(stage: str, name: str, value: float = 1) -> None:
+    write({"type": "counter", "stage": stage, "name": name, "value": value})
+
+
+def gauge(stage: str, name: str, value: float) -> None:
+    write({"type": "gauge", "stage": stage, "name": name, "value": value})
+
+
+class Metrics:
+    """Aggregates the trace of all processes into Prometheus metrics, reading only the new lines on each update. The
+    aggregates are saved to `state` after every update, so a new reader resumes from there instead of the start of
+    the trace."""
+
+    def __init__(self, trace: str | None = None, state: str | None = None) -> None:
+        self.trace = trace or path(TRACE)
+        self.state = path(STATE) if state is None else state
+        self.offset = 0
+        self.inode = 0
+        # {(metric, labels): value}
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        """resume from the aggregates saved by the last update of any process"""
+        if not self.state:
+            return
+        try:
+            with open(self.state) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if saved.get("trace") != self.trace:
+            return
+        self.offset = saved["offset"]
+        self.inode = saved["inode"]
+        for values, items in [
+            (self.counters, saved["counters"]),
+            (self.gauges, saved["gauges"]),
+        ]:
+            for metric, labels, value in items:
+                values[(metric, tuple(map(tuple, labels)))] = value
+
+    def save(self) -> None:
+        tmp = f"{self.state}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "trace": self.trace,
+                    "offset": self.offset,
+                    "inode": self.inode,
+                    "counters": [[m, l, v] for (m, l), v in self.counters.items()],
+                    "gauges": [[m, l, v] for (m, l), v in self.gauges.items()],
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp, self.state)
+
+    def reset(self) -> None:
+        self.offset = 0
+        self.counters.clear()
+        self.gauges.clear()
+
+    def add(self, metric: str, labels: dict, value: float) -> None:
+        key = (metric, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def read(self, f) -> None:
+        """consume the complete lines from the offset on"""
+        f.seek(self.offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # partially written, read it next time
+                break
+            self.offset += len(line)
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # interleaved by appends of several nodes over a shared filesystem
+                continue
+            self.consume(event)
+
+    def update(self) -> None:
+        with self.lock:
+            offset = self.offset
+            try:
+                with open(self.trace, "rb") as f:
+                    stat = os.fstat(f.fileno())
+                    if stat.st_ino != self.inode:
+                        # finish the rotated trace if it's the one we were reading, otherwise start over
+                        try:
+                            with open(f"{self.trace}.1", "rb") as old:
+                                rotated = os.fstat(old.fileno()).st_ino == self.inode
+                                if rotated:
+                                    self.read(old)
+                        except FileNotFoundError:
+                            rotated = False
+                        if not rotated:
+                            self.reset()
+                        self.offset = 0
+                        self.inode = stat.st_ino
+                        offset = -1
+                    elif stat.st_size < self.offset:
+                        # truncated, start over
+                        self.reset()
+                        offset = -1
+                    self.read(f)
+            except FileNotFoundError:
+                pass
+            if self.state and self.offset != offset:
+                self.save()
+
+    def consume(self, event: dict) -> None:
+        stage = {"stage": event["stage"]}
+        if event["type"] == "counter":
+            self.add(f"at_{event['name']}_total", stage, event["value"])
+        elif event["type"] == "gauge":
+            key = (f"at_{event['name']}", tuple(sorted(stage.items())))
+            self.gauges[key] = event["value"]
+        elif event["type"] == "span":
+            compute = event["finished"] - event["started"]
+            self.add("at_jobs_total", stage | {"status": event["status"]}, 1)
+            self.add(
+                "at_job_wait_seconds_total", stage, event["started"] - event["queued"]
+            )
+            self.add("at_job_compute_seconds_total", stage, compute)
+            self.add("at_audio_seconds_total", stage, event["audio_seconds"])
+            self.add("at_bytes_total", stage, event["bytes"])
+            if event["device"]:
+                self.add(
+                    "at_device_busy_seconds_total",
+                    {"device": f"{event['host']}/{event['device']}"},
+                    compute,
+                )
+
+    def prometheus(self) -> str:
+        self.update()
+        with self.lock:
+            return self.format()
+
+    def format(self) -> str:
+        lines = []
+        for kind, values in [("counter", self.counters), ("gauge", self.gauges)]:
+            for metric in sorted({m for m, _ in values}):
+                lines.append(f"# TYPE {metric} {kind}")
+                for (m, labels), value in values.items():
+                    if m == metric:
+                        label = ",".join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f"{metric}{{{label}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, textfile: str | None = None) -> None:
+        """write the metrics as a textfile for the node exporter"""
+        textfile = textfile or path(TEXTFILE)
+        tmp = textfile + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, textfile)
+
+    def serve(self, port: int) -> None:
+        """serve the metrics over HTTP at /metrics"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        msg("Metrics", "Serving", f"http://0.0.0.0:{port}/metrics")
+        ThreadingHTTPServer(("", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    # python metrics.py [port], export the textfile once, or serve over HTTP if a port is given
+    try:
+        if len(sys.argv) > 1:
+            Metrics().serve(int(sys.argv[1]))
+        else:
+            Metrics().export()
+            msg("Metrics", "Exported", file=path(TEXTFILE))
+    except KeyboardInterrupt:
+        msg("Metrics", "Safe to Exit")
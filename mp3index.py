@@ -0,0 +1,136 @@
+import os, mmap, threading, utils
+import numpy as np
+from functools import lru_cache
+from utils import msg
+
+
+# bitrate tables in kbps, keyed by (MPEG-1, layer)
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# sample rates keyed by the version bits, 3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000],
+}
+
+
+def parse_header(header: int) -> tuple[int, int, int] | None:
+    """(frame length, samples per frame, sample rate) of a 4-byte frame header, None if not valid"""
+    if header >> 21 != 0x7FF:
+        return None
+    version = (header >> 19) & 3
+    layer = 4 - ((header >> 17) & 3)
+    bitrate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 3
+    padding = (header >> 9) & 1
+    if version == 1 or layer == 4 or bitrate_index in [0, 15] or sample_rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding, 576, sample_rate
+    return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+
+def build_index(mp3: str) -> tuple[np.ndarray, np.ndarray]:
+    """byte offsets and timestamps of every frame start, plus the end of the last frame"""
+    msg("Frames", "Indexing", file=mp3)
+    offsets = []
+    samples = []
+    sample_rate = 0
+    end = 0
+    with open(mp3, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        pos = 0
+        # skip ID3v2 tag
+        if mm[:3] == b"ID3" and size >= 10:
+            # syncsafe integer, 7 bits per byte
+            tag_size = sum((mm[6 + i] & 0x7F) << (7 * (3 - i)) for i in range(4))
+            pos = 10 + tag_size + (10 if mm[5] & 0x10 else 0)
+        while pos + 4 <= size:
+            frame = parse_header(int.from_bytes(mm[pos : pos + 4], "big"))
+            if frame is None or pos + frame[0] > size:
+                # resync on the next possible frame header
+                pos = mm.find(b"\xff", pos + 1)
+                if pos < 0:
+                    break
+                continue
+            length, num_samples, sample_rate = frame
+            # the Xing / Info frame carries no audio
+            if not offsets and (
+                b"Xing" in mm[pos : pos + 64] or b"Info" in mm[pos : pos + 64]
+            ):
+                pos += length
+                continue
+            offsets.append(pos)
+            samples.append(num_samples)
+            pos += length
+            end = pos
+    if not offsets:
+        raise ValueError(f"No MPEG audio frame found in {mp3}")
+    offsets = np.array(offsets + [end], dtype=np.int64)
+    times = np.concatenate([[0], np.cumsum(samples)]) / sample_rate
+    return offsets, times
+
+
+@lru_cache(maxsize=64)
+def _load_index(mp3: str, mtime: float, size: int) -> tuple[np.ndarray, np.ndarray]:
+    cache = os.path.join(
+        utils.FRAME_DIR, f"{os.path.splitext(os.path.basename(mp3))[0]}.npz"
+    )
+    try:
+        with np.load(cache) as data:
+            if data["mtime"] == mtime and data["size"] == size:
+                return data["offsets"], data["times"]
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+    offsets, times = build_index(mp3)
+    np.savez(cache, offsets=offsets, times=times, mtime=mtime, size=size)
+    return offsets, times
+
+
+def load_index(mp3: str) -> tuple[np.ndarray, np.ndarray]:
+    """frame index of the mp3, read from FRAME_DIR or built once if missing or outdated"""
+    stat = os.stat(mp3)
+    return _load_index(mp3, stat.st_mtime, stat.st_size)
+
+
+def locate(mp3: str, start: float, end: float) -> tuple[int, int, float, float]:
+    """(first byte, end byte, start, end) of the whole frames covering [start, end]"""
+    offsets, times = load_index(mp3)
+    i = max(int(np.searchsorted(times, start, "right")) - 1, 0)
+    j = min(int(np.searchsorted(times, end, "left")), len(times) - 1)
+    j = max(i, j)
+    return int(offsets[i]), int(offsets[j]), float(times[i]), float(times[j])
+
+
+def read(mp3: str, start: float, end: float) -> bytes:
+    """mp3 bytes of the whole frames covering [start, end], empty if out of range"""
+    first, last, _, _ = locate(mp3, start, end)
+    with open(mp3, "rb") as f:
+        f.seek(first)
+        return f.read(last - first)
+
+
+def extract(mp3: str, start: float, end: float, out: str) -> None:
+    """write the whole frames covering [start, end] to a new mp3 file"""
+    data = read(mp3, start, end)
+    if not data:
+        raise ValueError(f"[{start:.0f}, {end:.0f}] is out of range of {mp3}")
+    dir = os.path.dirname(out)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    tmp = f"{out}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, out)
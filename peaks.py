@@ -0,0 +1,125 @@
+import os, ffmpeg, media, utils
+import numpy as np
+from functools import lru_cache
+from utils import msg
+
+
+# audio is decoded to mono at this rate for the envelope
+SAMPLE_RATE = 16000
+# samples per bin of each level, each level is 4X coarser than the previous one
+BINS = [128, 512, 2048, 8192]
+# waveplot size in pixels
+WIDTH = 960
+HEIGHT = 48
+
+
+def envelope(samples: np.ndarray, bin: int) -> tuple[np.ndarray, np.ndarray]:
+    """min and max of every `bin` samples, the last bin may be partial"""
+    n = len(samples) // bin * bin
+    full = samples[:n].reshape(-1, bin)
+    mins, maxs = full.min(axis=1), full.max(axis=1)
+    if n < len(samples):
+        mins = np.append(mins, samples[n:].min())
+        maxs = np.append(maxs, samples[n:].max())
+    return mins, maxs
+
+
+def build_peaks(vocal: str) -> list[tuple[np.ndarray, np.ndarray]]:
+    """the int16 (mins, maxs) of every level in BINS, decoding the vocal once"""
+    msg("Peaks", "Building", file=vocal)
+    args = (
+        ffmpeg.input(vocal)
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .compile()
+    )
+    levels: list[tuple[list, list]] = [([], []) for _ in BINS]
+    # read whole top level bins so every level stays aligned across chunks
+    chunk = BINS[-1] * 64
+    for data in media.stream("decode", args, chunk * 2):
+        samples = np.frombuffer(data[: len(data) // 2 * 2], dtype=np.int16)
+        mins, maxs = envelope(samples, BINS[0])
+        for i, (lo, hi) in enumerate(levels):
+            if i:
+                mins = envelope(mins, BINS[i] // BINS[i - 1])[0]
+                maxs = envelope(maxs, BINS[i] // BINS[i - 1])[1]
+            lo.append(mins)
+            hi.append(maxs)
+    return [
+        (
+            np.concatenate(lo or [[]]).astype(np.int16),
+            np.concatenate(hi or [[]]).astype(np.int16),
+        )
+        for lo, hi in levels
+    ]
+
+
+@lru_cache(maxsize=64)
+def _load_peaks(
+    vocal: str, mtime: float, size: int
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    cache = os.path.join(
+        utils.PEAK_DIR, f"{os.path.splitext(os.path.basename(vocal))[0]}.npz"
+    )
+    try:
+        with np.load(cache) as data:
+            if data["mtime"] == mtime and data["size"] == size:
+                return [(data[f"min_{i}"], data[f"max_{i}"]) for i in range(len(BINS))]
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+    levels = build_peaks(vocal)
+    arrays = {f"min_{i}": lo for i, (lo, _) in enumerate(levels)}
+    arrays |= {f"max_{i}": hi for i, (_, hi) in enumerate(levels)}
+    np.savez(cache, mtime=mtime, size=size, **arrays)
+    return levels
+
+
+def load_peaks(vocal: str) -> list[tuple[np.ndarray, np.ndarray]]:
+    """peaks pyramid of the vocal, read from PEAK_DIR or built once if missing or outdated"""
+    stat = os.stat(vocal)
+    return _load_peaks(vocal, stat.st_mtime, stat.st_size)
+
+
+def get_peaks(
+    vocal: str, start: float, end: float, width: int = WIDTH
+) -> tuple[np.ndarray, np.ndarray]:
+    """min / max envelope of [start, end] in at most `width` columns, from the coarsest level that is fine enough"""
+    levels = load_peaks(vocal)
+    for level in range(len(BINS) - 1, -1, -1):
+        if (end - start) * SAMPLE_RATE / BINS[level] >= width or level == 0:
+            break
+    mins, maxs = levels[level]
+    a = max(int(start * SAMPLE_RATE / BINS[level]), 0)
+    b = min(int(np.ceil(end * SAMPLE_RATE / BINS[level])), len(mins))
+    if a >= b:
+        return np.zeros(0, dtype=np.int16), np.zeros(0, dtype=np.int16)
+    # merge bins into columns
+    edges = np.unique(np.linspace(a, b, min(width, b - a) + 1).astype(int)[:-1])
+    return np.minimum.reduceat(mins[:b], edges), np.maximum.reduceat(maxs[:b], edges)
+
+
+def draw(
+    mins: np.ndarray, maxs: np.ndarray, width: int = WIDTH, height: int = HEIGHT
+) -> np.ndarray:
+    """RGB image of the envelope white on black, scaled to its peak amplitude"""
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    if not len(mins):
+        image[height // 2, :] = 255
+        return image
+    # stretch columns over the width
+    columns = np.arange(width) * len(mins) // width
+    lo = mins[columns].astype(np.float32)
+    hi = maxs[columns].astype(np.float32)
+    amp = max(np.abs(lo).max(), np.abs(hi).max()) + 1e-9
+    # row centers from top (+amp) to bottom (-amp), at least one pixel per column
+    rows = amp * (1 - 2 * (np.arange(height) + 0.5) / height)
+    pixel = amp / height
+    mask = (rows[:, None] >= lo[None, :] - pixel) & (
+        rows[:, None] <= hi[None, :] + pixel
+    )
+    image[mask] = 255
+    return image
+
+
+def render(vocal: str, start: float, end: float) -> np.ndarray:
+    """waveplot image of [start, end] of the vocal"""
+    return draw(*get_peaks(vocal, start, end))
@@ -0,0 +1,191 @@
+"""Order the jobs of every stage by priority instead of directory order."""
+import os, sys, json, time, math, metrics, fingerprint, utils
+from utils import NotPlanned, msg, valid, get_video, get_duration, get_audio_parts
+
+
+POLICIES = ["newest", "oldest", "shortest", "fifo"]
+BOOST = 100
+# pipeline stages in order
+STAGES = ["audio", "demucs", "vocal", "transcribe"]
+# realtime multiples per worker until the metrics have measured them
+SPEED = {"audio": 1000, "demucs": 25, "vocal": 200, "transcribe": 6}
+
+
+def settings() -> dict:
+    settings = {"policy": "newest", "aging": 0.5, "rooms": {}} | utils.config.get(
+        "priority", {}
+    )
+    if settings["policy"] not in POLICIES:
+        raise ValueError(f"unknown priority policy {settings['policy']}")
+    return settings
+
+
+def bare_name(file: str) -> str:
+    """the recording of any stage's file, e.g. 12345_20230101_x_part_01_vocals.wav -> 12345_20230101_x"""
+    base_name = os.path.splitext(os.path.basename(file))[0]
+    return base_name.split("_vocals")[0].split("_part_")[0]
+
+
+def recorded(file: str) -> float:
+    """When the recording was made, the end of the day in its name or the file time if earlier. The file time alone
+    would make old recordings look new once an earlier stage gets to them."""
+    mtime = os.path.getmtime(file)
+    try:
+        day = time.mktime(time.strptime(bare_name(file).split("_")[1], "%Y%m%d"))
+    except (IndexError, ValueError):
+        return mtime
+    return min(mtime, day + 86400)
+
+
+def boosted() -> set[str]:
+    try:
+        with open(utils.BOOSTLIST) as f:
+            return set(filter(None, f.read().splitlines()))
+    except FileNotFoundError:
+        return set()
+
+
+def urgency(file: str, waited: float, boost: set[str] | None = None) -> float:
+    """points of the job on the file waiting for waited seconds, higher goes first"""
+    policy = settings()
+    boost = boosted() if boost is None else boost
+    name = bare_name(file)
+    room = name.split("_")[0]
+    points = 0.0
+    if policy["policy"] in ["newest", "oldest"]:
+        hours = max(time.time() - recorded(file), 0) / 3600
+        points = math.log2(1 + hours) * (-1 if policy["policy"] == "newest" else 1)
+    elif policy["policy"] == "shortest":
+        try:
+            points = -math.log2(1 + get_duration(file) / 3600)
+        except Exception:
+            # broken files fail in the stage, where they are reported
+            pass
+    points += policy["rooms"].get(room, 0)
+    if name in boost or room in boost:
+        points += BOOST
+    return points + policy["aging"] * waited / 3600
+
+
+def load_queue(stage: str) -> dict[str, float]:
+    try:
+        with open(os.path.join(utils.QUEUE_DIR, f"{stage}.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def rank(files: list[str], queue: dict[str, float], now: float) -> list[str]:
+    """Sort jobs most urgent first, given since when each recording is queued. Nothing is written."""
+    boost = boosted()
+    points = {f: urgency(f, now - queue.get(bare_name(f), now), boost) for f in files}
+    return sorted(files, key=points.get, reverse=True)
+
+
+def order(stage: str, files: list[str]) -> list[str]:
+    """Sort the queued jobs of a stage, most urgent first, for the scheduler. Also remembers since when each recording
+    is queued in the stage, in QUEUE_DIR/{stage}.json, for aging and the queue view. Only pass the jobs still to do.
+    """
+    now = time.time()
+    queue = load_queue(stage)
+    # recordings no longer queued are dropped
+    queue = {bare_name(f): queue.get(bare_name(f), now) for f in files}
+    tmp = os.path.join(utils.QUEUE_DIR, f"{stage}.json.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(queue, f)
+    os.replace(tmp, os.path.join(utils.QUEUE_DIR, f"{stage}.json"))
+    return rank(files, queue, now)
+
+
+def speeds() -> dict[str, float]:
+    """realtime multiple of one worker of each stage, measured by the metrics where possible"""
+    exporter = metrics.Metrics()
+    exporter.update()
+    speeds = dict(SPEED)
+    for stage in STAGES:
+        labels = (("stage", stage),)
+        compute = exporter.counters.get(("at_job_compute_seconds_total", labels), 0)
+        audio = exporter.counters.get(("at_audio_seconds_total", labels), 0)
+        if compute > 0 and audio > 0:
+            speeds[stage] = audio / compute
+    return speeds
+
+
+def stage_of(name: str) -> tuple[str, str] | None:
+    """(stage, input file of the stage) the recording is queued in, None if searchable or skipped"""
+    vocal = os.path.join(utils.VOCAL_DIR, f"{name}.mp3")
+    if valid(name, "transcript") or fingerprint.duplicate_of(name):
+        return None
+    if valid(name, "vocal"):
+        return "transcribe", vocal
+    try:
+        audio_parts = list(get_audio_parts(name))
+    except NotPlanned:
+        return "audio", get_video(name)
+    base_names = [os.path.splitext(os.path.basename(f))[0] for f in audio_parts]
+    if not all(valid(b, "audio") for b in base_names):
+        return "audio", get_video(name)
+    if all(valid(b, "demucs") for b in base_names):
+        return "vocal", audio_parts[0]
+    return "demucs", audio_parts[0]
+
+
+def eta() -> list[dict]:
+    """expected seconds until each queued recording is searchable, soonest first"""
+    now = time.time()
+    queues: dict[str, list[str]] = {stage: [] for stage in STAGES}
+    durations = {}
+    for dir in utils.VIDEO_DIR_LIST:
+        for file in os.listdir(dir):
+            if not (file.endswith(".mp4") or file.endswith(".flv")):
+                continue
+            name = os.path.splitext(file)[0]
+            try:
+                queued = stage_of(name)
+            except Exception as e:
+                msg("Priority", "stage_of()", repr(e), file=name, error=True)
+                continue
+            if queued:
+                queues[queued[0]].append(queued[1])
+                durations[name] = get_duration(os.path.join(dir, file))
+    speed = speeds()
+    result = []
+    for stage, files in queues.items():
+        queue = load_queue(stage)
+        ahead = 0.0
+        for position, file in enumerate(rank(files, queue, now)):
+            name = bare_name(file)
+            ahead += durations[name]
+            later = STAGES[STAGES.index(stage) + 1 :]
+            result.append(
+                {
+                    "recording": name,
+                    "stage": stage,
+                    "position": position + 1,
+                    "waited": now - queue.get(name, now),
+                    "eta": ahead / speed[stage]
+                    + sum(durations[name] / speed[s] for s in later),
+                }
+            )
+    return sorted(result, key=lambda r: r["eta"])
+
+
+def format_seconds(seconds: float) -> str:
+    return f"{seconds // 3600:.0f}:{seconds % 3600 // 60:02.0f}"
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["boost"]:
+        with open(utils.BOOSTLIST, "a") as f:
+            for name in sys.argv[2:]:
+                f.write(f"{name}\n")
+                msg("Priority", "Boosted", file=name)
+    else:
+        for item in eta():
+            msg(
+                "Priority",
+                f"ETA {format_seconds(item['eta'])}",
+                f"{item['stage']:<10} #{item['position']:<4} "
+                f"waited {format_seconds(item['waited'])}",
+                file=item["recording"],
+            )
@@ -0,0 +1,185 @@
+"""Opt-in profiling of pipeline jobs, enabled with AT_PROFILE or "profile" in config.json."""
+import os, re, sys, time, pstats, resource, cProfile, threading, tracemalloc, utils
+from collections import Counter
+from contextlib import contextmanager
+from utils import msg
+
+
+# seconds between samples of the sampling profiler
+INTERVAL = 0.005
+# cProfile allows one active profiler per thread, so a nested job pauses the job around it
+_active = threading.local()
+
+
+def frame_name(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class Sampler(threading.Thread):
+    """samples the stack of a thread at a fixed interval"""
+
+    def __init__(self, thread_id: int, interval: float = INTERVAL) -> None:
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> Counter[str]:
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+def collapse_pstats(stats: pstats.Stats, max_depth: int = 64) -> Counter[str]:
+    """Approximate collapsed stacks from cProfile's caller graph, splitting each function's time among its callers,
+    each placed on its heaviest call path. Times are in microseconds."""
+    entries = stats.stats  # type: ignore
+    name = lambda f: f"{os.path.basename(f[0])}:{f[2]}"
+    paths: dict = {}
+
+    def path(func, visiting: set) -> str:
+        # heaviest caller chain, memoised, a caller already on the chain (recursion) ends it
+        if len(visiting) >= max_depth:
+            return name(func)
+        if func not in paths:
+            callers = entries[func][4]
+            heaviest = max(
+                (c for c in callers if c in entries and c not in visiting),
+                key=lambda c: callers[c][3],
+                default=None,
+            )
+            prefix = path(heaviest, visiting | {func}) if heaviest else ""
+            paths[func] = f"{prefix};{name(func)}" if prefix else name(func)
+        return paths[func]
+
+    stacks: Counter[str] = Counter()
+    for func, (_, _, tt, ct, callers) in entries.items():
+        edges = {c: e[3] for c, e in callers.items() if c in entries and c != func}
+        total = sum(edges.values())
+        if not edges or total <= 0:
+            stacks[path(func, set())] += int(tt * 1e6)
+            continue
+        for caller, edge_ct in edges.items():
+            stacks[f"{path(caller, {func})};{name(func)}"] += int(
+                tt * edge_ct / total * 1e6
+            )
+    return stacks
+
+
+def collapse_snapshot(snapshot: tracemalloc.Snapshot, top_n: int = 200) -> Counter[str]:
+    """collapsed stacks of the largest allocations still alive, weighted by bytes"""
+    stacks: Counter[str] = Counter()
+    for stat in snapshot.statistics("traceback")[:top_n]:
+        path = ";".join(
+            f"{os.path.basename(f.filename)}:{f.lineno}" for f in stat.traceback
+        )
+        stacks[path] += stat.size
+    return stacks
+
+
+def save(stacks: Counter[str], path: str) -> None:
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            if count > 0:
+                f.write(f"{stack} {count}\n")
+
+
+def peak_rss() -> float:
+    """peak RSS of this process in MB since the last reset_peak(), over its lifetime where /proc isn't available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak() -> None:
+    """reset the peak RSS of this process to its current RSS"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def modes() -> set[str]:
+    """the enabled profiling modes"""
+    return set(
+        filter(
+            None,
+            os.environ.get("AT_PROFILE", utils.config.get("profile", "")).split(","),
+        )
+    )
+
+
+def profile_filter() -> str:
+    return os.environ.get("AT_PROFILE_FILTER", utils.config.get("profile_filter", ""))
+
+
+@contextmanager
+def profile(stage: str, item: str):
+    """profile the job in the enabled modes if it matches the filter"""
+    enabled = modes()
+    if not enabled or profile_filter() not in f"{stage} {os.path.basename(item)}":
+        yield
+        return
+    name = re.sub(r"[^\w.-]", "_", os.path.splitext(os.path.basename(item))[0])
+    prefix = os.path.join(
+        utils.PROFILE_DIR, f"{stage}_{name}_{time.strftime('%Y%m%d%H%M%S')}"
+    )
+    stack = _active.__dict__.setdefault("stack", [])
+    outer = stack[-1] if stack else None
+    profiler = cProfile.Profile() if "cprofile" in enabled else None
+    sampler = Sampler(threading.get_ident()) if "sample" in enabled else None
+    # tracemalloc is process wide, the outermost job owns it and nested jobs snapshot it
+    tracing = "memory" in enabled
+    owner = tracing and not tracemalloc.is_tracing()
+    if owner:
+        tracemalloc.start(25)
+    if sampler:
+        sampler.start()
+    if outer:
+        outer.disable()
+    if profiler:
+        profiler.enable()
+    stack.append(profiler)
+    try:
+        yield
+    finally:
+        # stop everything before writing so the profiles don't include themselves
+        stack.pop()
+        if profiler:
+            profiler.disable()
+        if sampler:
+            sampler.stop()
+        if tracing and tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if owner:
+                tracemalloc.stop()
+            save(collapse_snapshot(snapshot), f"{prefix}.memory.collapsed")
+            msg("Profile", "Memory", f"peak {peak / 1024**2:.1f} MB traced", file=item)
+        if profiler:
+            profiler.dump_stats(f"{prefix}.pstats")
+            save(
+                collapse_pstats(pstats.Stats(profiler)), f"{prefix}.cprofile.collapsed"
+            )
+        if sampler:
+            save(sampler.stacks, f"{prefix}.sample.collapsed")
+        if outer:
+            outer.enable()
+        msg("Profile", "Saved", file=prefix)
@@ -1,46 +1,50 @@
-import os, torch, torchaudio, pickle
+import os, time, torch, torchaudio, mp3index, profiling, corpus, utils
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+from PIL import Image
 from multiprocessing import Pool
-from utils import (
-    VOCAL_DIR,
-    SLICE_DIR,
-    TMP_DIR,
-    msg,
-)
+from peaks import envelope, draw
+from utils import msg
 
 
-def get_waveplot(waveform: np.ndarray, sample_rate: int, file: str = ""):
+def get_waveplot(waveform: np.ndarray, sample_rate: int, file: str = "") -> np.ndarray:
     if file:
         msg("Search", "Get Waveplot", file=file)
-    time_axis = []
-    samples = []
-    for i in range(0, len(waveform), 100):
-        time_axis.append(i / sample_rate)
-        samples.append(waveform[i : i + 100].max())
-        time_axis.append((i + 50) / sample_rate)
-        samples.append(waveform[i : i + 100].min())
-    fig = plt.figure(figsize=(20, 1), facecolor="black", dpi=48)
-    if samples:
-        plt.plot(time_axis, samples, color="white")
-        plt.xlim(min(time_axis), max(time_axis))
-        amp = max(abs(min(samples)), abs(max(samples))) + 1e-9
-        plt.ylim(-amp, amp)
-    else:
-        plt.plot([0, 1], [0, 0], color="white")
-        plt.xlim(0, 1)
-        plt.ylim(-1, 1)
-    plt.axis("off")
-    return fig
+    # envelope over every 100 samples across channels
+    waveform = waveform.reshape(len(waveform), -1)
+    mins, _ = envelope(waveform.min(axis=1), 100)
+    _, maxs = envelope(waveform.max(axis=1), 100)
+    return draw(mins, maxs)
+
 
+# the vocal a pool worker last saved slices of, its peak RSS is reset on the first slice of the next
+_vocal = ""
 
-def save_slice(waveform: torch.Tensor, sample_rate: int, path: str) -> None:
+
+def save_slice(
+    vocal: str, sample_rate: int, start: float, end: float, path: str
+) -> int:
+    """save the slice of the vocal and its waveplot, returns the worker's peak RSS in MB on this vocal"""
+    global _vocal
+    if vocal != _vocal:
+        _vocal = vocal
+        profiling.reset_peak()
     msg("Cache", "Saving", file=path)
-    torchaudio.save(path, waveform, sample_rate, compression=-9.5)  # type: ignore
-    fig = get_waveplot(waveform.numpy().T, sample_rate)
-    fig.savefig(path.replace(".mp3", ".jpg"))
-    plt.close(fig)
+    start_frame = int(start * sample_rate)
+    waveform, sample_rate = torchaudio.load(  # type: ignore
+        vocal, frame_offset=start_frame, num_frames=int(end * sample_rate) - start_frame
+    )
+    if waveform.nelement() == 0:
+        msg("Slice", "Warning", "Empty waveform", file=path, error=True)
+    else:
+        torchaudio.save(path, waveform, sample_rate, compression=-9.5)  # type: ignore
+        image = get_waveplot(waveform.numpy().T, sample_rate)
+        Image.fromarray(image).save(path.replace(".mp3", ".jpg"))
+    return profiling.peak_rss()
+
+
+def _save_slice(args: tuple) -> float:
+    return save_slice(*args)
 
 
 def cache_all_slices(transcript: pd.DataFrame, margin: float) -> None:
@@ -48,72 +52,79 @@ def cache_all_slices(transcript: pd.DataFrame, margin: float) -> None:
     num_proc = torch.multiprocessing.cpu_count()
     # num_proc = 1
     skip_list = []
-    VALIDLIST = os.path.join(TMP_DIR, "valid_slices.txt")
+    VALIDLIST = os.path.join(utils.TMP_DIR, "valid_slices.txt")
     try:
         with open(VALIDLIST) as f:
             skip_list = f.read().splitlines()
     except:
         pass
-    for base_name in transcript["basename"].unique():
-        vocal = os.path.join(VOCAL_DIR, f"{base_name}.mp3")
-        slice_dir = os.path.join(SLICE_DIR, base_name)
-        if not os.path.exists(slice_dir):
-            os.makedirs(slice_dir)
-        # skip if already cached
-        msg("Cache", "Checking", file=vocal)
-        # check valid list
-        if base_name in skip_list:
-            continue
-        # else check cached slices
-        rows = []
-        for _, row in transcript[transcript["basename"] == base_name].iterrows():
-            start = max(row["start"] - margin, 0)
-            end = row["end"] + margin
-            slice = os.path.join(slice_dir, f"{base_name}_{start:.0f}_{end:.0f}.mp3")
-            if not os.path.exists(slice) or not os.path.exists(
-                slice.replace(".mp3", ".jpg")
-            ):
-                rows.append((start, end, slice))
-        if not rows:
-            with open(VALIDLIST, "a") as f:
-                f.write(base_name + "\n")
-            continue
-        # load mp3
-        msg("Cache", "Loading", file=vocal)
-        waveform, sample_rate = torchaudio.load(vocal)  # type: ignore
-        # save slices
-        args = []
-        for start, end, slice in rows:
-            # sanity check
-            start_frame = int(start * sample_rate)
-            end_frame = int(end * sample_rate)
-            if start_frame > waveform.shape[1]:
-                msg(
-                    "Slice",
-                    "Warning",
-                    f"Skipping start = {start:.0f} > duration",
-                    file=slice,
+    # one pool for all recordings, workers decode their own ranges so no PCM is copied between processes
+    with Pool(num_proc) as p:
+        for base_name, segments in transcript.groupby("basename", sort=False):
+            vocal = os.path.join(utils.VOCAL_DIR, f"{base_name}.mp3")
+            slice_dir = os.path.join(utils.SLICE_DIR, base_name)
+            if not os.path.exists(slice_dir):
+                os.makedirs(slice_dir)
+            # skip if already cached
+            msg("Cache", "Checking", file=vocal)
+            # check valid list
+            if base_name in skip_list:
+                continue
+            # else check cached slices
+            starts = (segments["start"] - margin).clip(lower=0).to_numpy()
+            ends = (segments["end"] + margin).to_numpy()
+            rows = []
+            for start, end in zip(starts, ends):
+                slice = os.path.join(
+                    slice_dir, f"{base_name}_{start:.0f}_{end:.0f}.mp3"
                 )
+                if not os.path.exists(slice) or not os.path.exists(
+                    slice.replace(".mp3", ".jpg")
+                ):
+                    rows.append((start, end, slice))
+            if not rows:
+                with open(VALIDLIST, "a") as f:
+                    f.write(base_name + "\n")
                 continue
-            if end_frame > waveform.shape[1]:
-                end_frame = waveform.shape[1]
-            # debug start
-            if waveform[:, start_frame : end_frame + 1].nelement() == 0:
-                print("empty waveform:", slice)
-            # debug end
-            args.append(
-                (
-                    waveform[:, start_frame : end_frame + 1],
-                    sample_rate,
-                    slice,
+            # duration and sample rate without decoding
+            msg("Cache", "Loading", file=vocal)
+            start_time = time.time()
+            duration = mp3index.load_index(vocal)[1][-1]
+            sample_rate = torchaudio.info(vocal).sample_rate  # type: ignore
+            # save slices
+            args = []
+            for start, end, slice in rows:
+                # sanity check
+                if start > duration:
+                    msg(
+                        "Slice",
+                        "Warning",
+                        f"Skipping start = {start:.0f} > duration",
+                        file=slice,
+                    )
+                    continue
+                args.append((vocal, sample_rate, start, min(end, duration), slice))
+            # peak RSS of this recording, the workers reset theirs on its first slice
+            profiling.reset_peak()
+            with profiling.profile("slice", base_name):
+                peak_rss = max(
+                    p.imap_unordered(_save_slice, args, chunksize=16), default=0
                 )
+            end_time = time.time()
+            audio = sum(end - start for _, _, start, end, _ in args)
+            peak_rss = max(peak_rss, profiling.peak_rss())
+            msg(
+                "Cache",
+                "Cached",
+                f"({audio / (end_time - start_time):.0f}X) {len(args)} slices "
+                f"{len(args) / (end_time - start_time):.1f}/s, peak RSS {peak_rss:.0f} MB",
+                file=vocal,
             )
-        with Pool(num_proc) as p:
-            p.starmap(save_slice, args)
     msg("Cache", "Done")
 
 
 if __name__ == "__main__":
-    with open(os.path.join(TMP_DIR, "transcript.pkl"), "rb") as f:
-        transcript: pd.DataFrame = pickle.load(f)
-        cache_all_slices(transcript, 2)
+    store, _ = corpus.load_transcript(refresh=True)
+    # every segment of every shard, recordings in order
+    transcript, _ = store.search("all", 0, 99999999, "", [])
+    cache_all_slices(transcript, 2)
@@ -0,0 +1,177 @@
+import os, json, time, atexit, threading, mp3index, utils
+from collections import Counter, OrderedDict
+from utils import msg
+
+
+# in SLICE_DIR
+INDEX = "index.json"
+# minimum seconds between index writes
+FLUSH_INTERVAL = 10
+
+
+class SliceCache:
+    """on-demand vocal slices snapped to mp3 frames, least recently used evicted past the budget"""
+
+    def __init__(self, budget: int | None = None, index: str | None = None) -> None:
+        self._budget = budget
+        self.index = index or os.path.join(utils.SLICE_DIR, INDEX)
+        self.lock = threading.RLock()
+        # {key: {"file", "size", "hits", "last_access"}}, least recently used first
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.recordings: Counter[str] = Counter()
+        # the statistics as of the last load or flush, what's beyond them is added to the index on the next flush
+        self.saved = self.counts()
+        self.last_flush = 0.0
+        self.load()
+        atexit.register(self.flush)
+
+    @property
+    def budget(self) -> int:
+        return utils.SLICE_CACHE_BYTES if self._budget is None else self._budget
+
+    def counts(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "recordings": Counter(self.recordings),
+        }
+
+    def read(self) -> dict | None:
+        try:
+            with open(self.index) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def merge(self, entries: dict[str, dict]) -> None:
+        """take over the entries of other processes whose slices still exist, the most recent access of a key winning"""
+        for key, entry in entries.items():
+            if key in self.entries:
+                if entry["last_access"] <= self.entries[key]["last_access"]:
+                    continue
+                self.size -= self.entries.pop(key)["size"]
+            elif not os.path.exists(entry["file"]):
+                continue
+            self.entries[key] = entry
+            self.size += entry["size"]
+        self.entries = OrderedDict(
+            sorted(self.entries.items(), key=lambda kv: kv[1]["last_access"])
+        )
+
+    def load(self) -> None:
+        data = self.read()
+        if data is None:
+            return
+        self.merge(data["entries"])
+        self.hits = data["hits"]
+        self.misses = data["misses"]
+        self.evictions = data["evictions"]
+        self.recordings = Counter(data["recordings"])
+        self.saved = self.counts()
+
+    def flush(self) -> None:
+        with self.lock:
+            # other processes may have flushed since, add to their index instead of overwriting it
+            data = self.read()
+            if data is not None:
+                self.merge(data["entries"])
+                self.hits += data["hits"] - self.saved["hits"]
+                self.misses += data["misses"] - self.saved["misses"]
+                self.evictions += data["evictions"] - self.saved["evictions"]
+                self.recordings.update(Counter(data["recordings"]))
+                self.recordings.subtract(self.saved["recordings"])
+                self.recordings = +self.recordings
+                self.evict()
+            data = {"entries": self.entries} | self.counts()
+            tmp = f"{self.index}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.index)
+            self.saved = self.counts()
+            self.last_flush = time.time()
+
+    def maybe_flush(self) -> None:
+        if time.time() - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def get(self, base_name: str, start: float, end: float) -> str:
+        """path to the slice of the vocal covering [start, end], cut if not cached"""
+        vocal = os.path.join(utils.VOCAL_DIR, f"{base_name}.mp3")
+        _, _, start, end = mp3index.locate(vocal, start, end)
+        key = f"{base_name}_{start:.3f}_{end:.3f}"
+        with self.lock:
+            self.recordings[base_name] += 1
+            entry = self.entries.get(key)
+            if entry and os.path.exists(entry["file"]):
+                self.hits += 1
+                entry["hits"] += 1
+                entry["last_access"] = time.time()
+                self.entries.move_to_end(key)
+                self.maybe_flush()
+                return entry["file"]
+            self.misses += 1
+        # cut outside the lock, the file is moved into place atomically
+        slice = os.path.join(utils.SLICE_DIR, base_name, f"{key}.mp3")
+        mp3index.extract(vocal, start, end, slice)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)["size"]
+            self.entries[key] = {
+                "file": slice,
+                "size": os.path.getsize(slice),
+                "hits": 0,
+                "last_access": time.time(),
+            }
+            self.size += self.entries[key]["size"]
+            self.evict()
+            self.maybe_flush()
+        return slice
+
+    def evict(self) -> None:
+        """remove least recently used slices until within budget, always keeping the newest one"""
+        with self.lock:
+            while self.size > self.budget and len(self.entries) > 1:
+                key, entry = self.entries.popitem(last=False)
+                self.size -= entry["size"]
+                self.evictions += 1
+                try:
+                    os.remove(entry["file"])
+                except FileNotFoundError:
+                    pass
+
+    def stats(self, top_n: int = 10) -> dict:
+        """access statistics, to check the warm set against what users search for"""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "budget": self.budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "top_recordings": self.recordings.most_common(top_n),
+                "top_slices": sorted(
+                    ((k, e["hits"]) for k, e in self.entries.items()),
+                    key=lambda kv: kv[1],
+                    reverse=True,
+                )[:top_n],
+            }
+
+
+if __name__ == "__main__":
+    stats = SliceCache().stats()
+    msg(
+        "Cache",
+        "Stats",
+        f"{stats['entries']} slices, {stats['bytes'] / 1024**2:.1f} / {stats['budget'] / 1024**2:.1f} MB, "
+        f"hit rate {stats['hit_rate']:.1%}, {stats['evictions']} evicted",
+    )
+    for i, (base_name, count) in enumerate(stats["top_recordings"]):
+        msg("Cache", "Top Recording", f"#{i+1} {count} requests", file=base_name)
@@ -0,0 +1,70 @@
+import os, json, utils
+from concurrent.futures import ThreadPoolExecutor
+from utils import get_duration, msg
+
+
+# in TMP_DIR
+STATUS_CACHE = "status.json"
+NUM_PROBE = 8
+
+
+class StatusEngine:
+    """durations of pipeline files, probing only new or changed ones, cached in TMP_DIR"""
+
+    def __init__(self, cache: str | None = None, num_probe: int = NUM_PROBE) -> None:
+        self.cache = cache or os.path.join(utils.TMP_DIR, STATUS_CACHE)
+        self.num_probe = num_probe
+        # {path: [mtime, size, duration]}
+        self.files: dict[str, list] = {}
+        try:
+            with open(self.cache) as f:
+                self.files = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        self.probed = 0
+        self.seen: set[str] = set()
+
+    @staticmethod
+    def probe(file: str) -> float:
+        try:
+            return get_duration(file)
+        except Exception as e:
+            msg("Status", "Probe Failed", repr(e), file=file, error=True)
+            return 0
+
+    def durations(
+        self, dirs: list[str], suffix: str | tuple[str, ...]
+    ) -> dict[str, float]:
+        """{path: duration} of the files ending with suffix in the given directories"""
+        stats = {}
+        for dir in dirs:
+            try:
+                with os.scandir(dir) as it:
+                    for entry in it:
+                        if entry.name.endswith(suffix) and entry.is_file():
+                            stat = entry.stat()
+                            stats[entry.path] = [stat.st_mtime, stat.st_size]
+            except FileNotFoundError:
+                pass
+        # probe only new or modified files
+        new = [
+            file
+            for file, stat in stats.items()
+            if self.files.get(file, [None, None])[:2] != stat
+        ]
+        if new:
+            msg("Status", "Probing", f"{len(new)} new files")
+            with ThreadPoolExecutor(self.num_probe) as executor:
+                for file, duration in zip(new, executor.map(self.probe, new)):
+                    self.files[file] = stats[file] + [duration]
+            self.probed += len(new)
+        self.seen.update(stats)
+        return {file: self.files[file][2] for file in stats}
+
+    def save(self) -> None:
+        # forget files that are gone
+        self.files = {k: v for k, v in self.files.items() if k in self.seen}
+        tmp = self.cache + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.files, f)
+        os.replace(tmp, self.cache)
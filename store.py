@@ -0,0 +1,540 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from pypinyin import lazy_pinyin
+
+
+COLUMNS = ["roomid", "basename", "start", "end", "text", "pinyin"]
+EMPTY = np.empty(0, dtype=np.int32)
+REGEX = re.compile(r"[.^$*+?{}\[\]\\|()]")
+# "words ~10" searches for the words within 10 seconds of each other
+WITHIN = re.compile(r"\s*~\s*(\d+(?:\.\d+)?)\s*$")
+# searches over shards at the same time
+POOL = ThreadPoolExecutor(4, thread_name_prefix="shard")
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def ngrams(s: str) -> list[str]:
+    """character unigrams and bigrams"""
+    return list(s) + [s[i : i + 2] for i in range(len(s) - 1)]
+
+
+def characters(s: str) -> list[str]:
+    """characters but whitespace, the tokens of phrases in text"""
+    return [c for c in s if not c.isspace()]
+
+
+def build_index(docs: pd.Series, tokenize) -> dict[str, np.ndarray]:
+    """build an inverted index {token: sorted row positions} over a series of strings"""
+    tokens = docs.map(lambda doc: list(set(tokenize(doc)))).explode().dropna()
+    rows = tokens.index.to_numpy(dtype=np.int32)
+    return {
+        token: rows[positions]
+        for token, positions in tokens.groupby(tokens, sort=False).indices.items()
+    }
+
+
+def build_tf_index(
+    docs: pd.Series, tokenize
+) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """build an inverted index {token: (sorted row positions, term frequencies)} over a series of strings"""
+    tokens = docs.map(tokenize).explode().dropna()
+    if tokens.empty:
+        return {}
+    counts = (
+        pd.DataFrame({"term": tokens.to_numpy(), "row": tokens.index.to_numpy()})
+        .groupby(["term", "row"])
+        .size()
+    )
+    terms = counts.index.get_level_values(0).to_numpy()
+    rows = counts.index.get_level_values(1).to_numpy(dtype=np.int32)
+    tf = counts.to_numpy(dtype=np.float32)
+    bounds = np.concatenate(
+        [[0], np.flatnonzero(terms[1:] != terms[:-1]) + 1, [len(terms)]]
+    )
+    return {terms[a]: (rows[a:b], tf[a:b]) for a, b in zip(bounds[:-1], bounds[1:])}
+
+
+def split_within(keyword: str) -> tuple[str, float | None]:
+    """the keywords and the seconds of a trailing "~N", None if there is none"""
+    within = WITHIN.search(keyword)
+    if within is None:
+        return keyword, None
+    return keyword[: within.start()], float(within.group(1))
+
+
+def ranges(starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """concatenated np.arange(start, start + size) of every pair"""
+    offsets = np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
+    return offsets + np.arange(sizes.sum(), dtype=np.int64)
+
+
+def intersect(postings: list[np.ndarray]) -> np.ndarray:
+    """intersect sorted row arrays, smallest first"""
+    postings = sorted(postings, key=len)
+    rows = postings[0]
+    for p in postings[1:]:
+        if not len(rows):
+            break
+        rows = np.intersect1d(rows, p, assume_unique=True)
+    return rows
+
+
+def top_k(scores: np.ndarray, limit: int) -> np.ndarray:
+    """indices of the limit highest scores, highest first and earliest first among equal scores"""
+    if limit >= len(scores):
+        top = np.arange(len(scores))
+    elif limit <= 0:
+        top = np.arange(0)
+    else:
+        # the limit-th highest score, ties with it are cut in chronological order
+        kth = scores[np.argpartition(scores, -limit)[-limit]]
+        above = np.flatnonzero(scores > kth)
+        top = np.concatenate(
+            [above, np.flatnonzero(scores == kth)[: limit - len(above)]]
+        )
+    return top[np.lexsort((top, -scores[top]))]
+
+
+class TranscriptStore:
+    """transcript segments sorted by room, date and recording, with keyword indexes"""
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        df = df.reset_index(drop=True)
+        # typed columns, parsed once per recording instead of once per row per query
+        basename = df["basename"].astype("category")
+        recordings = basename.cat.categories
+        dates = pd.to_numeric(
+            pd.Series(recordings).str.split("_").str[1], errors="coerce"
+        ).fillna(0)
+        rid = basename.cat.codes.to_numpy(dtype=np.int32)
+        date = dates.to_numpy(dtype=np.int32)[rid]
+        # rooms ordered as they appear in file-name order
+        roomid = df["roomid"].astype(
+            pd.CategoricalDtype(
+                pd.unique(df["roomid"].to_numpy()[np.argsort(rid, kind="stable")])
+            )
+        )
+        room = roomid.cat.codes.to_numpy(dtype=np.int32)
+        order = np.lexsort((rid, date, room))
+        df = df.iloc[order].reset_index(drop=True)
+        df["roomid"] = roomid.iloc[order].reset_index(drop=True)
+        df["date"] = date[order]
+        df["rid"] = rid[order]
+        self.df = df
+        # metadata
+        self.rooms: list[str] = sorted(roomid.cat.categories.tolist())
+        self.recordings: list[str] = recordings.tolist()
+        self.dates = df["date"].to_numpy()
+        room = room[order]
+        bounds = np.searchsorted(room, np.arange(len(self.rooms) + 1))
+        self.room_ranges = {
+            r: (int(bounds[i]), int(bounds[i + 1]))
+            for i, r in enumerate(roomid.cat.categories)
+        }
+        # keyword indexes, characters for text and syllables for pinyin
+        self.text_index = build_index(df["text"], lambda s: s)
+        self.pinyin_index = build_index(df["pinyin"], lambda s: s.split(" "))
+        # ranking indexes, see bm25_index()
+        self._bm25: dict[str, tuple[dict, np.ndarray]] = {}
+        # phrase indexes, see positional_index()
+        self._positions: dict[str, tuple[dict, np.ndarray, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def prefilter(self, roomid: str, date_from: int, date_to: int) -> np.ndarray:
+        """rows of the given room within [date_from, date_to]"""
+        if roomid != "all":
+            lo, hi = self.room_ranges.get(roomid, (0, 0))
+            a = lo + np.searchsorted(self.dates[lo:hi], date_from, "left")
+            b = lo + np.searchsorted(self.dates[lo:hi], date_to, "right")
+            return np.arange(a, b, dtype=np.int32)
+        mask = (self.dates >= date_from) & (self.dates <= date_to)
+        return np.flatnonzero(mask).astype(np.int32)
+
+    def text_candidates(self, keyword: str) -> np.ndarray:
+        """rows whose text could contain the keyword, i.e. contain all of its characters"""
+        return intersect([self.text_index.get(c, EMPTY) for c in set(keyword)])
+
+    def pinyin_candidates(self, pinyin: str) -> np.ndarray:
+        """rows whose pinyin could contain the given pinyin string. Interior syllables must match exactly, while the
+        first and last ones may be the suffix and prefix of a longer token."""
+        tokens = pinyin.split(" ")
+        if len(tokens) == 1:
+            preds = [lambda v: tokens[0] in v]
+        else:
+            preds = [
+                lambda v: v.endswith(tokens[0]),
+                lambda v: v.startswith(tokens[-1]),
+            ]
+        postings = [self.pinyin_index.get(t, EMPTY) for t in set(tokens[1:-1]) if t]
+        for pred in preds:
+            matched = [p for v, p in self.pinyin_index.items() if pred(v)]
+            postings.append(np.unique(np.concatenate(matched)) if matched else EMPTY)
+        return intersect(postings)
+
+    def keywords(self, keyword: str, options: list[str]) -> list[str]:
+        """normalize the search box into the keywords to match, lowercase text or pinyin"""
+        keyword, within = split_within(keyword)
+        if "Exact Match" in options or "Ends With" in options:
+            keywords = [keyword]
+        elif "Phrase" in options and within is None:
+            keywords = [keyword]
+        else:
+            keywords = keyword.split()
+        if "Pinyin" in options:
+            return [" ".join(lazy_pinyin(k)) for k in keywords]
+        return [k.lower() for k in keywords]
+
+    def match(
+        self,
+        roomid: str,
+        date_from: int,
+        date_to: int,
+        keyword: str,
+        options: list[str],
+    ) -> np.ndarray:
+        """filter segments the same way the search UI does, returns matched rows in chronological order"""
+        rows = self.prefilter(roomid, int(date_from), int(date_to))
+        column = "pinyin" if "Pinyin" in options else "text"
+        keywords = self.keywords(keyword, options)
+        contains = not ("Exact Match" in options or "Ends With" in options)
+        # narrow down by the inverted index
+        postings = [rows]
+        for k in keywords:
+            # keep the regex semantics of str.contains for keywords with special characters
+            if k and not (contains and REGEX.search(k)):
+                postings.append(
+                    self.pinyin_candidates(k)
+                    if column == "pinyin"
+                    else self.text_candidates(k)
+                )
+        rows = intersect(postings)
+        # verify candidates
+        docs = self.df[column].iloc[rows]
+        if "Exact Match" in options:
+            mask = docs == keywords[0]
+        elif "Ends With" in options:
+            mask = docs.str.endswith(keywords[0])
+        else:
+            mask = pd.Series(True, index=docs.index)
+            for k in keywords:
+                mask &= docs.str.contains(k)
+        return rows[mask.to_numpy(dtype=bool)]
+
+    def bm25_index(self, column: str) -> tuple[dict, np.ndarray]:
+        """term frequency index and document lengths for ranking, built on first use"""
+        if column not in self._bm25:
+            tokenize = ngrams if column == "text" else str.split
+            docs = self.df[column]
+            self._bm25[column] = (
+                build_tf_index(docs, tokenize),
+                docs.map(lambda doc: len(tokenize(doc))).to_numpy(dtype=np.float32),
+            )
+        return self._bm25[column]
+
+    def bm25_stats(self, keywords: list[str], column: str) -> tuple[int, float, dict]:
+        """(number of segments, total length, {term: document frequency}) of the keywords' terms, which add up over
+        shards to the statistics of the whole corpus"""
+        index, length = self.bm25_index(column)
+        tokenize = ngrams if column == "text" else str.split
+        terms = {t for keyword in keywords for t in tokenize(keyword)}
+        return (
+            len(self),
+            float(length.sum()),
+            {t: len(index[t][0]) for t in terms if t in index},
+        )
+
+    def scores(
+        self,
+        rows: np.ndarray,
+        keywords: list[str],
+        column: str,
+        stats: tuple[int, float, dict] | None = None,
+    ) -> np.ndarray:
+        """BM25 scores of the keywords for the given sorted rows. The idf and average length come from `stats` if
+        given, see bm25_stats()."""
+        index, length = self.bm25_index(column)
+        tokenize = ngrams if column == "text" else str.split
+        terms = [t for keyword in keywords for t in tokenize(keyword)]
+        n, total, dfs = stats or self.bm25_stats(keywords, column)
+        avgdl = total / n if n else 1.0
+        scores = np.zeros(len(rows), dtype=np.float32)
+        for term in terms:
+            if term not in index:
+                continue
+            doc, tf = index[term]
+            df = dfs.get(term, len(doc))
+            idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+            # scatter the posting list onto the matched rows
+            pos = np.searchsorted(rows, doc)
+            hit = pos < len(rows)
+            hit[hit] = rows[pos[hit]] == doc[hit]
+            tf, dl = tf[hit], length[doc[hit]]
+            scores[pos[hit]] += (
+                idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * dl / avgdl))
+            )
+        return scores
+
+    def positional_index(self, column: str) -> tuple[dict, np.ndarray, np.ndarray]:
+        """{token: stream offsets}, first offset and token count of every row, recordings one apart"""
+        if column not in self._positions:
+            tokenize = characters if column == "text" else str.split
+            tokens = [tokenize(doc) for doc in self.df[column]]
+            sizes = np.array([len(t) for t in tokens], dtype=np.int64)
+            rid = self.df["rid"].to_numpy()
+            step = sizes.copy()
+            step[:-1] += rid[1:] != rid[:-1]
+            starts = np.cumsum(step) - step
+            offsets = ranges(starts, sizes)
+            codes, uniques = pd.factorize(
+                np.array([t for doc in tokens for t in doc], dtype=object)
+            )
+            order = np.argsort(codes, kind="stable")
+            bounds = np.concatenate([[0], np.cumsum(np.bincount(codes))])
+            index = {
+                token: offsets[order[bounds[i] : bounds[i + 1]]]
+                for i, token in enumerate(uniques)
+            }
+            self._positions[column] = (index, starts, sizes)
+        return self._positions[column]
+
+    def occurrences(self, keyword: str, column: str) -> tuple[np.ndarray, np.ndarray]:
+        """rows of the first and the last token of every occurrence of the keyword in the streams, and the time it
+        starts at, interpolated within its segment"""
+        index, starts, sizes = self.positional_index(column)
+        tokens = characters(keyword) if column == "text" else keyword.split()
+        offsets = intersect(
+            [index.get(t, EMPTY).astype(np.int64) - i for i, t in enumerate(tokens)]
+        )
+        first = np.searchsorted(starts, offsets, "right") - 1
+        last = np.searchsorted(starts, offsets + len(tokens) - 1, "right") - 1
+        start, end = self.df["start"].to_numpy(), self.df["end"].to_numpy()
+        fraction = (offsets - starts[first]) / np.maximum(sizes[first], 1)
+        time = start[first] + (end[first] - start[first]) * fraction
+        return np.stack([first, last]), time
+
+    def spans(
+        self,
+        roomid: str,
+        date_from: int,
+        date_to: int,
+        keyword: str,
+        options: list[str],
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """first and last rows of the phrase matches, which may run over segments, in chronological order"""
+        rows = self.prefilter(roomid, int(date_from), int(date_to))
+        column = "pinyin" if "Pinyin" in options else "text"
+        keywords = [k for k in self.keywords(keyword, options) if k.strip()]
+        if not keywords:
+            return rows, rows
+        allowed = np.zeros(len(self), dtype=bool)
+        allowed[rows] = True
+        rid = self.df["rid"].to_numpy()
+        found = []
+        for k in keywords:
+            (first, last), time = self.occurrences(k, column)
+            keep = allowed[first]
+            found.append((first[keep], last[keep], time[keep]))
+        # only recordings with all of the keywords
+        recordings = intersect([np.unique(rid[first]) for first, _, _ in found])
+        events = [
+            (first[mask], last[mask], time[mask], np.full(mask.sum(), i))
+            for i, (first, last, time) in enumerate(found)
+            for mask in [np.isin(rid[first], recordings)]
+        ]
+        first, last, time, which = (np.concatenate(e) for e in zip(*events))
+        if len(keywords) == 1:
+            # occurrences within the same segments are one match
+            unique = np.unique(first * len(self) + last)
+            return unique // len(self), unique % len(self)
+        # shortest windows with all of the keywords, one after the other
+        _, within = split_within(keyword)
+        order = np.lexsort((time, rid[first]))
+        first, last, time, which = first[order], last[order], time[order], which[order]
+        recording = rid[first].tolist()
+        times, whiches = time.tolist(), which.tolist()
+        spans = []
+        counts, have, left = [0] * len(keywords), 0, 0
+        for right in range(len(times)):
+            if recording[right] != recording[left]:
+                counts, have, left = [0] * len(keywords), 0, right
+            counts[whiches[right]] += 1
+            have += counts[whiches[right]] == 1
+            while times[right] - times[left] > within:
+                counts[whiches[left]] -= 1
+                have -= counts[whiches[left]] == 0
+                left += 1
+            if have == len(keywords):
+                spans.append(
+                    (first[left : right + 1].min(), last[left : right + 1].max())
+                )
+                counts, have, left = [0] * len(keywords), 0, right + 1
+        if not spans:
+            return EMPTY, EMPTY
+        first, last = np.array(spans, dtype=np.int64).T
+        order = np.argsort(first, kind="stable")
+        return first[order], last[order]
+
+    def rows(self, first: np.ndarray, last: np.ndarray) -> pd.DataFrame:
+        """the matches from their first to their last segment as rows, with the text of all of them"""
+        df = self.df.iloc[first].reset_index(drop=True)
+        df["end"] = self.df["end"].to_numpy()[last]
+        for column, sep in [("text", ""), ("pinyin", " ")]:
+            docs = self.df[column]
+            values = df[column].to_numpy(copy=True)
+            for i in np.flatnonzero(last > first):
+                values[i] = sep.join(docs.iloc[first[i] : last[i] + 1])
+            df[column] = values
+        return df
+
+    def search(
+        self,
+        roomid: str,
+        date_from: int,
+        date_to: int,
+        keyword: str,
+        options: list[str],
+        order: str = "Chronological",
+        limit: int | None = None,
+        stats: tuple[int, float, dict] | None = None,
+    ) -> tuple[pd.DataFrame, int]:
+        """The first `limit` matches in the given order, and the total number of matches. A match is a segment, or
+        the segments a phrase or a "~N" proximity search matched across. Ordered by relevance, the matches have the
+        sum of the BM25 scores of their segments in a "score" column."""
+        if "Exact Match" in options or "Ends With" in options:
+            spanning = False
+        else:
+            spanning = "Phrase" in options or split_within(keyword)[1] is not None
+        if spanning:
+            first, last = self.spans(roomid, date_from, date_to, keyword, options)
+        else:
+            first = last = self.match(roomid, date_from, date_to, keyword, options)
+        total = len(first)
+        limit = total if limit is None else limit
+        if order == "Relevance":
+            column = "pinyin" if "Pinyin" in options else "text"
+            sizes = last - first + 1
+            rows, inverse = np.unique(ranges(first, sizes), return_inverse=True)
+            scores = self.scores(rows, self.keywords(keyword, options), column, stats)
+            # the score of a match is summed over its segments
+            scores = (
+                np.add.reduceat(scores[inverse], np.cumsum(sizes) - sizes)
+                if total
+                else scores
+            )
+            top = top_k(scores, limit)
+            df = self.rows(first[top], last[top])
+            df["score"] = scores[top]
+            return df, total
+        return self.rows(first[:limit], last[:limit]), total
+
+    def segments(self, base_name: str) -> pd.DataFrame:
+        """all segments of a recording in order, empty if it has none"""
+        if base_name not in self.recordings:
+            return self.df.iloc[:0]
+        rid = self.recordings.index(base_name)
+        rows = np.flatnonzero(self.df["rid"].to_numpy() == rid)
+        return self.df.iloc[rows].reset_index(drop=True)
+
+
+class ShardedStore:
+    """transcript stores sharded by room and month, loaded on first use and searched in parallel"""
+
+    def __init__(self, manifest: dict[str, dict], load) -> None:
+        """load gets the stores of a shard from its manifest entry"""
+        self.manifest = dict(
+            sorted(manifest.items(), key=lambda item: (item[1]["room"], item[0]))
+        )
+        self.load = load
+        self.rooms: list[str] = sorted({meta["room"] for meta in manifest.values()})
+        self.empty = TranscriptStore(pd.DataFrame(columns=COLUMNS))
+
+    def __len__(self) -> int:
+        return sum(meta["rows"] for meta in self.manifest.values())
+
+    def shards(self, roomid: str, date_from: int, date_to: int) -> list[str]:
+        """the shards that can have segments of the given room within [date_from, date_to], in chronological order"""
+        return [
+            shard
+            for shard, meta in self.manifest.items()
+            if (roomid == "all" or meta["room"] == roomid)
+            and (
+                meta["month"] is None
+                or int(date_from) // 100 <= meta["month"] <= int(date_to) // 100
+            )
+        ]
+
+    def stores(self, shards: list[str]) -> list[list[TranscriptStore]]:
+        """the non-empty stores of each shard"""
+        return [
+            [store for store in stores if len(store)]
+            for stores in POOL.map(
+                lambda shard: self.load(shard, self.manifest[shard]), shards
+            )
+        ]
+
+    def search(
+        self,
+        roomid: str,
+        date_from: int,
+        date_to: int,
+        keyword: str,
+        options: list[str],
+        order: str = "Chronological",
+        limit: int | None = None,
+    ) -> tuple[pd.DataFrame, int]:
+        """same as TranscriptStore.search over the shards"""
+        groups = self.stores(self.shards(roomid, date_from, date_to))
+        stores = [store for group in groups for store in group]
+        if not stores:
+            df = self.empty.df.copy()
+            if order == "Relevance":
+                df["score"] = np.zeros(0, dtype=np.float32)
+            return df, 0
+        stats = None
+        if order == "Relevance":
+            column = "pinyin" if "Pinyin" in options else "text"
+            keywords = stores[0].keywords(keyword, options)
+            parts = list(POOL.map(lambda s: s.bm25_stats(keywords, column), stores))
+            dfs = {}
+            for _, _, part in parts:
+                for term, df in part.items():
+                    dfs[term] = dfs.get(term, 0) + df
+            stats = (sum(p[0] for p in parts), sum(p[1] for p in parts), dfs)
+        results = list(
+            POOL.map(
+                lambda s: s.search(
+                    roomid, date_from, date_to, keyword, options, order, limit, stats
+                ),
+                stores,
+            )
+        )
+        total = sum(t for _, t in results)
+        df = pd.concat([r for r, _ in results], ignore_index=True)
+        if any(len(group) > 1 for group in groups):
+            # rows of a shard and its delta interleave
+            df = df.sort_values(["roomid", "date", "basename", "start"], kind="stable")
+        if order == "Relevance":
+            # stable, so ties stay in chronological order
+            df = df.sort_values("score", ascending=False, kind="stable")
+        return df.iloc[:limit].reset_index(drop=True), total
+
+    def segments(self, base_name: str) -> pd.DataFrame:
+        """all segments of a recording in order, empty if it has none"""
+        roomid, date = (base_name.split("_") + [""])[:2]
+        month = int(date) // 100 if date.isdigit() else None
+        for shard, meta in self.manifest.items():
+            if meta["room"] == roomid and meta["month"] in [None, month]:
+                parts = [store.segments(base_name) for store in self.load(shard, meta)]
+                parts = [part for part in parts if len(part)] or parts[:1]
+                if len(parts) == 1:
+                    return parts[0]
+                # parts of the recording in the shard and in its delta
+                df = pd.concat(parts, ignore_index=True)
+                return df.sort_values("start", kind="stable", ignore_index=True)
+        return self.empty.df
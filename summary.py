@@ -1,34 +1,50 @@
-import os, json
-from utils import (
-    VIDEO_DIR_LIST,
-    AUDIO_DIR,
-    DEMUCS_DIR,
-    EXCLUDELIST,
-    VOCAL_DIR,
-    TRANSCRIPT_DIR,
-    get_duration,
-    msg,
-    highlight,
-)
-
-
-def main() -> None:
+import os, json, metrics, fingerprint, utils
+from status import StatusEngine
+from utils import msg, highlight
+
+
+# in TMP_DIR
+SUMMARY = "summary.json"
+
+
+def main(engine: StatusEngine | None = None, exporter: metrics.Metrics | None = None) -> None:
+    # get durations of all files, only new or modified files are probed
+    # a long running caller passes its engine and exporter to keep them warm between runs
+    engine = engine or StatusEngine()
+    engine.seen.clear()
+    engine.probed = 0
+    video_files = engine.durations(utils.VIDEO_DIR_LIST, (".mp4", ".flv"))
+    audio_files = engine.durations([utils.AUDIO_DIR], ".m4a")
+    vocal_files = engine.durations([utils.VOCAL_DIR], ".mp3")
+    wav_files = engine.durations([utils.DEMUCS_DIR], "_vocals.wav")
+    transcript_files = engine.durations([utils.TRANSCRIPT_DIR], ".json")
+    engine.save()
+    report = {"probed": engine.probed}
+
     # get exclude info
     exclude = {}
     try:
-        with open(EXCLUDELIST, "r") as f:
+        with open(utils.EXCLUDELIST, "r") as f:
             exclude_list = f.read().splitlines()
             for file in exclude_list:
                 base_name = os.path.splitext(file)[0]
-                duration = get_duration(os.path.join(AUDIO_DIR, file))
+                duration = audio_files.get(os.path.join(utils.AUDIO_DIR, file), 0)
                 if duration:
                     exclude[base_name] = duration
     except FileNotFoundError:
         pass
+    # duplicates of other recordings are excluded as well
+    duplicates = fingerprint.duplicates()
+    report["duplicates"] = duplicates
+    for file, duration in audio_files.items():
+        base_name = os.path.splitext(os.path.basename(file))[0]
+        if base_name.split("_part_")[0] in duplicates and duration:
+            exclude[base_name] = duration
 
     # print exclude info
-    msg("Summary", "Exclude", f"{len(exclude)} excluded")
+    msg("Summary", "Exclude", f"{len(exclude)} excluded, {len(duplicates)} duplicate recordings")
     top_n = [(k, exclude[k]) for k in sorted(exclude, key=exclude.get, reverse=True)]
+    report["exclude"] = {"count": len(exclude), "top": top_n[:5]}
     for i in range(min(5, len(top_n))):
         msg(
             "Summary",
@@ -39,21 +55,17 @@ def main() -> None:
 
     # get video info
     video = {}
-    for dir in VIDEO_DIR_LIST:
-        for file in os.listdir(dir):
-            if file.endswith(".mp4") or file.endswith(".flv"):
-                base_name = os.path.splitext(file)[0]
-                duration = get_duration(os.path.join(dir, file))
-                if duration:
-                    video[base_name] = duration
+    for file, duration in video_files.items():
+        base_name = os.path.splitext(os.path.basename(file))[0]
+        if duration:
+            video[base_name] = duration
 
     # get audio info
     audio = {}
-    for file in os.listdir(AUDIO_DIR):
-        base_name = os.path.splitext(file)[0]
-        if file.endswith(".m4a") and base_name not in exclude:
+    for file, duration in audio_files.items():
+        base_name = os.path.splitext(os.path.basename(file))[0]
+        if base_name not in exclude:
             bare_name = base_name.split("_part_")[0]
-            duration = get_duration(os.path.join(AUDIO_DIR, file))
             if duration:
                 if bare_name in audio:
                     audio[bare_name] += duration
@@ -62,6 +74,7 @@ def main() -> None:
 
     # compare video and audio
     diff_va = set(video.keys()) - set(audio.keys()) - set(exclude.keys())
+    report["audio"] = {"video_without_audio": sorted(diff_va)}
     msg(
         "Summary",
         "Audio",
@@ -70,6 +83,7 @@ def main() -> None:
     for i in range(min(5, len(diff_va))):
         msg("Summary", "Audio", f"Video without audio #{i+1}:", f"{diff_va.pop()}")
     diff_av = (set(audio.keys()) | set(exclude.keys())) - set(video.keys())
+    report["audio"]["audio_without_video"] = sorted(diff_av)
     msg(
         "Summary",
         "Audio",
@@ -79,6 +93,7 @@ def main() -> None:
         msg("Summary", "Audio", f"Audio without video #{i+1}:", f"{diff_av.pop()}")
     diff_duration = {_: abs(video[_] - audio[_]) for _ in set(video.keys()) & set(audio.keys())}
     top_n = [(k, diff_duration[k]) for k in sorted(diff_duration, key=diff_duration.get, reverse=True)]
+    report["audio"]["inconsistency"] = top_n[:5]
     for i in range(min(5, len(top_n))):
         msg(
             "Summary",
@@ -89,15 +104,14 @@ def main() -> None:
 
     # get vocal info
     vocal = {}
-    for file in os.listdir(VOCAL_DIR):
-        if file.endswith(".mp3"):
-            base_name = os.path.splitext(file)[0]
-            duration = get_duration(os.path.join(VOCAL_DIR, file))
-            if duration:
-                vocal[base_name] = duration
+    for file, duration in vocal_files.items():
+        base_name = os.path.splitext(os.path.basename(file))[0]
+        if duration:
+            vocal[base_name] = duration
 
     # compare audio and vocal
     diff_av = set(audio.keys()) - set(vocal.keys())
+    report["vocal"] = {"audio_without_vocal": sorted(diff_av)}
     msg(
         "Summary",
         "Vocal",
@@ -106,6 +120,7 @@ def main() -> None:
     for i in range(min(5, len(diff_av))):
         msg("Summary", "Vocal", f"Audio without vocal #{i+1}:", f"{diff_av.pop()}")
     diff_va = set(vocal.keys()) - set(audio.keys())
+    report["vocal"]["vocal_without_audio"] = sorted(diff_va)
     msg(
         "Summary",
         "Vocal",
@@ -115,6 +130,7 @@ def main() -> None:
         msg("Summary", "Vocal", f"Vocal without audio #{i+1}:", f"{diff_va.pop()}")
     diff_duration = {_: abs(audio[_] - vocal[_]) for _ in set(audio.keys()) & set(vocal.keys())}
     top_n = [(k, diff_duration[k]) for k in sorted(diff_duration, key=diff_duration.get, reverse=True)]
+    report["vocal"]["inconsistency"] = top_n[:5]
     for i in range(min(5, len(top_n))):
         msg(
             "Summary",
@@ -125,17 +141,18 @@ def main() -> None:
 
     # get transcript info
     transcript = {}
-    for file in os.listdir(TRANSCRIPT_DIR):
-        if file.endswith(".json"):
-            base_name = os.path.splitext(file)[0]
-            transcript[base_name] = get_duration(os.path.join(TRANSCRIPT_DIR, file))
+    for file, duration in transcript_files.items():
+        base_name = os.path.splitext(os.path.basename(file))[0]
+        transcript[base_name] = duration
 
     # compare vocal and transcript
     diff_vt = set(vocal.keys()) - set(transcript.keys())
-    cached = 0
-    for file in os.listdir(DEMUCS_DIR):
-        if file.endswith("_vocals.wav"):
-            cached += get_duration(os.path.join(DEMUCS_DIR, file))
+    cached = sum(wav_files.values())
+    report["transcript"] = {
+        "vocal_without_transcript": sorted(diff_vt),
+        "pending_hours": sum([vocal[k] for k in diff_vt]) / 3600,
+        "cached_hours": cached / 3600,
+    }
     msg(
         "Summary",
         "Transcript",
@@ -149,6 +166,7 @@ def main() -> None:
             f"{diff_vt.pop()}",
         )
     diff_tv = set(transcript.keys()) - set(vocal.keys())
+    report["transcript"]["transcript_without_vocal"] = sorted(diff_tv)
     msg(
         "Summary",
         "Transcript",
@@ -163,6 +181,7 @@ def main() -> None:
         )
     diff_duration = {_: abs(vocal[_] - transcript[_]) for _ in set(vocal.keys()) & set(transcript.keys())}
     top_n = [(k, diff_duration[k]) for k in sorted(diff_duration, key=diff_duration.get, reverse=True)]
+    report["transcript"]["inconsistency"] = top_n[:5]
     for i in range(min(5, len(top_n))):
         msg(
             "Summary",
@@ -178,6 +197,42 @@ def main() -> None:
         f"Transcribed {transcribed_duration / 3600:.1f} h in total, {(total_duration - transcribed_duration) / 3600:.1f} h remaining",
     )
 
+    report["transcribed_hours"] = transcribed_duration / 3600
+    report["remaining_hours"] = (total_duration - transcribed_duration) / 3600
+
+    # stage of each item
+    report["items"] = {}
+    for bare_name in set(video) | set(audio) | set(vocal) | set(transcript):
+        if bare_name in transcript:
+            stage = "transcript"
+        elif bare_name in vocal:
+            stage = "vocal"
+        elif bare_name in audio:
+            stage = "audio"
+        elif bare_name in exclude:
+            stage = "excluded"
+        else:
+            stage = "video"
+        report["items"][bare_name] = {
+            "stage": stage,
+            "video": video.get(bare_name),
+            "audio": audio.get(bare_name),
+            "vocal": vocal.get(bare_name),
+            "transcript": transcript.get(bare_name),
+        }
+
+    # queue depth of each stage
+    metrics.gauge("audio", "queue_depth", len(report["audio"]["video_without_audio"]))
+    metrics.gauge("demucs", "queue_depth", len(report["vocal"]["audio_without_vocal"]))
+    metrics.gauge("transcribe", "queue_depth", len(report["transcript"]["vocal_without_transcript"]))
+    (exporter or metrics.Metrics()).export()
+
+    # machine-readable summary
+    summary = os.path.join(utils.TMP_DIR, SUMMARY)
+    with open(summary + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    os.replace(summary + ".tmp", summary)
+
     # ending message
     msg("Summary", "Done", "-" * 32)
 
@@ -0,0 +1,26 @@
+import os, sys, json, pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    """a config.json with its work directories in a temporary directory, loaded into utils"""
+    video_dir = tmp_path / "video"
+    out_dir = tmp_path / "out"
+    video_dir.mkdir()
+    out_dir.mkdir()
+    file = tmp_path / "config.json"
+    file.write_text(
+        json.dumps(
+            {
+                "video_dir_list": [str(video_dir)],
+                "out_dir": str(out_dir),
+                "part_duration": 600,
+            }
+        )
+    )
+    monkeypatch.chdir(tmp_path)
+    utils.reload_config(str(file))
+    return utils.config
@@ -0,0 +1,39 @@
+import pytest
+from fastapi import HTTPException
+from api import parse_range
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=10-19", (10, 19)),
+        ("bytes=10-", (10, 99)),
+        ("bytes=90-500", (90, 99)),
+        ("bytes=-10", (90, 99)),
+        # a suffix longer than the file is all of it
+        ("bytes=-100", (0, 99)),
+        ("bytes=-500", (0, 99)),
+        ("bytes = 5-6", (5, 6)),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize(
+    "header", ["bytes=0-1,5-6", "items=0-10", "bytes=a-b", "bytes=-", "bytes=x-"]
+)
+def test_parse_range_ignores_what_it_doesnt_serve(header):
+    assert parse_range(header, 100) is None
+
+
+@pytest.mark.parametrize(
+    "header, size",
+    [("bytes=100-", 100), ("bytes=20-10", 100), ("bytes=-0", 100), ("bytes=-5", 0)],
+)
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(HTTPException) as e:
+        parse_range(header, size)
+    assert e.value.status_code == 416
+    assert e.value.headers["Content-Range"] == f"bytes */{size}"
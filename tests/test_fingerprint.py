@@ -0,0 +1,51 @@
+import numpy as np
+import fingerprint
+
+
+def keys(n: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 1 << 16, n).astype(np.int32)
+
+
+def test_compare_aligned_copy():
+    a = keys(500)
+    assert fingerprint.compare(a, a.copy(), 0) == (0.0, 500)
+
+
+def test_compare_finds_the_offset_of_a_contained_copy():
+    a = keys(300)
+    b = np.concatenate([keys(120, seed=1), a, keys(80, seed=2)])
+    assert fingerprint.compare(a, b, 120) == (0.0, 300)
+    # b's frame i - 120 is a's frame i, so seen from b the offset is negative
+    assert fingerprint.compare(b, a, -120) == (0.0, 300)
+    ber, overlap = fingerprint.compare(a, b, 0)
+    assert overlap == 300 and abs(ber - 0.5) < 0.05
+
+
+def test_compare_counts_partial_overlap():
+    a, b = keys(100), keys(100, seed=1)
+    b[:40] = a[60:]
+    assert fingerprint.compare(a, b, -60) == (0.0, 40)
+    assert fingerprint.compare(a, b, 100) == (1.0, 0)
+    assert fingerprint.compare(a, b, -100) == (1.0, 0)
+
+
+def test_compare_tolerates_bit_errors_and_skips_silence():
+    a = keys(1000)
+    b = a ^ (1 << np.random.default_rng(3).integers(0, 16, 1000))
+    ber, _ = fingerprint.compare(a, b, 0)
+    assert abs(ber - 1 / 16) < 1e-9
+    assert ber < fingerprint.MAX_BER
+    # silent frames don't count as errors, all silent is no match
+    c = a.copy()
+    c[::2] = -1
+    assert fingerprint.compare(a, c, 0) == (0.0, 1000)
+    assert fingerprint.compare(a, np.full(1000, -1), 0) == (1.0, 0)
+
+
+def test_anchors_are_chosen_by_value():
+    a = keys(4000)
+    b = np.concatenate([keys(77, seed=1), a])
+    shifted = fingerprint.anchors(b)
+    assert np.array_equal(shifted[shifted >= 77] - 77, fingerprint.anchors(a))
+    rate = len(fingerprint.anchors(a)) / len(a)
+    assert abs(rate - 2**-fingerprint.ANCHOR_BITS) < 0.03
@@ -0,0 +1,65 @@
+import pytest
+import journal
+
+
+@pytest.fixture
+def clock(config, monkeypatch):
+    """a settable time.time() for journal"""
+    now = [1_000_000.0]
+    monkeypatch.setattr(journal.time, "time", lambda: now[0])
+    return now
+
+
+def fail(stage: str = "demucs", job: str = "a", error: Exception | None = None):
+    with pytest.raises(Exception):
+        with journal.attempt(stage, job):
+            raise error or RuntimeError("broken")
+
+
+def test_backoff_doubles_up_to_the_limit(clock, config):
+    config["journal"] = {"attempts": 10, "backoff": 600, "max_backoff": 3000}
+    waits = []
+    for _ in range(5):
+        fail()
+        entry = journal.load("demucs", "a")
+        waits.append(entry["retry_at"] - clock[0])
+        assert journal.blocked("demucs", "a")
+        clock[0] = entry["retry_at"]
+        assert not journal.blocked("demucs", "a")
+    assert waits == [600, 1200, 2400, 3000, 3000]
+    assert entry["attempts"] == 5 and entry["error"] == "RuntimeError"
+
+
+def test_quarantined_after_attempts(clock):
+    for attempt in range(3):
+        fail()
+        assert journal.load("demucs", "a")["quarantined"] == (attempt == 2)
+        clock[0] += 86400
+    assert journal.blocked("demucs", "a")
+    journal.release("demucs", "a")
+    assert not journal.blocked("demucs", "a")
+
+
+def test_quarantine_right_away(clock):
+    with pytest.raises(ValueError):
+        with journal.attempt("demucs", "a") as options:
+            options["quarantine"] = True
+            raise ValueError("no speech")
+    assert journal.load("demucs", "a")["quarantined"]
+
+
+def test_success_clears_and_transient_errors_dont_count(clock):
+    fail()
+    with journal.attempt("demucs", "a"):
+        pass
+    assert journal.load("demucs", "a") is None
+    fail(error=RuntimeError("CUDA out of memory"))
+    assert journal.load("demucs", "a") is None
+    assert not journal.blocked("demucs", "a")
+
+
+def test_retry_makes_the_job_due(clock):
+    fail()
+    journal.retry("demucs", "a")
+    assert not journal.blocked("demucs", "a")
+    assert journal.load("demucs", "a")["attempts"] == 1
@@ -0,0 +1,55 @@
+import os, time, pytest
+import lease
+
+
+@pytest.fixture
+def leases(tmp_path):
+    # a long ttl keeps the heartbeats quiet, expiry is simulated by aging the lease file
+    return lease.FileLeases(str(tmp_path / "lease"), ttl=60)
+
+
+def expire(leases, stage: str, item: str) -> None:
+    old = time.time() - 2 * leases.ttl
+    os.utime(leases.path(stage, item), (old, old))
+
+
+def test_live_lease_is_exclusive(leases):
+    first = leases.acquire("demucs", "a")
+    assert first
+    assert leases.acquire("demucs", "a") is None
+    assert leases.held("demucs", "a")
+    assert leases.acquire("demucs", "b")
+    first.release()
+    assert not leases.held("demucs", "a")
+    assert leases.acquire("demucs", "a")
+
+
+def test_stale_lease_is_taken_over(leases, tmp_path):
+    first = leases.acquire("demucs", "a")
+    expire(leases, "demucs", "a")
+    assert not leases.held("demucs", "a")
+    second = leases.acquire("demucs", "a")
+    assert second and second.owner != first.owner
+    assert leases.read(leases.path("demucs", "a"))["owner"] == second.owner
+    # the old holder finds out on its next renewal and its output is dropped
+    assert not leases.renew(first)
+    src, dst = tmp_path / "first.tmp", tmp_path / "out"
+    src.write_text("first")
+    assert not first.publish(str(src), str(dst))
+    assert not src.exists() and not dst.exists()
+    src.write_text("second")
+    assert second.publish(str(src), str(dst))
+    assert dst.read_text() == "second"
+    # releasing the lost lease leaves the new holder's alone
+    first.release()
+    assert leases.held("demucs", "a")
+    second.release()
+    assert not os.listdir(os.path.dirname(leases.path("demucs", "a")))
+
+
+def test_renewed_lease_is_not_taken_over(leases):
+    first = leases.acquire("demucs", "a")
+    expire(leases, "demucs", "a")
+    assert leases.renew(first)
+    assert leases.acquire("demucs", "a") is None
+    first.release()
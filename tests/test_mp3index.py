@@ -0,0 +1,60 @@
+import os, ffmpeg, pytest
+import numpy as np
+import mp3index, utils
+
+
+FRAME = 1152 / 44100
+
+
+@pytest.fixture
+def mp3(config):
+    """5 s of a tone as a 64 kbps mp3 with an ID3 tag and a Xing frame, like the vocals"""
+    file = os.path.join(utils.VOCAL_DIR, "111_20220101_x.mp3")
+    ffmpeg.input("sine=frequency=440:duration=5", f="lavfi").output(
+        file, acodec="libmp3lame", ar=44100, ac=1, audio_bitrate="64k"
+    ).run(quiet=True)
+    return file
+
+
+def test_index_covers_every_frame(mp3):
+    offsets, times = mp3index.build_index(mp3)
+    assert np.allclose(np.diff(times), FRAME)
+    assert 5 <= times[-1] < 5 + 3 * FRAME
+    assert offsets[-1] == os.path.getsize(mp3)
+    with open(mp3, "rb") as f:
+        data = f.read()
+    for a, b in zip(offsets[:-1], offsets[1:]):
+        length, _, _ = mp3index.parse_header(int.from_bytes(data[a : a + 4], "big"))
+        assert b - a == length
+
+
+@pytest.mark.parametrize(
+    "start, end", [(0, 1), (1.234, 2.5), (2.0, 2.0), (4.5, 10), (-1, 0.5)]
+)
+def test_locate_whole_frames_covering_the_span(mp3, start, end):
+    offsets, times = mp3index.build_index(mp3)
+    first, last, actual_start, actual_end = mp3index.locate(mp3, start, end)
+    assert first in offsets and last in offsets
+    assert actual_start <= max(start, 0)
+    assert actual_end >= min(end, times[-1])
+    # no more than one frame of slack on either side
+    assert max(start, 0) - actual_start < FRAME
+    assert actual_end - min(end, times[-1]) < FRAME
+    i, j = offsets.tolist().index(first), offsets.tolist().index(last)
+    assert (times[i], times[j]) == (actual_start, actual_end)
+
+
+def test_read_is_empty_out_of_range(mp3):
+    assert mp3index.read(mp3, 100, 110) == b""
+    with pytest.raises(ValueError):
+        mp3index.extract(mp3, 100, 110, os.path.join(utils.SLICE_DIR, "x.mp3"))
+
+
+def test_index_is_cached_until_the_file_changes(mp3):
+    offsets, _ = mp3index.load_index(mp3)
+    assert os.path.exists(os.path.join(utils.FRAME_DIR, "111_20220101_x.npz"))
+    with open(mp3, "ab") as f:
+        f.write(open(mp3, "rb").read()[offsets[0] : offsets[-1]])
+    longer, times = mp3index.load_index(mp3)
+    assert len(longer) == 2 * len(offsets) - 1
+    assert times[-1] > 9.9
@@ -0,0 +1,191 @@
+import heapq, random
+import numpy as np
+import pandas as pd
+import pytest
+from pypinyin import lazy_pinyin
+from store import TranscriptStore, top_k
+
+
+WORDS = ["晚上好", "大家", "吃饭", "唱歌", "游戏", "谢谢", "礼物", "今天", "哈哈", "好难"]
+
+
+def segments(seed: int = 0) -> pd.DataFrame:
+    """random segments of a few rooms and recordings, in file order like the corpus"""
+    rng = random.Random(seed)
+    rows = []
+    for room in ["222", "111", "333"]:
+        for date in rng.sample(range(20220101, 20220131), 4):
+            base_name = f"{room}_{date}_x"
+            for i in range(30):
+                text = "".join(rng.choices(WORDS, k=rng.randint(1, 4)))
+                rows.append(
+                    {
+                        "roomid": room,
+                        "basename": base_name,
+                        "start": i * 5.0,
+                        "end": i * 5.0 + 4,
+                        "text": text.lower(),
+                        "pinyin": " ".join(lazy_pinyin(text)),
+                    }
+                )
+    return pd.DataFrame(rows)
+
+
+def old_search(df, roomid, date_from, date_to, keyword, options) -> pd.DataFrame:
+    """the pandas filters of the search before the store"""
+    if roomid != "all":
+        df = df[df["roomid"] == roomid]
+    dates = df["basename"].map(lambda b: int(b.split("_")[1]))
+    df = df[(date_from <= dates) & (dates <= date_to)]
+    column = "pinyin" if "Pinyin" in options else "text"
+    convert = lambda k: " ".join(lazy_pinyin(k)) if "Pinyin" in options else k.lower()
+    if "Exact Match" in options:
+        df = df[df[column] == convert(keyword)]
+    elif "Ends With" in options:
+        df = df[df[column].str.endswith(convert(keyword))]
+    else:
+        for k in keyword.split():
+            df = df[df[column].str.contains(convert(k))]
+    return df
+
+
+def keys(df: pd.DataFrame) -> list[tuple[str, float]]:
+    return sorted(zip(df["basename"], df["start"]))
+
+
+@pytest.mark.parametrize(
+    "keyword, options",
+    [
+        ("吃饭", []),
+        ("吃饭 唱歌", []),
+        ("饭唱", []),
+        ("晚上好", ["Exact Match"]),
+        ("哈哈", ["Ends With"]),
+        ("chi fan", ["Pinyin"]),
+        ("吃饭", ["Pinyin"]),
+        ("ge you", ["Pinyin"]),
+        ("谢谢", ["Pinyin", "Ends With"]),
+        ("礼物", ["Pinyin", "Exact Match"]),
+        ("不存在", []),
+    ],
+)
+@pytest.mark.parametrize(
+    "roomid, date_from, date_to",
+    [
+        ("all", 20220101, 20770101),
+        ("111", 20220101, 20770101),
+        ("222", 20220110, 20220120),
+    ],
+)
+def test_search_matches_pandas_filters(keyword, options, roomid, date_from, date_to):
+    df = segments()
+    store = TranscriptStore(df)
+    expected = old_search(df, roomid, date_from, date_to, keyword, options)
+    result, total = store.search(roomid, date_from, date_to, keyword, options)
+    assert total == len(expected)
+    assert keys(result) == keys(expected)
+
+
+def test_search_is_chronological_per_room():
+    store = TranscriptStore(segments())
+    result, _ = store.search("all", 20220101, 20770101, "吃饭", [])
+    for _, rows in result.groupby("roomid", observed=True, sort=False):
+        order = list(zip(rows["date"], rows["basename"], rows["start"]))
+        assert order == sorted(order)
+
+
+def test_search_limit_keeps_total():
+    store = TranscriptStore(segments())
+    full, total = store.search("all", 20220101, 20770101, "大家", [])
+    page, page_total = store.search("all", 20220101, 20770101, "大家", [], limit=5)
+    assert page_total == total
+    assert page["basename"].tolist() == full["basename"].tolist()[:5]
+    assert page["start"].tolist() == full["start"].tolist()[:5]
+
+
+def ranked(texts: list[str]) -> TranscriptStore:
+    return TranscriptStore(
+        pd.DataFrame(
+            {
+                "roomid": "111",
+                "basename": "111_20220101_x",
+                "start": [i * 5.0 for i in range(len(texts))],
+                "end": [i * 5.0 + 4 for i in range(len(texts))],
+                "text": texts,
+                "pinyin": [" ".join(lazy_pinyin(t)) for t in texts],
+            }
+        )
+    )
+
+
+def test_relevance_prefers_frequent_terms_in_short_segments():
+    store = ranked(["今天吃饭了", "吃饭吃饭", "今天我们一起去外面的餐厅吃饭然后唱歌", "唱歌"])
+    result, total = store.search("all", 0, 99999999, "吃饭", [], "Relevance")
+    assert total == 3
+    assert result["text"].tolist()[0] == "吃饭吃饭"
+    assert result["text"].tolist()[-1] == "今天我们一起去外面的餐厅吃饭然后唱歌"
+    assert result["score"].is_monotonic_decreasing
+
+
+def test_relevance_ties_are_chronological():
+    store = ranked(["吃饭", "唱歌", "吃饭", "吃饭"])
+    result, _ = store.search("all", 0, 99999999, "吃饭", [], "Relevance", limit=2)
+    assert result["start"].tolist() == [0.0, 10.0]
+
+
+def test_relevance_limit_is_the_top_of_the_ranking():
+    store = TranscriptStore(segments())
+    full, total = store.search("all", 20220101, 20770101, "吃饭 大家", [], "Relevance")
+    top, top_total = store.search(
+        "all", 20220101, 20770101, "吃饭 大家", [], "Relevance", limit=7
+    )
+    assert top_total == total
+    assert keys(top) == keys(full.iloc[:7])
+    assert top["score"].tolist() == full["score"].tolist()[:7]
+
+
+@pytest.mark.parametrize("limit", [0, 1, 5, 50, 1000])
+def test_top_k_matches_nlargest(limit):
+    rng = np.random.default_rng(limit)
+    scores = rng.integers(0, 4, 300).astype(np.float32)
+    expected = heapq.nlargest(limit, range(len(scores)), key=scores.__getitem__)
+    assert top_k(scores, limit).tolist() == expected
+
+
+def test_phrase_runs_over_segments():
+    store = ranked(["今天吃", "饭了", "唱歌", "吃饭吃饭"])
+    result, total = store.search("all", 0, 99999999, "吃饭", ["Phrase"])
+    assert total == 2
+    assert result["text"].tolist() == ["今天吃饭了", "吃饭吃饭"]
+    assert result[["start", "end"]].values.tolist() == [[0, 9], [15, 19]]
+    # without Phrase a keyword has to be within a segment
+    assert store.search("all", 0, 99999999, "吃饭", [])[1] == 1
+    pinyin, total = store.search("all", 0, 99999999, "chi fan", ["Pinyin", "Phrase"])
+    assert total == 2 and pinyin["text"].tolist() == ["今天吃饭了", "吃饭吃饭"]
+
+
+def test_phrase_stays_within_a_recording():
+    df = pd.DataFrame(
+        {
+            "roomid": "111",
+            "basename": ["111_20220101_x", "111_20220102_x"],
+            "start": [0.0, 0.0],
+            "end": [4.0, 4.0],
+            "text": ["今天吃", "饭了"],
+            "pinyin": ["jin tian chi", "fan le"],
+        }
+    )
+    store = TranscriptStore(df)
+    assert store.search("all", 0, 99999999, "吃饭", ["Phrase"])[1] == 0
+    assert store.search("all", 0, 99999999, "chi fan", ["Pinyin", "Phrase"])[1] == 0
+
+
+def test_keywords_within_seconds():
+    store = ranked(["吃饭", "然后", "唱歌", "休息", "聊天", "游戏", "还有", "吃饭"])
+    result, total = store.search("all", 0, 99999999, "吃饭 唱歌 ~10", [])
+    assert total == 1
+    assert result["text"].tolist() == ["吃饭然后唱歌"]
+    assert result[["start", "end"]].values.tolist() == [[0, 14]]
+    assert store.search("all", 0, 99999999, "吃饭 唱歌 ~5", [])[1] == 0
+    assert store.search("all", 0, 99999999, "吃饭 游戏 ~10", [])[1] == 1
+    assert store.search("all", 0, 99999999, "吃饭 休息 聊天 ~40", [])[1] == 1
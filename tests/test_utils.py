@@ -0,0 +1,55 @@
+import os, pytest
+import utils
+
+
+@pytest.fixture
+def quiet(config, monkeypatch):
+    """find_quiet without decoding, 5 s into every window it's asked about"""
+    windows = []
+
+    def find_quiet(file: str, start: float, end: float) -> float:
+        windows.append((start, end))
+        return start + 5
+
+    monkeypatch.setattr(utils, "find_quiet", find_quiet)
+    monkeypatch.setattr(utils, "_plans", {})
+    return windows
+
+
+@pytest.mark.parametrize(
+    "duration, cuts",
+    [
+        (500, []),
+        (600, []),
+        # a 145 s tail is shorter than MIN_TAIL of a part and merged into the previous part
+        (690, []),
+        (800, [545]),
+        (1300, [545, 1090]),
+        (1200, [545]),
+    ],
+)
+def test_plan_cuts_merges_short_tails(quiet, duration, cuts):
+    assert utils.plan_cuts("video.mp4", duration) == cuts
+
+
+def test_plan_cuts_look_within_tolerance_of_each_part(quiet):
+    utils.plan_cuts("video.mp4", 1300)
+    assert quiet == [(540, 660), (1085, 1205)]
+
+
+def test_cuts_are_planned_only_by_extract_audio(quiet):
+    with pytest.raises(utils.NotPlanned):
+        utils.get_cuts("111_20220101_x", "video.mp4", 1300)
+    assert not os.listdir(utils.PLAN_DIR)
+    assert utils.get_cuts("111_20220101_x", "video.mp4", 1300, plan=True) == [545, 1090]
+    assert os.path.exists(os.path.join(utils.PLAN_DIR, "111_20220101_x.json"))
+    # read back from the plan without scanning again
+    utils._plans.clear()
+    assert utils.get_cuts("111_20220101_x", "video.mp4", 1300) == [545, 1090]
+    assert len(quiet) == 2
+
+
+def test_extracted_recordings_keep_uniform_cuts(quiet):
+    open(os.path.join(utils.AUDIO_DIR, "111_20220101_x_part_01.m4a"), "w").close()
+    assert utils.get_cuts("111_20220101_x", "video.mp4", 1300) == [600, 1200]
+    assert not quiet
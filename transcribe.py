@@ -1,10 +1,126 @@
-import os, sys, json, whisper, opencc, torch, time
+import os, sys, json, time, ffmpeg, media, lease, journal, metrics, priority, utils
+import numpy as np
 from multiprocessing import Process, Manager
 from io import StringIO
-from utils import VOCAL_DIR, TRANSCRIPT_DIR, TMP_DIR, get_duration, msg, valid
+from utils import msg, valid, get_audio_parts, get_part_offset
 
 
-NUM_GPU = torch.cuda.device_count()
+# whisper decodes 30 s windows, its seek is in mel frames of 10 ms
+FRAMES_PER_SECOND = 100
+SAMPLE_RATE = 16000
+# a window loops if more than LOOP_REPEAT of its LOOP_NGRAM character n-grams repeat earlier ones
+LOOP_NGRAM = 4
+LOOP_REPEAT = 0.6
+# fewer n-grams are too short to tell
+LOOP_MIN_NGRAMS = 24
+# faster than anyone speaks
+MAX_CHARS_PER_SECOND = 12
+# seconds a segment may stray out of its window
+DRIFT = 2.0
+# seconds decoded at a time, a loop is repaired before the next chunk is conditioned on it
+CHUNK = 300
+# retry looped windows without the previous text, which feeds the loop, and with sampling
+FALLBACK = {
+    "condition_on_previous_text": False,
+    "temperature": (0.2, 0.4, 0.6, 0.8, 1.0),
+    "compression_ratio_threshold": 1.8,
+}
+
+
+def part_names(bare_name: str) -> list[str]:
+    """base names of the parts of a recording in order, the bare name itself if it has one part"""
+    return [
+        os.path.splitext(os.path.basename(f))[0] for f in get_audio_parts(bare_name)
+    ]
+
+
+def part_transcript(base_name: str) -> str:
+    return os.path.join(utils.TRANSCRIPT_PART_DIR, f"{base_name}.json")
+
+
+def load_part(audio: str, offset: float, duration: float) -> np.ndarray:
+    """duration seconds of an audio file from offset, decoded the way whisper loads audio"""
+    out = media.run(
+        "decode",
+        ffmpeg.input(audio, ss=offset, t=duration)
+        .output("-", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .compile(),
+    )
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def windows(segments: list[dict]) -> list[list[dict]]:
+    """group consecutive segments by the whisper window they were decoded in"""
+    groups: list[list[dict]] = []
+    for segment in segments:
+        if groups and groups[-1][0]["seek"] == segment["seek"]:
+            groups[-1].append(segment)
+        else:
+            groups.append([segment])
+    return groups
+
+
+def looped(segments: list[dict], start: float, end: float) -> str | None:
+    """why the window looks like a hallucination loop, "repetition" or "timestamps", None if it doesn't"""
+    text = "".join(segment["text"].strip() for segment in segments)
+    ngrams = [text[i : i + LOOP_NGRAM] for i in range(len(text) - LOOP_NGRAM + 1)]
+    if (
+        len(ngrams) >= LOOP_MIN_NGRAMS
+        and 1 - len(set(ngrams)) / len(ngrams) > LOOP_REPEAT
+    ):
+        return "repetition"
+    for segment in segments:
+        if (
+            segment["end"] < segment["start"]
+            or segment["start"] < start - DRIFT
+            or segment["end"] > end + DRIFT
+        ):
+            return "timestamps"
+    if len(text) > MAX_CHARS_PER_SECOND * max(end - start, 1):
+        return "timestamps"
+    return None
+
+
+def collapse(segments: list[dict], start: float, end: float) -> list[dict]:
+    """the segments without repeated texts, clamped into the window"""
+    texts, result = set(), []
+    for segment in segments:
+        text = segment["text"].strip()
+        if text in texts:
+            continue
+        texts.add(text)
+        segment["start"] = min(max(segment["start"], start), end)
+        segment["end"] = min(max(segment["end"], segment["start"]), end)
+        result.append(segment)
+    return result
+
+
+def merge(bare_name: str) -> bool:
+    """merge the part transcripts once all are done, call it only after the vocal is assembled"""
+    parts = [part_transcript(base_name) for base_name in part_names(bare_name)]
+    if not all(os.path.exists(part) for part in parts):
+        return False
+    result = {"text": "", "segments": []}
+    for part in parts:
+        with open(part, encoding="utf-8") as f:
+            data = json.load(f)
+        result["text"] += data["text"]
+        for segment in data["segments"]:
+            segment["id"] = len(result["segments"])
+            result["segments"].append(segment)
+        result.setdefault("language", data.get("language"))
+    transcript = os.path.join(utils.TRANSCRIPT_DIR, f"{bare_name}.json")
+    tmp = f"{transcript}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+    os.replace(tmp, transcript)
+    for part in parts:
+        try:
+            os.remove(part)
+        except FileNotFoundError:
+            pass
+    msg("Xscribe", "Merged", f"{len(parts)} parts", file=transcript)
+    return True
 
 
 class TqdmOut(StringIO):
@@ -44,6 +160,8 @@ class Worker:
         self.gpu_id = gpu_id
         self.state = state
         self.model = None
+        import opencc
+
         self.converter = opencc.OpenCC("t2s.json")
 
     def __call__(self) -> None:
@@ -58,54 +176,166 @@ class Worker:
     def main(self) -> None:
         while True:
             if self.state["task"]:
-                vocal, transcript = self.state["task"]
-                msg(f" GPU {self.gpu_id} ", "Xscribing", file=vocal)
+                source, transcript = self.state["task"]
+                base_name = os.path.basename(transcript)[:-5]
+                bare_name = base_name.split("_part_")[0]
+                # claim the part so that other nodes skip it, then check again as it may have been finished meanwhile
+                claim = lease.acquire("transcribe", base_name)
+                if (
+                    not claim
+                    or os.path.exists(transcript)
+                    or valid(bare_name, "transcript")
+                    or journal.blocked("transcribe", base_name)
+                ):
+                    if claim:
+                        claim.release()
+                    self.state["task"] = None
+                    continue
+                msg(f" GPU {self.gpu_id} ", "Xscribing", file=transcript)
                 start_time = time.time()
-                try:
-                    self.transcribe(vocal, transcript)
-                except (Exception, KeyboardInterrupt) as e:
+                with claim, metrics.span(
+                    "transcribe",
+                    base_name,
+                    f"cuda:{self.gpu_id}",
+                    self.state["queued"],
+                ) as record, journal.attempt("transcribe", base_name):
+                    record["bytes"] = os.path.getsize(source)
+                    record["audio_seconds"] = get_audio_parts(bare_name)[
+                        os.path.join(utils.AUDIO_DIR, f"{base_name}.m4a")
+                    ]
+                    offset = get_part_offset(base_name)
                     try:
-                        os.remove(transcript)
-                    except:
-                        pass
-                    if isinstance(e, Exception):
-                        msg(
-                            f" GPU {self.gpu_id} ",
-                            "transcribe() Crashed",
-                            file=vocal,
-                            error=True,
+                        # the assembled vocal holds all parts, separated parts start at 0
+                        audio = load_part(
+                            source,
+                            offset if source.endswith(".mp3") else 0.0,
+                            record["audio_seconds"],
                         )
-                    raise
+                        self.transcribe(audio, transcript, offset, claim)
+                    except (Exception, KeyboardInterrupt) as e:
+                        if isinstance(e, Exception):
+                            msg(
+                                f" GPU {self.gpu_id} ",
+                                "transcribe() Crashed",
+                                file=transcript,
+                                error=True,
+                            )
+                            # leave the part to the watcher, so the restarted worker doesn't retry it before its back-off
+                            self.state["task"] = None
+                        raise
                 end_time = time.time()
-                speed = get_duration(vocal) / (end_time - start_time)
+                speed = record["audio_seconds"] / (end_time - start_time)
                 msg(
                     f" GPU {self.gpu_id} ",
                     "Xscribed",
                     f"({speed:.0f}X)",
-                    file=vocal,
+                    file=transcript,
                 )
+                # the last part completes the transcript
+                if valid(bare_name, "vocal"):
+                    merge(bare_name)
                 self.state["task"] = None
                 self.state["progress"] = "n/a"
             time.sleep(5)
 
-    def transcribe(self, vocal: str, transcript: str) -> None:
+    def transcribe(
+        self,
+        audio: np.ndarray,
+        transcript: str,
+        offset: float = 0.0,
+        claim: lease.Lease | None = None,
+    ) -> None:
+        """transcribe samples starting at offset in their recording to a json, published through the claim if given"""
         # transcribe
         if not self.model:
+            import whisper
+
             msg(f" GPU {self.gpu_id} ", "Loading Model")
             self.model = whisper.load_model("large-v2", device=f"cuda:{self.gpu_id}")
             msg(f" GPU {self.gpu_id} ", "Model Loaded")
         # redirect tqdm progress bar to state
+        result = {"text": "", "segments": [], "language": None}
+        step = CHUNK * SAMPLE_RATE
         with TqdmOut(self.state) as tqdm_out:
             sys.stderr = tqdm_out
-            result = self.model.transcribe(vocal, language="zh", verbose=False)
+            for i in range(0, len(audio), step):
+                # the text so far prompts the next chunk, as whisper does between its windows
+                chunk = self.model.transcribe(
+                    audio[i : i + step],
+                    language="zh",
+                    verbose=False,
+                    initial_prompt=result["text"][-200:] or None,
+                )
+                self.repair(chunk, audio[i : i + step], transcript, i / SAMPLE_RATE)
+                for segment in chunk["segments"]:
+                    segment["id"] = len(result["segments"])
+                    segment["start"] += i / SAMPLE_RATE
+                    segment["end"] += i / SAMPLE_RATE
+                    segment["seek"] += i * FRAMES_PER_SECOND // SAMPLE_RATE
+                    result["segments"].append(segment)
+                result["text"] += chunk["text"]
+                result["language"] = result["language"] or chunk.get("language")
             sys.stderr = sys.__stderr__
-        # convert to simplified chinese
+        # convert to simplified chinese and shift to the time in the recording
         result["text"] = self.converter.convert(result["text"])
         for segment in result["segments"]:
             segment["text"] = self.converter.convert(segment["text"])
-        # save result to json file with utf-8 encoding, pretty print
-        with open(transcript, "w", encoding="utf-8") as f:
+            segment["start"] += offset
+            segment["end"] += offset
+            if "seek" in segment:
+                # in mel frames of 10 ms
+                segment["seek"] += round(offset * 100)
+        # save result to json file with utf-8 encoding, pretty print, in one go so that readers never see it partially
+        tmp = f"{transcript}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
             json.dump(result, f, ensure_ascii=False, indent=4)
+        if claim:
+            claim.publish(tmp, transcript)
+        else:
+            os.replace(tmp, transcript)
+
+    def repair(
+        self, result: dict, audio: np.ndarray, transcript: str, at: float = 0.0
+    ) -> None:
+        """re-decode the looped windows of a chunk starting at seconds at with the FALLBACK settings, in place"""
+        duration = len(audio) / SAMPLE_RATE
+        groups = windows(result["segments"])
+        segments = []
+        for i, group in enumerate(groups):
+            seek = group[0]["seek"]
+            start = seek / FRAMES_PER_SECOND
+            end = (
+                groups[i + 1][0]["seek"] / FRAMES_PER_SECOND
+                if i + 1 < len(groups)
+                else duration
+            )
+            reason = looped(group, start, end)
+            if reason:
+                msg(
+                    f" GPU {self.gpu_id} ",
+                    "Loop",
+                    f"{reason} at {at + start:.0f} s, re-decoding",
+                    file=transcript,
+                )
+                retry = self.model.transcribe(
+                    audio[round(start * SAMPLE_RATE) : round(end * SAMPLE_RATE)],
+                    language="zh",
+                    verbose=None,
+                    **FALLBACK,
+                )
+                group = retry["segments"]
+                for segment in group:
+                    segment["start"] += start
+                    segment["end"] += start
+                    segment["seek"] = seek
+                if looped(group, start, end):
+                    group = collapse(group, start, end)
+                metrics.count("transcribe", "loop_windows")
+            segments.extend(group)
+        for i, segment in enumerate(segments):
+            segment["id"] = i
+        result["segments"] = segments
+        result["text"] = "".join(segment["text"] for segment in segments)
 
 
 class Watcher:
@@ -126,39 +356,88 @@ class Watcher:
             # set new tasks to idle workers, prioritize GPU1
             for state in reversed(self.states):
                 if not state["task"]:
+                    state["queued"] = time.time()
                     state["task"] = self.new_task()
             time.sleep(5)
 
     def new_task(self) -> tuple[str, str] | None:
-        for file in os.listdir(VOCAL_DIR):
+        """(audio, part transcript) of the most urgent part without a transcript that isn't being worked on"""
+        current_tasks = [state["task"][1] for state in self.states if state["task"]]
+        # {audio: [part transcripts]}
+        tasks: dict[str, list[str]] = {}
+        # parts of assembled vocals (prerequisite) whose transcript isn't merged yet (job), the check cleans up the wavs
+        for file in os.listdir(utils.VOCAL_DIR):
             if file.endswith(".mp3"):
-                base_name = os.path.splitext(file)[0]
-                vocal = os.path.join(VOCAL_DIR, file)
-                transcript = os.path.join(TRANSCRIPT_DIR, f"{base_name}.json")
-                task = (vocal, transcript)
-                # return task if vocal is valid (prerequisite) and valid transcript not exist (job) and not being worked on (job)
-                current_tasks = [state["task"] for state in self.states]
+                bare_name = os.path.splitext(file)[0]
                 if (
-                    valid(base_name, "vocal")
-                    and not valid(base_name, "transcript")
-                    and task not in current_tasks
+                    not valid(bare_name, "vocal")
+                    or valid(bare_name, "transcript")
+                    or merge(bare_name)
                 ):
-                    return task
+                    continue
+                tasks[os.path.join(utils.VOCAL_DIR, file)] = [
+                    part_transcript(base_name) for base_name in part_names(bare_name)
+                ]
+        # parts separated by Demucs (prerequisite) before their recording is assembled, transcribed from the wav
+        for file in (
+            os.listdir(utils.DEMUCS_DIR) if os.path.exists(utils.DEMUCS_DIR) else []
+        ):
+            if file.endswith("_vocals.wav") and not file.endswith("_no_vocals.wav"):
+                base_name = file.split("_vocals.wav")[0]
+                try:
+                    if not valid(base_name, "demucs"):
+                        continue
+                except Exception as e:
+                    msg("Watcher", "valid()", repr(e), file=file, error=True)
+                    continue
+                for parts in tasks.values():
+                    if part_transcript(base_name) in parts:
+                        parts.remove(part_transcript(base_name))
+                tasks[os.path.join(utils.DEMUCS_DIR, file)] = [
+                    part_transcript(base_name)
+                ]
+        # drop the parts done (job) or being worked on (job)
+        for audio, parts in tasks.items():
+            tasks[audio] = [
+                part
+                for part in parts
+                if not os.path.exists(part)
+                and part not in current_tasks
+                and not lease.held("transcribe", os.path.basename(part)[:-5])
+                and not journal.blocked("transcribe", os.path.basename(part)[:-5])
+            ]
+        # return the first part left of the most urgent recording, whichever audio it is in
+        queue = priority.order("transcribe", [a for a in tasks if tasks[a]])
+        if queue:
+            bare_name = priority.bare_name(queue[0])
+            return min(
+                (part, audio)
+                for audio, parts in tasks.items()
+                for part in parts
+                if priority.bare_name(part) == bare_name
+            )[::-1]
 
 
 def main() -> None:
+    # heavy imports stay out of module import, workers import whisper when they load the model
+    import torch
+
+    num_gpu = torch.cuda.device_count()
     msg("Xscribe", "Starting")
     with Manager() as manager:
         # init processes
         states = manager.list(
-            [manager.dict({"task": None, "progress": "n/a"}) for _ in range(NUM_GPU)]
+            [
+                manager.dict({"task": None, "progress": "n/a", "queued": 0})
+                for _ in range(num_gpu)
+            ]
         )
         watcher = Process(target=Watcher(states))
-        workers = [Process(target=Worker(i, states[i])) for i in range(NUM_GPU)]
+        workers = [Process(target=Worker(i, states[i])) for i in range(num_gpu)]
         # start processes
         watcher.start()
         # start workers in reverse order as GPU0 might has been occupied by Demucs
-        for i in range(NUM_GPU - 1, -1, -1):
+        for i in range(num_gpu - 1, -1, -1):
             workers[i].start()
         # wait for processes to finish
         while True:
@@ -167,7 +446,7 @@ def main() -> None:
                 "Xscribe",
                 "Progress",
                 " ".join(
-                    [f'GPU {i} {states[i]["progress"]:<32}' for i in range(NUM_GPU)]
+                    [f'GPU {i} {states[i]["progress"]:<32}' for i in range(num_gpu)]
                 ),
                 end="\r",
             )
@@ -176,7 +455,7 @@ def main() -> None:
                 msg("Xscribe", "Restarting", "Watcher")
                 watcher = Process(target=Watcher(states))
                 watcher.start()
-            for i in range(NUM_GPU - 1, -1, -1):
+            for i in range(num_gpu - 1, -1, -1):
                 if not workers[i].is_alive():
                     msg("Xscribe", "Restarting", f"GPU {i}")
                     workers[i] = Process(target=Worker(i, states[i]))
@@ -1,4 +1,5 @@
-import os, json, time, ffmpeg
+import os, json, time, shutil, ffmpeg
+import numpy as np
 from colorama import Fore
 from math import ceil
 
@@ -11,32 +12,132 @@ def find_all_dir(dir: str):
     return dir_list
 
 
-# load config
-with open("config.json") as f:
-    config = json.load(f)
-VIDEO_DIR_LIST = [
-    item for dir in config["video_dir_list"] for item in find_all_dir(dir)
-]
-OUT_DIR = config["out_dir"]
-PART_DURATION = config["part_duration"]
-# work directories
-AUDIO_DIR = os.path.join(OUT_DIR, "audio")
-VOCAL_DIR = os.path.join(OUT_DIR, "vocal")
-TMP_DIR = os.path.join(OUT_DIR, "tmp")
-DEMUCS_DIR = os.path.join(TMP_DIR, "htdemucs")
-TRANSCRIPT_DIR = os.path.join(OUT_DIR, "transcript")
-SLICE_DIR = os.path.join(TMP_DIR, "slice")
-# SLICE_DIR = "/home/yiguo/slice"
-FAVORITE_DIR = os.path.join(OUT_DIR, "favorite")
-for dir in [AUDIO_DIR, VOCAL_DIR, TMP_DIR, TRANSCRIPT_DIR, SLICE_DIR, FAVORITE_DIR]:
-    if not os.path.exists(dir):
-        os.mkdir(dir)
-# other global variables
-EXCLUDELIST = os.path.join(AUDIO_DIR, "exclude.txt")
+# config-derived globals, loaded on first access so that importing utils has no side effects. Other modules read
+# them as utils.NAME when called, so that a reload reaches them
+CONFIG_NAMES = (
+    "config",
+    "VIDEO_DIR_LIST",
+    "OUT_DIR",
+    "PART_DURATION",
+    "SLICE_CACHE_BYTES",
+    "AUDIO_DIR",
+    "VOCAL_DIR",
+    "TMP_DIR",
+    "DEMUCS_DIR",
+    "TRANSCRIPT_DIR",
+    "TRANSCRIPT_PART_DIR",
+    "SLICE_DIR",
+    "FRAME_DIR",
+    "PEAK_DIR",
+    "METRIC_DIR",
+    "PROFILE_DIR",
+    "LEASE_DIR",
+    "FINGERPRINT_DIR",
+    "QUEUE_DIR",
+    "PLAN_DIR",
+    "SEPARATION_DIR",
+    "JOURNAL_DIR",
+    "SHARD_DIR",
+    "FAVORITE_DIR",
+    "EXCLUDELIST",
+    "BOOSTLIST",
+)
+
+
+def load_config(file: str = "config.json") -> None:
+    """read the config, find the video directories and name the work directories"""
+    global config, VIDEO_DIR_LIST, OUT_DIR, PART_DURATION, SLICE_CACHE_BYTES
+    global AUDIO_DIR, VOCAL_DIR, TMP_DIR, DEMUCS_DIR, TRANSCRIPT_DIR, TRANSCRIPT_PART_DIR
+    global SLICE_DIR, FRAME_DIR, PEAK_DIR, METRIC_DIR, PROFILE_DIR, LEASE_DIR
+    global FINGERPRINT_DIR, QUEUE_DIR, PLAN_DIR, SEPARATION_DIR, JOURNAL_DIR, SHARD_DIR
+    global FAVORITE_DIR
+    global EXCLUDELIST, BOOSTLIST
+    # load config
+    with open(file) as f:
+        config = json.load(f)
+    VIDEO_DIR_LIST = [
+        item for dir in config["video_dir_list"] for item in find_all_dir(dir)
+    ]
+    OUT_DIR = config["out_dir"]
+    PART_DURATION = config["part_duration"]
+    SLICE_CACHE_BYTES = config.get("slice_cache_bytes", 2 * 1024**3)
+    # work directories
+    AUDIO_DIR = os.path.join(OUT_DIR, "audio")
+    VOCAL_DIR = os.path.join(OUT_DIR, "vocal")
+    TMP_DIR = os.path.join(OUT_DIR, "tmp")
+    DEMUCS_DIR = os.path.join(TMP_DIR, "htdemucs")
+    TRANSCRIPT_DIR = os.path.join(OUT_DIR, "transcript")
+    TRANSCRIPT_PART_DIR = os.path.join(TMP_DIR, "transcript_part")
+    SLICE_DIR = os.path.join(TMP_DIR, "slice")
+    # SLICE_DIR = "/home/yiguo/slice"
+    FRAME_DIR = os.path.join(TMP_DIR, "frame")
+    PEAK_DIR = os.path.join(TMP_DIR, "peak")
+    METRIC_DIR = os.path.join(TMP_DIR, "metrics")
+    PROFILE_DIR = os.path.join(TMP_DIR, "profile")
+    LEASE_DIR = os.path.join(TMP_DIR, "lease")
+    FINGERPRINT_DIR = os.path.join(TMP_DIR, "fingerprint")
+    QUEUE_DIR = os.path.join(TMP_DIR, "queue")
+    PLAN_DIR = os.path.join(TMP_DIR, "plan")
+    SEPARATION_DIR = os.path.join(TMP_DIR, "separation")
+    JOURNAL_DIR = os.path.join(TMP_DIR, "journal")
+    SHARD_DIR = os.path.join(TMP_DIR, "shard")
+    FAVORITE_DIR = os.path.join(OUT_DIR, "favorite")
+    # other global variables
+    EXCLUDELIST = os.path.join(AUDIO_DIR, "exclude.txt")
+    BOOSTLIST = os.path.join(AUDIO_DIR, "boost.txt")
+
+
+def make_dirs() -> None:
+    """create the work directories"""
+    for dir in [
+        AUDIO_DIR,
+        VOCAL_DIR,
+        TMP_DIR,
+        TRANSCRIPT_DIR,
+        TRANSCRIPT_PART_DIR,
+        SLICE_DIR,
+        FRAME_DIR,
+        PEAK_DIR,
+        METRIC_DIR,
+        PROFILE_DIR,
+        LEASE_DIR,
+        FINGERPRINT_DIR,
+        QUEUE_DIR,
+        PLAN_DIR,
+        SEPARATION_DIR,
+        JOURNAL_DIR,
+        SHARD_DIR,
+        FAVORITE_DIR,
+    ]:
+        if not os.path.exists(dir):
+            os.mkdir(dir)
+
+
+def reload_config(file: str = "config.json") -> None:
+    """reload the config in a running process"""
+    load_config(file)
+    make_dirs()
+
+
+def __getattr__(name: str):
+    if name in CONFIG_NAMES:
+        require_config()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def require_config() -> None:
+    """load the config and create the work directories if not yet, on the first use of a config-derived global"""
+    if "config" not in globals():
+        load_config()
+        make_dirs()
 
 
 # utility functions
 
+# {file: ((mtime, size), duration)} of probed media files
+_durations: dict[str, tuple[tuple[int, int], float]] = {}
+
 
 def get_duration(file: str) -> float:
     if file.endswith(".json"):
@@ -48,8 +149,18 @@ def get_duration(file: str) -> float:
             else:
                 duration = 0
     else:
-        output = ffmpeg.probe(file)
+        # probe each version of a file once in long running processes
+        stat = os.stat(file)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = _durations.get(file)
+        if cached and cached[0] == key:
+            return cached[1]
+        # through the shared executor, which limits concurrent probes and coalesces identical ones
+        import media
+
+        output = media.probe(file)
         duration = float(output["format"]["duration"])
+        _durations[file] = (key, duration)
     return duration
 
 
@@ -62,7 +173,7 @@ def msg(
     end: str = "\n",
 ) -> None:
     # clear line
-    print(" " * os.get_terminal_size().columns, end="\r", flush=True)
+    print(" " * shutil.get_terminal_size().columns, end="\r", flush=True)
     # print message
     color = Fore.RED if error else Fore.GREEN
     print(
@@ -87,6 +198,7 @@ def highlight(value: int | float, operand: str, threshold: float) -> str:
 
 def get_video(bare_name: str) -> str:
     """find the video path by bare name"""
+    require_config()
     for dir in VIDEO_DIR_LIST:
         for file in os.listdir(dir):
             if file in [f"{bare_name}.mp4", f"{bare_name}.flv"]:
@@ -95,31 +207,148 @@ def get_video(bare_name: str) -> str:
     raise Exception(f"Can't find video for bare name: {bare_name}")
 
 
-def get_audio_parts(bare_name: str) -> dict[str, float]:
+# seconds around each multiple of PART_DURATION to look for a quiet cut point, at most a tenth of it
+CUT_TOLERANCE = 60
+# a last part shorter than this fraction of PART_DURATION is merged into the previous part
+MIN_TAIL = 0.25
+# sample rate of the energy scan, 50 ms frames smoothed over 0.5 s
+SCAN_RATE = 4000
+SCAN_FRAME = 200
+SCAN_SMOOTH = 10
+# {bare_name: (video duration, cut points)} of the plans read in this process
+_plans: dict[str, tuple[float, list[float]]] = {}
+
+
+class NotPlanned(Exception):
+    """the recording's cut points aren't planned yet, only extract_audio plans them"""
+
+
+def find_quiet(file: str, start: float, end: float) -> float:
+    """the middle of the quietest half second in [start, end] of the file's audio"""
+    import media
+
+    out = media.run(
+        "decode",
+        ffmpeg.input(file, ss=start, t=end - start)
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=SCAN_RATE)
+        .compile(),
+    )
+    samples = np.frombuffer(out, dtype=np.int16).astype(np.float32)
+    frames = len(samples) // SCAN_FRAME
+    if frames < SCAN_SMOOTH:
+        return (start + end) / 2
+    energy = (samples[: frames * SCAN_FRAME].reshape(frames, SCAN_FRAME) ** 2).mean(1)
+    energy = np.convolve(energy, np.ones(SCAN_SMOOTH), "valid")
+    quiet = start + (np.argmin(energy) + SCAN_SMOOTH / 2) * SCAN_FRAME / SCAN_RATE
+    return round(float(quiet), 3)
+
+
+def plan_cuts(video: str, duration: float) -> list[float]:
+    """Cut points of the audio parts, at the quietest spot within CUT_TOLERANCE of every PART_DURATION after the
+    previous cut, so that parts don't break words. A short last part is merged into the previous one.
+    """
+    cuts = []
+    start = 0.0
+    tolerance = min(CUT_TOLERANCE, PART_DURATION / 10)
+    while duration - start > PART_DURATION:
+        target = start + PART_DURATION
+        cuts.append(
+            find_quiet(
+                video,
+                max(target - tolerance, start + 1),
+                min(target + tolerance, duration - 1),
+            )
+        )
+        start = cuts[-1]
+    if cuts and duration - cuts[-1] < MIN_TAIL * PART_DURATION:
+        cuts.pop()
+    return cuts
+
+
+def uniform_cuts(duration: float) -> list[float]:
+    """cut points at every multiple of PART_DURATION, as planned before the cuts were aligned to silence"""
+    return [PART_DURATION * i for i in range(1, ceil(duration / PART_DURATION))]
+
+
+def save_plan(file: str, duration: float, cuts: list[float]) -> None:
+    tmp = f"{file}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"duration": duration, "cuts": cuts}, f)
+    if os.path.exists(file):
+        os.replace(tmp, file)
+    else:
+        # another process may have planned meanwhile, the first plan wins
+        try:
+            os.link(tmp, file)
+        except FileExistsError:
+            pass
+        os.remove(tmp)
+
+
+def get_cuts(
+    bare_name: str, video: str, duration: float, plan: bool = False
+) -> list[float]:
+    """cut points of the recording saved in PLAN_DIR, raises NotPlanned if missing unless plan"""
+    cached = _plans.get(bare_name)
+    if cached and abs(cached[0] - duration) < 1:
+        return cached[1]
+    file = os.path.join(PLAN_DIR, f"{bare_name}.json")
+    try:
+        with open(file) as f:
+            saved = json.load(f)
+        if abs(saved["duration"] - duration) >= 1:
+            # the video changed, plan again
+            raise FileNotFoundError
+        cuts = saved["cuts"]
+    except (FileNotFoundError, json.JSONDecodeError):
+        cuts = uniform_cuts(duration)
+        names = [f"{bare_name}.m4a"] + [
+            f"{bare_name}_part_{1 + i:02d}.m4a" for i in range(len(cuts) + 1)
+        ]
+        extracted = any(os.path.exists(os.path.join(AUDIO_DIR, n)) for n in names)
+        if not plan and not extracted:
+            raise NotPlanned(bare_name)
+        if not extracted:
+            cuts = plan_cuts(video, duration)
+        if plan:
+            save_plan(file, duration, cuts)
+            with open(file) as f:
+                cuts = json.load(f)["cuts"]
+    _plans[bare_name] = (duration, cuts)
+    return cuts
+
+
+def get_audio_parts(bare_name: str, plan: bool = False) -> dict[str, float]:
     """Find the audio part files by bare name. Note that it returns the designed filenames and durations,
-    not the actual files and durations.
+    not the actual files and durations. The parts are cut at the planned points, see get_cuts() for plan.
 
     Returns
     -------
     dict[str, float]
-        {audio_part_path: duration}
+        {audio_part_path: duration} in order.
     """
+    require_config()
     video = get_video(bare_name)
     video_duration = get_duration(video)
-    num_part = ceil(video_duration / PART_DURATION)
-    if num_part == 1:
-        audio_parts = {os.path.join(AUDIO_DIR, f"{bare_name}.m4a"): video_duration}
-    else:
-        audio_parts = {
-            os.path.join(AUDIO_DIR, f"{bare_name}_part_{1+i:02d}.m4a"): PART_DURATION
-            for i in range(num_part - 1)
-        } | {
-            os.path.join(
-                AUDIO_DIR, f"{bare_name}_part_{num_part:02d}.m4a"
-            ): video_duration
-            % PART_DURATION
-        }
-    return audio_parts
+    cuts = get_cuts(bare_name, video, video_duration, plan)
+    if not cuts:
+        return {os.path.join(AUDIO_DIR, f"{bare_name}.m4a"): video_duration}
+    bounds = [0.0] + cuts + [video_duration]
+    return {
+        os.path.join(AUDIO_DIR, f"{bare_name}_part_{1 + i:02d}.m4a"): end - start
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+    }
+
+
+def get_part_offset(base_name: str) -> float:
+    """start of an audio part in its recording in seconds"""
+    bare_name = base_name.split("_part_")[0]
+    offset = 0.0
+    for file, duration in get_audio_parts(bare_name).items():
+        if os.path.basename(file) == f"{base_name}.m4a":
+            return offset
+        offset += duration
+    raise ValueError(f"No audio part {base_name}")
 
 
 def valid(base_name: str, target: str) -> bool:
@@ -139,6 +368,7 @@ def valid(base_name: str, target: str) -> bool:
     bool
         True if the job has been done correctly, False otherwise.
     """
+    require_config()
     bare_name = base_name.split("_vocal")[0].split("_part_")[0]
     audio = os.path.join(AUDIO_DIR, f"{base_name}.m4a")
     wav = os.path.join(DEMUCS_DIR, f"{base_name}_vocals.wav")